@@ -4,6 +4,8 @@ import argparse
 import os
 from sklearn.decomposition import PCA
 
+from spatiallm.pcd import remove_statistical_outlier, to_uint8_colors
+
 def load_point_cloud(file_path):
     print(f"Loading point cloud from {file_path}")
     try:
@@ -35,14 +37,13 @@ def align_to_manhattan(point_cloud, visualize=True):
         print("Error: Invalid point cloud for alignment.")
         return None, np.eye(3), np.zeros(3)
     
-    # Copy original point cloud data
-    points = np.asarray(point_cloud.points).copy()
+    # Keep the original colors as uint8
     has_colors = point_cloud.has_colors()
-    original_colors = np.asarray(point_cloud.colors).copy() if has_colors else None
+    original_colors = to_uint8_colors(np.asarray(point_cloud.colors)) if has_colors else None
     
     # Simple outlier removal
     try:
-        cl, _ = point_cloud.remove_statistical_outlier(nb_neighbors=20, std_ratio=2.0)
+        cl, _ = remove_statistical_outlier(point_cloud, nb_neighbors=20, std_ratio=2.0)
         if len(np.asarray(cl.points)) == 0:
             print("Warning: Outlier removal eliminated all points. Using original point cloud.")
             cl = point_cloud
@@ -50,11 +51,11 @@ def align_to_manhattan(point_cloud, visualize=True):
         print(f"Warning: Error during outlier removal: {e}. Using original point cloud.")
         cl = point_cloud
     
-    # Get cleaned points
-    points = np.asarray(cl.points).copy()
+    # Get cleaned points as float32
+    points = np.asarray(cl.points, dtype=np.float32)
     
-    # Calculate centroid
-    centroid = np.mean(points, axis=0)
+    # Calculate centroid (accumulated in float64)
+    centroid = np.mean(points, axis=0, dtype=np.float64)
     print(f"Centroid: {centroid}")
     
     # Use PCA to find principal axes
@@ -102,8 +103,9 @@ def align_to_manhattan(point_cloud, visualize=True):
         print(f"Error during PCA analysis: {e}")
         return point_cloud, np.eye(3), centroid
     
-    # Apply transformation
-    aligned_points = np.dot(points - centroid, R.T) + centroid
+    # Apply transformation in float32
+    centroid_f32 = centroid.astype(np.float32)
+    aligned_points = np.dot(points - centroid_f32, R.T.astype(np.float32)) + centroid_f32
     
     # Create result point cloud
     aligned_result = o3d.geometry.PointCloud()
@@ -112,7 +114,7 @@ def align_to_manhattan(point_cloud, visualize=True):
     # Copy colors if present
     if has_colors and original_colors is not None:
         if len(original_colors) == len(aligned_points):
-            aligned_result.colors = o3d.utility.Vector3dVector(original_colors)
+            aligned_result.colors = o3d.utility.Vector3dVector(original_colors / 255.0)
         else:
             print("Warning: Color array size mismatch. Using default coloring.")
             aligned_result.paint_uniform_color([0, 0.651, 0.929])  # Blue
@@ -128,14 +130,14 @@ def align_to_manhattan(point_cloud, visualize=True):
             original_viz = o3d.geometry.PointCloud()
             original_viz.points = o3d.utility.Vector3dVector(points)
             if has_colors and original_colors is not None:
-                original_viz.colors = o3d.utility.Vector3dVector(original_colors)
+                original_viz.colors = o3d.utility.Vector3dVector(original_colors / 255.0)
             else:
                 original_viz.paint_uniform_color([1, 0.706, 0])  # Orange
             
             aligned_viz = o3d.geometry.PointCloud()
             aligned_viz.points = o3d.utility.Vector3dVector(aligned_points)
             if has_colors and original_colors is not None:
-                aligned_viz.colors = o3d.utility.Vector3dVector(original_colors)
+                aligned_viz.colors = o3d.utility.Vector3dVector(original_colors / 255.0)
             else:
                 aligned_viz.paint_uniform_color([0, 0.651, 0.929])  # Blue
             
@@ -0,0 +1,164 @@
+"""
+Benchmark the latency of the point encoder fast path against the previous
+path, which cast the encoder to float32, scanned every point cloud for nan
+padding and recomputed the Fourier encoding of every voxel on each call, and
+with the sparse convolutions autocast to bfloat16 on CPU. The maximum absolute
+difference of the context features to the previous path is reported.
+
+Usage:
+    python benchmarks/encoder_benchmark.py --num_points 50000 200000 --batch_size 1 4
+    python benchmarks/encoder_benchmark.py -m manycore-research/SpatialLM-Llama-1B --sparse_backend torch
+"""
+
+import argparse
+import time
+
+import torch
+
+from spatiallm.model.pcd_encoder import (
+    PointCloudEncoder,
+    fourier_encode_vector,
+    unpad_point_clouds,
+    vox_to_sequence,
+)
+
+
+def synthetic_point_clouds(batch_size, num_points, num_bins, seed=0):
+    """[n_points, 9] grid coordinates, coordinates and colors of thin surfaces."""
+    generator = torch.Generator().manual_seed(seed)
+    point_clouds = []
+    for _ in range(batch_size):
+        coords = torch.randint(0, num_bins, (num_points, 3), generator=generator)
+        # snap every point to one of the faces, as scanned surfaces are thin
+        face = torch.randint(0, 3, (num_points,), generator=generator)
+        coords[torch.arange(num_points), face] = 0
+        feats = torch.rand(num_points, 6, generator=generator)
+        point_clouds.append(torch.cat([coords.float(), feats], dim=1))
+    return point_clouds
+
+
+def legacy_encode(encoder, point_clouds, device):
+    """The encoder path before the fast path, see the module docstring."""
+    encoder.to(torch.float32)
+    backend = encoder.sparse_backend
+    sparse_tensors = []
+    for point_cloud in point_clouds:
+        point_cloud = point_cloud[~torch.isnan(point_cloud).any(dim=1)]
+        sparse_tensors.append(
+            backend.SparseTensor(
+                coords=point_cloud[:, :3].int(), feats=point_cloud[:, 3:].float()
+            )
+        )
+    sparse_tensor = backend.sparse_collate(sparse_tensors).to(device)
+    outputs = vox_to_sequence(encoder.sparse_resnet(sparse_tensor))
+    coords_normalised = outputs["coords"] / (encoder.reduced_grid_size - 1)
+    context = torch.cat(
+        [outputs["seq"], fourier_encode_vector(coords_normalised)], dim=-1
+    )
+    return encoder.input_proj(context) + encoder.extra_embedding
+
+
+def fast_encode(encoder, point_clouds, device):
+    backend = encoder.sparse_backend
+    sparse_tensors = []
+    for point_cloud in unpad_point_clouds(point_clouds):
+        point_cloud = point_cloud.to(device=device, dtype=torch.float32)
+        sparse_tensors.append(
+            backend.SparseTensor(
+                coords=point_cloud[:, :3].int(), feats=point_cloud[:, 3:]
+            )
+        )
+    return encoder(backend.sparse_collate(sparse_tensors))["context"]
+
+
+def best_of(fn, repeat, device):
+    timings = []
+    for _ in range(repeat):
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        output = fn()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        timings.append(time.perf_counter() - start)
+    return min(timings), output
+
+
+def main():
+    parser = argparse.ArgumentParser("Point encoder benchmark")
+    parser.add_argument("--num_points", type=int, nargs="+", default=[20_000, 100_000])
+    parser.add_argument("--batch_size", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("-m", "--model_path", type=str, default=None)
+    parser.add_argument("--sparse_backend", type=str, default=None)
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    device = torch.device(args.device)
+
+    if args.model_path is not None:
+        from transformers import AutoModelForCausalLM
+
+        model = AutoModelForCausalLM.from_pretrained(args.model_path)
+        config = model.config.point_config
+        state_dict = model.point_backbone.state_dict()
+        del model
+    else:
+        config = dict(
+            input_channels=6,
+            embed_channels=1536,
+            conv_layers=[64, 128, 256, 512],
+            num_bins=1280,
+        )
+        state_dict = None
+    encoder = PointCloudEncoder(
+        input_channels=config["input_channels"],
+        d_model=config["embed_channels"],
+        conv_layers=config["conv_layers"],
+        num_bins=config["num_bins"],
+        sparse_backend=args.sparse_backend,
+    )
+    if state_dict is not None:
+        encoder.load_state_dict(state_dict)
+    encoder = encoder.to(device).eval()
+
+    modes = ["legacy", "fast"]
+    if device.type == "cpu":
+        modes.append("fast bf16")
+    print(
+        f"{'batch':>5} {'points':>8} | "
+        + " ".join(f"{mode + ' (ms)':>14}" for mode in modes)
+        + " | bf16 max abs diff"
+    )
+    for batch_size in args.batch_size:
+        for num_points in args.num_points:
+            point_clouds = synthetic_point_clouds(
+                batch_size, num_points, config["num_bins"]
+            )
+            results = {}
+            with torch.no_grad():
+                results["legacy"] = best_of(
+                    lambda: legacy_encode(encoder, point_clouds, device),
+                    args.repeat,
+                    device,
+                )
+                for mode in modes[1:]:
+                    encoder.autocast_dtype = torch.bfloat16 if "bf16" in mode else None
+                    results[mode] = best_of(
+                        lambda: fast_encode(encoder, point_clouds, device),
+                        args.repeat,
+                        device,
+                    )
+                encoder.autocast_dtype = None
+            reference = results["legacy"][1]
+            # the fast float32 path computes the same operations
+            assert torch.allclose(results["fast"][1], reference, atol=1e-5)
+            diff = (results[modes[-1]][1] - reference).abs().max().item()
+            print(
+                f"{batch_size:>5} {num_points:>8} | "
+                + " ".join(f"{results[mode][0] * 1e3:>14.1f}" for mode in modes)
+                + f" | {diff:.2e}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""
+Check that the layout grammar of constrained decoding accepts every box class
+of a label mapping, so --constrained never masks a class the model was trained
+on. Class names are written with underscores in place of spaces, the inverse of
+the mapping eval.py applies.
+
+Usage:
+    python benchmarks/grammar_coverage.py
+    python benchmarks/grammar_coverage.py --label_mapping SpatialLM-Testset/benchmark_categories.tsv --column spatiallm18
+"""
+
+import argparse
+import csv
+import sys
+
+from spatiallm import Layout
+from spatiallm.layout.grammar import LayoutGrammar
+
+
+def rejected_class_names(class_names, grammar):
+    """Class names whose box line the grammar or Layout.parse_line rejects."""
+    rejected = []
+    for class_name in class_names:
+        line = f"bbox_0=Bbox({class_name},1,2,3,4,5,6,7)"
+        state = grammar.advance_text(grammar.start, line + "\n")
+        if state is None or Layout.parse_line(line) is None:
+            rejected.append(class_name)
+    return rejected
+
+
+def main():
+    parser = argparse.ArgumentParser("Layout grammar class coverage")
+    parser.add_argument(
+        "--label_mapping",
+        type=str,
+        default="SpatialLM-Testset/benchmark_categories.tsv",
+    )
+    parser.add_argument("--column", type=str, default="spatiallm59")
+    args = parser.parse_args()
+
+    with open(args.label_mapping) as f:
+        class_names = sorted(
+            {
+                row[args.column].replace(" ", "_")
+                for row in csv.DictReader(f, delimiter="\t")
+                if row[args.column]
+            }
+        )
+    rejected = rejected_class_names(class_names, LayoutGrammar())
+    print(f"{len(class_names) - len(rejected)}/{len(class_names)} classes accepted")
+    for class_name in rejected:
+        print(f"Rejected: {class_name}")
+    sys.exit(1 if rejected else 0)
+
+
+if __name__ == "__main__":
+    main()
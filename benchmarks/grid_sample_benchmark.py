@@ -0,0 +1,122 @@
+"""
+Benchmark the counting-sort voxelization of GridSample test mode against the
+hash + argsort path, with the grid settings used by inference.py.
+
+Usage:
+    python benchmarks/grid_sample_benchmark.py --num_points 1000000 10000000 50000000
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from spatiallm import Layout
+from spatiallm.pcd.pcd_loader import GridSample
+from spatiallm.pcd.voxelize import voxelize_test
+
+
+def synthetic_scan(num_points, extent=(12.0, 9.0, 3.0), seed=0):
+    """Points scattered on the floor, ceiling and walls of a box room plus clutter."""
+    rng = np.random.default_rng(seed)
+    extent = np.asarray(extent)
+    points = rng.random((num_points, 3)) * extent
+    # snap 80% of the points onto one of the six faces of the room
+    on_face = rng.random(num_points) < 0.8
+    axis = rng.integers(0, 3, num_points)
+    side = rng.integers(0, 2, num_points)
+    rows = np.flatnonzero(on_face)
+    points[rows, axis[rows]] = side[rows] * extent[axis[rows]]
+    points += rng.normal(scale=0.005, size=points.shape)
+    return points
+
+
+def best_of(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings), output
+
+
+def sort_select(grid_coord, kind=None):
+    """Voxel selection of the hash + argsort path of GridSample test mode."""
+    key = GridSample.fnv_hash_vec(grid_coord)
+    idx_sort = np.argsort(key, kind=kind)
+    _, inverse, count = np.unique(
+        key[idx_sort], return_inverse=True, return_counts=True
+    )
+    idx_select = np.cumsum(np.insert(count, 0, 0)[0:-1]) + (count.max() // 2) % count
+    inverse_unsorted = np.zeros_like(inverse)
+    inverse_unsorted[idx_sort] = inverse
+    return idx_sort[idx_select], inverse_unsorted
+
+
+def main():
+    parser = argparse.ArgumentParser("GridSample voxelization benchmark")
+    parser.add_argument(
+        "--num_points",
+        type=int,
+        nargs="+",
+        default=[1_000_000, 5_000_000, 10_000_000, 50_000_000],
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    # the GridSample configuration of inference.preprocess_point_cloud
+    grid_size = Layout.get_grid_size()
+    num_bins = Layout.get_num_bins()
+    cfg = dict(
+        grid_size=grid_size,
+        hash_type="fnv",
+        mode="test",
+        keys=("coord",),
+        return_grid_coord=True,
+        max_grid_coord=num_bins,
+    )
+    sort_path = GridSample(**cfg, counting_sort=False)
+    counting_path = GridSample(**cfg, counting_sort=True)
+
+    print(
+        f"{'points':>10} {'voxels':>9} | {'GridSample (s)':>23} {'speedup':>7} |"
+        f" {'selection only (s)':>23} {'speedup':>7} | match"
+    )
+    print(
+        f"{'':>10} {'':>9} | {'argsort':>11} {'counting':>11} {'':>7} |"
+        f" {'argsort':>11} {'counting':>11} {'':>7} |"
+    )
+    for num_points in args.num_points:
+        coord = synthetic_scan(num_points)
+        t_sort, ref = best_of(lambda: sort_path({"coord": coord.copy()}), args.repeat)
+        t_count, out = best_of(
+            lambda: counting_path({"coord": coord.copy()}), args.repeat
+        )
+
+        grid_coord = np.floor(coord / grid_size).astype(int)
+        grid_coord = np.clip(grid_coord - grid_coord.min(0), 0, num_bins - 1)
+        ts_sort, _ = best_of(lambda: sort_select(grid_coord), args.repeat)
+        ts_count, (index, inverse, _) = best_of(
+            lambda: voxelize_test(
+                grid_coord, num_bins, GridSample.fnv_hash_vec, return_inverse=True
+            ),
+            args.repeat,
+        )
+
+        # the argsort path breaks ties inside a voxel arbitrarily, so compare the
+        # selected points against the same path with a stable sort
+        index_stable, inverse_stable = sort_select(grid_coord, kind="stable")
+        match = (
+            np.array_equal(ref["grid_coord"], out["grid_coord"])
+            and np.array_equal(index_stable, index)
+            and np.array_equal(inverse_stable, inverse)
+        )
+        print(
+            f"{num_points:>10} {len(index):>9} |"
+            f" {t_sort:>11.3f} {t_count:>11.3f} {t_sort / t_count:>6.2f}x |"
+            f" {ts_sort:>11.3f} {ts_count:>11.3f} {ts_sort / ts_count:>6.2f}x | {match}"
+        )
+
+
+if __name__ == "__main__":
+    main()
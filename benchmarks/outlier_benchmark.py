@@ -0,0 +1,115 @@
+"""
+Benchmark the parallel KD-tree outlier removal against Open3D's
+remove_radius_outlier and remove_statistical_outlier, checking that both keep
+the same points. A parity check of the radius filter on small synthetic scans
+runs first and fails loudly if the kept points differ.
+
+Usage:
+    python benchmarks/outlier_benchmark.py --point_cloud SpatialLM-Testset/pcd
+    python benchmarks/outlier_benchmark.py --num_points 1000000 5000000
+"""
+
+import argparse
+import glob
+import os
+
+import numpy as np
+import open3d as o3d
+
+from spatiallm.pcd import NeighborFilter, load_o3d_pcd
+
+from grid_sample_benchmark import best_of, synthetic_scan
+
+# (num_points, nb_points, radius) of the radius filter parity check, including
+# a sparse cloud where most points have a single neighbor
+PARITY_CASES = ((20_000, 3, 0.05), (2_000, 1, 0.02), (20_000, 0, 0.05))
+
+
+def kdtree_filters(points, num_nb, radius, nb_neighbors, std_ratio):
+    """Both filters on one shared index, the way cleanup and alignment use it."""
+    neighbors = NeighborFilter(points)
+    radius_mask = neighbors.radius_mask(num_nb, radius)
+    statistical_mask = neighbors.statistical_mask(nb_neighbors, std_ratio)
+    return np.flatnonzero(radius_mask), np.flatnonzero(statistical_mask)
+
+
+def open3d_filters(pcd, num_nb, radius, nb_neighbors, std_ratio):
+    _, radius_index = pcd.remove_radius_outlier(num_nb, radius)
+    _, statistical_index = pcd.remove_statistical_outlier(nb_neighbors, std_ratio)
+    return np.asarray(radius_index), np.asarray(statistical_index)
+
+
+def to_o3d(points):
+    pcd = o3d.geometry.PointCloud()
+    pcd.points = o3d.utility.Vector3dVector(points)
+    return pcd
+
+
+def check_parity():
+    """Assert that both backends keep the same points on small scans."""
+    for num_points, nb_points, radius in PARITY_CASES:
+        points = synthetic_scan(num_points)
+        _, ref = to_o3d(points).remove_radius_outlier(nb_points, radius)
+        out = np.flatnonzero(NeighborFilter(points).radius_mask(nb_points, radius))
+        assert np.array_equal(np.asarray(ref), out), (
+            f"remove_radius_outlier({nb_points}, {radius}) on {num_points} points:"
+            f" Open3D keeps {len(ref)} points, the KD-tree filter {len(out)}"
+        )
+        print(f"Parity {num_points} points, nb_points={nb_points}: {len(out)} kept")
+
+
+def main():
+    parser = argparse.ArgumentParser("Outlier removal benchmark")
+    parser.add_argument(
+        "--point_cloud",
+        type=str,
+        default=None,
+        help="A point cloud file or a folder of .ply files, synthetic scans if not set",
+    )
+    parser.add_argument(
+        "--num_points", type=int, nargs="+", default=[1_000_000, 5_000_000]
+    )
+    parser.add_argument("--voxel_size", type=float, default=0.02)
+    parser.add_argument("--num_nb", type=int, default=3)
+    parser.add_argument("--radius", type=float, default=0.05)
+    parser.add_argument("--nb_neighbors", type=int, default=20)
+    parser.add_argument("--std_ratio", type=float, default=2.0)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    filter_args = (args.num_nb, args.radius, args.nb_neighbors, args.std_ratio)
+    check_parity()
+
+    scenes = []
+    if args.point_cloud is None:
+        for num_points in args.num_points:
+            scenes.append(
+                (f"synthetic_{num_points}", to_o3d(synthetic_scan(num_points)))
+            )
+    else:
+        if os.path.isfile(args.point_cloud):
+            files = [args.point_cloud]
+        else:
+            files = sorted(glob.glob(os.path.join(args.point_cloud, "*.ply")))
+        for file in files:
+            scenes.append((os.path.basename(file), load_o3d_pcd(file)))
+
+    print(
+        f"{'scene':>24} {'points':>9} | {'open3d (s)':>10} {'kdtree (s)':>10}"
+        f" {'speedup':>7} | match"
+    )
+    for name, pcd in scenes:
+        # the filters run on the voxelized cloud, as in cleanup_pcd
+        pcd = pcd.voxel_down_sample(args.voxel_size)
+        points = np.asarray(pcd.points)
+        t_ref, ref = best_of(lambda: open3d_filters(pcd, *filter_args), args.repeat)
+        t_out, out = best_of(lambda: kdtree_filters(points, *filter_args), args.repeat)
+        match = all(np.array_equal(a, b) for a, b in zip(ref, out))
+        print(
+            f"{name:>24} {len(points):>9} | {t_ref:>10.3f} {t_out:>10.3f}"
+            f" {t_ref / t_out:>6.2f}x | {match}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+Benchmark the fused inference preprocessing of Compose against running
+PositiveShift, NormalizeColor and GridSample one after the other, reporting wall
+time and peak memory of NumPy allocations.
+
+Usage:
+    python benchmarks/preprocess_benchmark.py --num_points 1000000 10000000
+"""
+
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+import torch
+
+from spatiallm import Layout
+from spatiallm.pcd import Compose
+
+from grid_sample_benchmark import synthetic_scan
+
+
+def inference_cfg(grid_size, num_bins):
+    """The transform chain of inference.preprocess_point_cloud."""
+    return [
+        dict(type="PositiveShift"),
+        dict(type="NormalizeColor"),
+        dict(
+            type="GridSample",
+            grid_size=grid_size,
+            hash_type="fnv",
+            mode="test",
+            keys=("coord", "color"),
+            return_grid_coord=True,
+            max_grid_coord=num_bins,
+        ),
+    ]
+
+
+def unfused_preprocess(transform, points, colors):
+    point_cloud = transform({"coord": points.copy(), "color": colors.copy()})
+    point_cloud = np.concatenate(
+        [point_cloud["grid_coord"], point_cloud["coord"], point_cloud["color"]],
+        axis=1,
+    )
+    return torch.as_tensor(np.stack([point_cloud], axis=0))
+
+
+def fused_preprocess(transform, points, colors):
+    point_cloud = transform({"coord": points, "color": colors})
+    return torch.from_numpy(point_cloud["feat"]).unsqueeze(0)
+
+
+def measure(fn, repeat):
+    """Best wall time over repeat runs and the peak traced memory of one run."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = fn()
+        timings.append(time.perf_counter() - start)
+    del output
+    tracemalloc.start()
+    output = fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(timings), peak, output
+
+
+def main():
+    parser = argparse.ArgumentParser("Inference preprocessing benchmark")
+    parser.add_argument(
+        "--num_points",
+        type=int,
+        nargs="+",
+        default=[1_000_000, 5_000_000, 10_000_000],
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    cfg = inference_cfg(Layout.get_grid_size(), Layout.get_num_bins())
+    unfused = Compose(cfg, fuse=False)
+    fused = Compose(cfg)
+    assert fused.fused is not None
+
+    print(
+        f"{'points':>10} {'voxels':>9} | {'time (s)':>23} {'speedup':>7} |"
+        f" {'peak memory (MB)':>23} {'ratio':>7} | match"
+    )
+    print(
+        f"{'':>10} {'':>9} | {'unfused':>11} {'fused':>11} {'':>7} |"
+        f" {'unfused':>11} {'fused':>11} {'':>7} |"
+    )
+    for num_points in args.num_points:
+        points = synthetic_scan(num_points)
+        rng = np.random.default_rng(0)
+        colors = rng.integers(0, 256, size=(num_points, 3), dtype=np.uint8)
+
+        t_ref, m_ref, ref = measure(
+            lambda: unfused_preprocess(unfused, points, colors), args.repeat
+        )
+        t_out, m_out, out = measure(
+            lambda: fused_preprocess(fused, points, colors), args.repeat
+        )
+        # the model casts the features to float32, compare at that precision
+        match = torch.equal(ref.float(), out)
+        print(
+            f"{num_points:>10} {out.shape[1]:>9} |"
+            f" {t_ref:>11.3f} {t_out:>11.3f} {t_ref / t_out:>6.2f}x |"
+            f" {m_ref / 2**20:>11.1f} {m_out / 2**20:>11.1f}"
+            f" {m_ref / m_out:>6.2f}x | {match}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""
+Benchmark weight-only quantized CPU inference against the float32 model,
+reporting the decoding speed, the resident memory of the loaded model and,
+given the testset metadata, the eval.py accuracy of the layouts predicted in
+every mode.
+
+Every mode runs in its own process so that memory is measured in isolation.
+Layouts are decoded greedily, so the differences come from quantization only.
+
+Usage:
+    python benchmarks/quantization_benchmark.py -p scene.ply -m manycore-research/SpatialLM-Llama-1B
+    python benchmarks/quantization_benchmark.py -p SpatialLM-Testset/pcd -o quantization_preds \\
+        --metadata SpatialLM-Testset/test.csv --gt_dir SpatialLM-Testset/layout \\
+        --label_mapping SpatialLM-Testset/benchmark_categories.tsv
+"""
+
+import argparse
+import glob
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def rss_gb():
+    """Current resident memory of the process in GB."""
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024**2
+    return float("nan")
+
+
+def run_mode(mode, args, point_cloud_files):
+    import torch
+    from transformers import AutoTokenizer, AutoModelForCausalLM
+
+    from spatiallm import Layout, PromptCache
+    from spatiallm.model.quantization import load_quantized_model
+    from inference import load_and_preprocess_point_cloud, prepare_input_ids
+
+    torch.set_num_threads(args.num_threads or torch.get_num_threads())
+    tokenizer = AutoTokenizer.from_pretrained(args.model_path)
+    if mode == "float32":
+        model = AutoModelForCausalLM.from_pretrained(args.model_path)
+    else:
+        model = load_quantized_model(args.model_path, 8 if mode == "int8" else 4)
+    model.set_point_backbone_dtype(torch.float32)
+    model.eval()
+    model_rss = rss_gb()
+
+    num_tokens = 0
+    seconds = 0.0
+    for point_cloud_file in point_cloud_files:
+        input_pcd, min_extent, _, scale = load_and_preprocess_point_cloud(
+            point_cloud_file, Layout.get_grid_size(), Layout.get_num_bins()
+        )[0]
+        input_ids = prepare_input_ids(model, tokenizer, args.code_template_file)
+        prompt_cache = PromptCache.prefill(model, input_ids, input_pcd)
+        start = time.perf_counter()
+        output_ids = model.generate(
+            **prompt_cache.generate_kwargs(),
+            max_new_tokens=args.max_new_tokens,
+            do_sample=False,
+            use_cache=True,
+        )[0, len(prompt_cache) :]
+        seconds += time.perf_counter() - start
+        num_tokens += len(output_ids)
+
+        if args.output is not None:
+            layout = Layout(tokenizer.decode(output_ids, skip_special_tokens=True))
+            layout.undiscretize_and_unnormalize()
+            layout.scale(scale)
+            layout.translate(min_extent)
+            output_dir = os.path.join(args.output, mode)
+            os.makedirs(output_dir, exist_ok=True)
+            output_file = os.path.basename(point_cloud_file).replace(".ply", ".txt")
+            with open(os.path.join(output_dir, output_file), "w") as f:
+                f.write(layout.to_language_string())
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024**2
+    return dict(
+        tokens_per_second=num_tokens / seconds,
+        model_rss=model_rss,
+        peak_rss=peak_rss,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser("Quantized inference benchmark")
+    parser.add_argument("-p", "--point_cloud", type=str, required=True)
+    parser.add_argument(
+        "-m", "--model_path", type=str, default="manycore-research/SpatialLM-Llama-1B"
+    )
+    parser.add_argument(
+        "-t", "--code_template_file", type=str, default="code_template.txt"
+    )
+    parser.add_argument(
+        "--modes", type=str, nargs="+", default=["float32", "int8", "int4"]
+    )
+    parser.add_argument("--max_new_tokens", type=int, default=4096)
+    parser.add_argument("--num_threads", type=int, default=None)
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        default=None,
+        help="Folder to save the layouts of every mode in, required for eval.py",
+    )
+    parser.add_argument("--metadata", type=str, default=None)
+    parser.add_argument("--gt_dir", type=str, default=None)
+    parser.add_argument("--label_mapping", type=str, default=None)
+    args = parser.parse_args()
+
+    if os.path.isfile(args.point_cloud):
+        point_cloud_files = [args.point_cloud]
+    else:
+        point_cloud_files = sorted(glob.glob(os.path.join(args.point_cloud, "*.ply")))
+
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    for mode in args.modes:
+        with context.Pool(1) as pool:
+            results[mode] = pool.apply(run_mode, (mode, args, point_cloud_files))
+
+    print(
+        f"{'mode':>8} | {'tokens/s':>8} {'speedup':>7} | {'RSS GB':>6} {'peak GB':>7}"
+    )
+    reference = results[args.modes[0]]["tokens_per_second"]
+    for mode, result in results.items():
+        print(
+            f"{mode:>8} | {result['tokens_per_second']:>8.1f}"
+            f" {result['tokens_per_second'] / reference:>6.2f}x"
+            f" | {result['model_rss']:>6.2f} {result['peak_rss']:>7.2f}"
+        )
+
+    if args.output is not None and args.metadata is not None:
+        for mode in args.modes:
+            print(f"\neval.py of {mode}:")
+            subprocess.run(
+                [
+                    sys.executable,
+                    os.path.join(ROOT, "eval.py"),
+                    "--metadata",
+                    args.metadata,
+                    "--gt_dir",
+                    args.gt_dir,
+                    "--pred_dir",
+                    os.path.join(args.output, mode),
+                    "--label_mapping",
+                    args.label_mapping,
+                ],
+                check=True,
+            )
+
+
+if __name__ == "__main__":
+    main()
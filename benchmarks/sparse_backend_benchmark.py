@@ -0,0 +1,141 @@
+"""
+Benchmark the pure-PyTorch sparse convolution backend of the point encoder
+against torchsparse, loading the same weights in both and checking that they
+encode synthetic scenes, or the point cloud of a checkpoint, to matching
+context features.
+
+Without torchsparse installed, only the torch backend is timed.
+
+Usage:
+    python benchmarks/sparse_backend_benchmark.py --num_points 50000 200000
+    python benchmarks/sparse_backend_benchmark.py -m manycore-research/SpatialLM-Llama-1B -p scene.ply --device cuda
+"""
+
+import argparse
+import time
+
+import torch
+
+from spatiallm.model.pcd_encoder import PointCloudEncoder, get_sparse_backend
+
+
+def synthetic_points(num_points, grid_size=400, seed=0):
+    """Voxel coordinates on the walls and floor of a box, with random features."""
+    generator = torch.Generator().manual_seed(seed)
+    coords = torch.randint(0, grid_size, (num_points, 3), generator=generator)
+    # snap every point to one of the faces, as scanned surfaces are thin
+    face = torch.randint(0, 3, (num_points,), generator=generator)
+    coords[torch.arange(num_points), face] = 0
+    coords = torch.unique(coords, dim=0)
+    feats = torch.randn(coords.shape[0], 6, generator=generator)
+    return torch.cat([coords.float(), feats], dim=1)
+
+
+def build_encoders(args):
+    backends = ["torch"]
+    try:
+        get_sparse_backend("torchsparse")
+        backends.insert(0, "torchsparse")
+    except ImportError:
+        print("torchsparse is not installed, timing the torch backend only")
+
+    if args.model_path is not None:
+        from transformers import AutoModelForCausalLM
+
+        model = AutoModelForCausalLM.from_pretrained(args.model_path)
+        config = model.config.point_config
+        state_dict = model.point_backbone.state_dict()
+        del model
+    else:
+        config = dict(
+            input_channels=6,
+            embed_channels=1536,
+            conv_layers=[64, 128, 256, 512],
+            num_bins=1280,
+        )
+        state_dict = None
+
+    encoders = {}
+    for backend in backends:
+        encoder = PointCloudEncoder(
+            input_channels=config["input_channels"],
+            d_model=config["embed_channels"],
+            conv_layers=config["conv_layers"],
+            num_bins=config["num_bins"],
+            sparse_backend=backend,
+        )
+        if state_dict is None:
+            state_dict = encoder.state_dict()
+        encoder.load_state_dict(state_dict)
+        encoders[backend] = encoder.to(args.device).eval()
+    return encoders
+
+
+def encode(encoder, point_cloud, device):
+    backend = encoder.sparse_backend
+    sparse_tensor = backend.sparse_collate(
+        [
+            backend.SparseTensor(
+                coords=point_cloud[:, :3].int(), feats=point_cloud[:, 3:].float()
+            )
+        ]
+    ).to(device)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    with torch.no_grad():
+        context = encoder(sparse_tensor)["context"]
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return time.perf_counter() - start, context
+
+
+def main():
+    parser = argparse.ArgumentParser("Sparse backend benchmark")
+    parser.add_argument("--num_points", type=int, nargs="+", default=[20_000, 100_000])
+    parser.add_argument("-m", "--model_path", type=str, default=None)
+    parser.add_argument(
+        "-p",
+        "--point_cloud",
+        type=str,
+        default=None,
+        help="A scene to encode instead of synthetic points, requires --model_path",
+    )
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    device = torch.device(args.device)
+
+    encoders = build_encoders(args)
+    if args.point_cloud is not None:
+        from spatiallm import Layout
+        from inference import load_and_preprocess_point_cloud
+
+        point_cloud = load_and_preprocess_point_cloud(
+            args.point_cloud, Layout.get_grid_size(), Layout.get_num_bins()
+        )[0][0]
+        scenes = [(args.point_cloud, point_cloud[0])]
+    else:
+        scenes = [(n, synthetic_points(n)) for n in args.num_points]
+
+    print(
+        f"{'scene':>12} | "
+        + " ".join(f"{b + ' (ms)':>16}" for b in encoders)
+        + " | max abs diff"
+    )
+    for name, point_cloud in scenes:
+        timings, contexts = [], []
+        for encoder in encoders.values():
+            runs = [encode(encoder, point_cloud, device) for _ in range(args.repeat)]
+            timings.append(min(seconds for seconds, _ in runs))
+            contexts.append(runs[0][1])
+        diff = (contexts[0] - contexts[-1]).abs().max().item()
+        print(
+            f"{str(name)[-12:]:>12} | "
+            + " ".join(f"{seconds * 1e3:>16.1f}" for seconds in timings)
+            + f" | {diff:.2e}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Benchmark prompt-lookup speculative decoding against plain greedy decoding of
+the same prefilled prompt, checking that both produce the same layout and
+reporting the draft acceptance rate and decoding speed.
+
+Usage:
+    python benchmarks/speculative_benchmark.py -p scene.ply -m manycore-research/SpatialLM-Llama-1B
+    python benchmarks/speculative_benchmark.py -p scene.ply --num_draft_tokens 5 10 20
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+from transformers import AutoTokenizer, AutoModelForCausalLM
+
+from spatiallm import Layout, PromptCache
+from spatiallm.model.speculative import generate_speculative
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from inference import load_and_preprocess_point_cloud, prepare_input_ids
+
+
+def main():
+    parser = argparse.ArgumentParser("Speculative decoding benchmark")
+    parser.add_argument("-p", "--point_cloud", type=str, required=True)
+    parser.add_argument(
+        "-m", "--model_path", type=str, default="manycore-research/SpatialLM-Llama-1B"
+    )
+    parser.add_argument(
+        "-t", "--code_template_file", type=str, default="code_template.txt"
+    )
+    parser.add_argument("--num_draft_tokens", type=int, nargs="+", default=[10])
+    parser.add_argument("--max_new_tokens", type=int, default=4096)
+    parser.add_argument("--device", type=str, default="cpu")
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model_path)
+    model = AutoModelForCausalLM.from_pretrained(args.model_path).to(args.device)
+    model.set_point_backbone_dtype(torch.float32)
+    model.eval()
+    eos_token_id = model.generation_config.eos_token_id or tokenizer.eos_token_id
+
+    input_pcd = load_and_preprocess_point_cloud(
+        args.point_cloud, Layout.get_grid_size(), Layout.get_num_bins()
+    )[0][0]
+    input_ids = prepare_input_ids(model, tokenizer, args.code_template_file)
+    prompt_cache = PromptCache.prefill(model, input_ids, input_pcd)
+
+    start = time.perf_counter()
+    reference = model.generate(
+        **prompt_cache.generate_kwargs(),
+        max_new_tokens=args.max_new_tokens,
+        do_sample=False,
+        use_cache=True,
+    )[0, len(prompt_cache) :]
+    t_ref = time.perf_counter() - start
+    if isinstance(eos_token_id, int):
+        eos_token_id = [eos_token_id]
+    if reference[-1].item() in eos_token_id:
+        reference = reference[:-1]
+    print(f"greedy: {len(reference)} tokens, {len(reference) / t_ref:.1f} tokens/s")
+
+    print(
+        f"{'drafts':>6} | {'tokens/s':>8} {'speedup':>7} | {'passes':>6}"
+        f" {'accepted':>8} | match"
+    )
+    for num_draft_tokens in args.num_draft_tokens:
+        output, stats = generate_speculative(
+            model,
+            prompt_cache,
+            eos_token_id,
+            max_new_tokens=args.max_new_tokens,
+            do_sample=False,
+            num_draft_tokens=num_draft_tokens,
+        )
+        match = torch.equal(output, reference.cpu())
+        acceptance = stats["num_accepted"] / max(stats["num_drafted"], 1)
+        print(
+            f"{num_draft_tokens:>6} | {stats['num_tokens'] / stats['seconds']:>8.1f}"
+            f" {t_ref / stats['seconds']:>6.2f}x | {stats['num_forward']:>6}"
+            f" {acceptance:>8.1%} | {match}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""
+Benchmark the sort + scatter vox_to_sequence and sparse_uncollate of the point
+encoder against the per-batch-element masking loops they replace, checking that
+both produce identical tensors.
+
+Usage:
+    python benchmarks/vox_to_sequence_benchmark.py --batch_size 1 4 16 --num_voxels 10000 200000
+    python benchmarks/vox_to_sequence_benchmark.py --device cuda --sorted
+"""
+
+import argparse
+import time
+
+import torch
+from torch.nn import functional as F
+
+from spatiallm.model.pcd_encoder import (
+    get_sparse_backend,
+    index_batched_sparse_tensor,
+    sparse_uncollate,
+    vox_to_sequence,
+)
+
+
+def loop_uncollate(sparse_tensor):
+    """One boolean mask over all voxels per batch element."""
+    batch_size = sparse_tensor.C[:, 0].max() + 1
+    return [index_batched_sparse_tensor(sparse_tensor, b) for b in range(batch_size)]
+
+
+def loop_vox_to_sequence(sparse_tensor):
+    """Pad every batch element with transposed F.pad calls."""
+    sparse_tensor_list = loop_uncollate(sparse_tensor)
+    batch_size = len(sparse_tensor_list)
+    channels = sparse_tensor_list[0].F.shape[-1]
+    maxlen = max([x.C.shape[0] for x in sparse_tensor_list])
+    device = sparse_tensor.F.device
+    seq = torch.zeros((batch_size, maxlen, channels), dtype=sparse_tensor.F.dtype)
+    coords = torch.zeros((batch_size, maxlen, 3), dtype=sparse_tensor.C.dtype)
+    mask = torch.ones((batch_size, maxlen), dtype=torch.bool)
+    seq, coords, mask = seq.to(device), coords.to(device), mask.to(device)
+    for i, tensor in enumerate(sparse_tensor_list):
+        num = tensor.C.shape[0]
+        seq[i] = F.pad(tensor.F.T, (0, maxlen - num), value=0).T
+        coords[i] = F.pad(tensor.C.T, (0, maxlen - num), value=0).T
+        mask[i, :num] = False
+    return {"seq": seq, "coords": coords, "mask": mask}
+
+
+def synthetic_batch(batch_size, num_voxels, channels, device, shuffle=True, seed=0):
+    """Voxels of batch_size scenes of varying sizes, interleaved unless not shuffled."""
+    generator = torch.Generator().manual_seed(seed)
+    sizes = torch.randint(
+        num_voxels // 2, num_voxels + 1, (batch_size,), generator=generator
+    )
+    batch_index = torch.repeat_interleave(torch.arange(batch_size), sizes)
+    if shuffle:
+        batch_index = batch_index[torch.randperm(len(batch_index), generator=generator)]
+    coords = torch.randint(0, 80, (len(batch_index), 3), generator=generator)
+    coords = torch.cat([batch_index[:, None], coords], dim=1).int()
+    feats = torch.randn(len(batch_index), channels, generator=generator)
+    return get_sparse_backend().SparseTensor(
+        coords=coords.to(device), feats=feats.to(device)
+    )
+
+
+def best_of(fn, repeat, device):
+    timings = []
+    for _ in range(repeat):
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        output = fn()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        timings.append(time.perf_counter() - start)
+    return min(timings), output
+
+
+def main():
+    parser = argparse.ArgumentParser("vox_to_sequence benchmark")
+    parser.add_argument("--batch_size", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument(
+        "--num_voxels", type=int, nargs="+", default=[10_000, 50_000, 200_000]
+    )
+    parser.add_argument("--channels", type=int, default=1536)
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument(
+        "--sorted",
+        action="store_true",
+        help="Keep the voxels grouped by batch element, as sparse_collate outputs them",
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    device = torch.device(args.device)
+
+    print(
+        f"{'batch':>5} {'voxels':>8} | {'loop (ms)':>9} {'sorted (ms)':>11}"
+        f" {'speedup':>7} | {'uncollate speedup':>17} | match"
+    )
+    for batch_size in args.batch_size:
+        for num_voxels in args.num_voxels:
+            tensor = synthetic_batch(
+                batch_size, num_voxels, args.channels, device, not args.sorted
+            )
+            t_ref, ref = best_of(
+                lambda: loop_vox_to_sequence(tensor), args.repeat, device
+            )
+            t_out, out = best_of(lambda: vox_to_sequence(tensor), args.repeat, device)
+            t_ref_un, ref_un = best_of(
+                lambda: loop_uncollate(tensor), args.repeat, device
+            )
+            t_out_un, out_un = best_of(
+                lambda: sparse_uncollate(tensor), args.repeat, device
+            )
+            match = all(torch.equal(ref[key], out[key]) for key in ref) and all(
+                torch.equal(a.C, b.C) and torch.equal(a.F, b.F)
+                for a, b in zip(ref_un, out_un)
+            )
+            print(
+                f"{batch_size:>5} {num_voxels:>8} | {t_ref * 1e3:>9.2f}"
+                f" {t_out * 1e3:>11.2f} {t_ref / t_out:>6.2f}x |"
+                f" {t_ref_un / t_out_un:>16.2f}x | {match}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,71 @@
 import os
 import glob
+import time
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
 import numpy as np
 from tqdm import tqdm
 from threading import Thread
 from transformers import AutoTokenizer, AutoModelForCausalLM
-from transformers import TextIteratorStreamer
+from transformers import TextIteratorStreamer, LogitsProcessorList
+from transformers import StoppingCriteriaList
 
 from spatiallm import Layout
 from spatiallm import SpatialLMLlamaForCausalLM, SpatialLMQwenForCausalLM
-from spatiallm.pcd import load_o3d_pcd, get_points_and_colors, cleanup_pcd, Compose
+from spatiallm import PointFeatureCache, PromptCache
+from spatiallm.layout.consensus import consensus_layout
+from spatiallm.model.grammar_decoding import (
+    LayoutConstraint,
+    LayoutLogitsProcessor,
+    generate_constrained,
+)
+from spatiallm.model.speculative import generate_speculative
+from spatiallm.model.kv_cache import CACHE_DTYPES, cache_nbytes
+from spatiallm.model.quantization import load_quantized_model
+from spatiallm.model.stopping import LayoutStoppingCriteria, estimate_max_new_tokens
+from spatiallm.layout.merge import merge_tile_layouts
+from spatiallm.layout.stream import StreamingLayoutParser
+from spatiallm.pcd import (
+    load_o3d_pcd,
+    load_ply_pcd,
+    get_points_and_colors,
+    cleanup_pcd,
+    Compose,
+    PointCloudCache,
+    split_into_tiles,
+    fit_cell_budget,
+)
 
 
-def preprocess_point_cloud(points, colors, grid_size, num_bins):
+def load_point_cloud(file_path):
+    # memory-map binary PLY files, fall back to Open3D for any other format
+    try:
+        return load_ply_pcd(file_path)
+    except ValueError:
+        return load_o3d_pcd(file_path)
+
+
+def preprocess_point_cloud(
+    points, colors, grid_size, num_bins, max_point_tokens=None, token_stride=1
+):
+    """Voxelize a point cloud into the input features of the model.
+
+    With max_point_tokens set, a scene that would produce more point tokens is
+    shrunk by the smallest factor meeting the budget, which amounts to a
+    coarser grid. The layout predicted for it must be scaled back by that factor.
+
+    Returns:
+        input_pcd: [1, N, 9] tensor of grid coordinates, coordinates and colors.
+        scale: float, the factor the scene was shrunk by.
+    """
+    scale = 1.0
+    if max_point_tokens is not None:
+        # every point token is one occupied cell of the encoder's output grid
+        scale, _ = fit_cell_budget(points, grid_size * token_stride, max_point_tokens)
+        if scale > 1.0:
+            points = points / np.asarray(scale, dtype=points.dtype)
     transform = Compose(
         [
             dict(type="PositiveShift"),
@@ -30,31 +81,114 @@ def preprocess_point_cloud(points, colors, grid_size, num_bins):
             ),
         ]
     )
+    # the chain runs fused, which leaves the input arrays untouched and returns
+    # the float32 [grid_coord, xyz, rgb] features in a single buffer
     point_cloud = transform(
         {
             "name": "pcd",
-            "coord": points.copy(),
-            "color": colors.copy(),
+            "coord": points,
+            "color": colors,
         }
     )
-    coord = point_cloud["grid_coord"]
-    xyz = point_cloud["coord"]
-    rgb = point_cloud["color"]
-    point_cloud = np.concatenate([coord, xyz, rgb], axis=1)
-    return torch.as_tensor(np.stack([point_cloud], axis=0))
+    if max_point_tokens is not None:
+        num_tokens = len(np.unique(point_cloud["grid_coord"] // token_stride, axis=0))
+        print(
+            f"Grid size {grid_size * scale:.4f} m (scale {scale:.3f}), "
+            f"{num_tokens} point tokens"
+        )
+    return torch.from_numpy(point_cloud["feat"]).unsqueeze(0), scale
 
 
-def generate_layout(
-    model,
-    point_cloud,
-    tokenizer,
-    code_template_file,
-    top_k=10,
-    top_p=0.95,
-    temperature=0.6,
-    num_beams=1,
-    max_new_tokens=4096,
+def load_and_preprocess_point_cloud(
+    point_cloud_file,
+    grid_size,
+    num_bins,
+    voxel_size=0.02,
+    num_nb=3,
+    radius=0.05,
+    cache=None,
+    tile_overlap=None,
+    max_point_tokens=None,
+    token_stride=1,
+    crops=None,
 ):
+    """Load, clean up and voxelize a point cloud file, reusing cached results.
+
+    The cleaned up cloud is first cropped by the crop transform configs in
+    crops. Scenes larger than the normalization world are split into tiles
+    overlapping by tile_overlap meters, unless tile_overlap is None. Every tile
+    is kept within max_point_tokens, see preprocess_point_cloud.
+
+    Returns:
+        List[Tuple[torch.Tensor, np.ndarray, Optional[Tuple], float]], for every
+            tile the [1, N, 9] tensor of grid coordinates, coordinates and colors,
+            the [3] minimum bound of its points, the min and max xy corner of the
+            floor region it owns (None if the scene is not tiled) and the factor
+            it was shrunk by.
+    """
+    if cache is not None:
+        key = cache.key(
+            point_cloud_file,
+            voxel_size=voxel_size,
+            num_nb=num_nb,
+            radius=radius,
+            grid_size=grid_size,
+            num_bins=num_bins,
+            tile_overlap=tile_overlap,
+            max_point_tokens=max_point_tokens,
+            token_stride=token_stride,
+            crops=crops,
+        )
+        features, meta = cache.get(key)
+        if features is not None:
+            input_pcd = torch.from_numpy(np.array(features)[None])
+            return [(input_pcd, meta["min_extent"], None, float(meta["scale"]))]
+
+    point_cloud = load_point_cloud(point_cloud_file)
+    point_cloud = cleanup_pcd(point_cloud, voxel_size, num_nb, radius)
+    points, colors = get_points_and_colors(point_cloud)
+    if crops:
+        # the minimum bound of the cropped points maps the layout back
+        point_cloud = Compose(crops)({"coord": points, "color": colors})
+        points, colors = point_cloud["coord"], point_cloud["color"]
+        if len(points) == 0:
+            raise ValueError(f"No points of {point_cloud_file} are left after cropping")
+
+    tiles = []
+    if tile_overlap is not None:
+        # one voxel less than the world so that no grid coordinate is clipped
+        tile_size = grid_size * (num_bins - 1)
+        tiles = split_into_tiles(points, tile_size, tile_overlap)
+    if len(tiles) > 1:
+        if np.ptp(points[:, 2]) > tile_size:
+            print(f"Warning: {point_cloud_file} is taller than {tile_size} m")
+
+        def preprocess_tile(tile):
+            tile_points = points[tile.index]
+            input_pcd, scale = preprocess_point_cloud(
+                tile_points,
+                colors[tile.index],
+                grid_size,
+                num_bins,
+                max_point_tokens,
+                token_stride,
+            )
+            owned_region = (tile.owned_min, tile.owned_max)
+            return input_pcd, np.min(tile_points, axis=0), owned_region, scale
+
+        with ThreadPoolExecutor() as executor:
+            return list(executor.map(preprocess_tile, tiles))
+
+    min_extent = np.min(points, axis=0)
+    input_pcd, scale = preprocess_point_cloud(
+        points, colors, grid_size, num_bins, max_point_tokens, token_stride
+    )
+    if cache is not None:
+        cache.put(key, input_pcd[0].numpy(), min_extent=min_extent, scale=scale)
+    return [(input_pcd, min_extent, None, scale)]
+
+
+def prepare_input_ids(model, tokenizer, code_template_file):
     # load the code template
     with open(code_template_file, "r") as f:
         code_template = f.read()
@@ -75,15 +209,223 @@ def generate_layout(
     input_ids = tokenizer.apply_chat_template(
         conversation, add_generation_prompt=True, return_tensors="pt"
     )
-    input_ids = input_ids.to(model.device)
+    return input_ids.to(model.device)
+
+
+def report_early_stops(stopping_criteria):
+    # the criteria only record why they stopped a sequence, print it here
+    for criteria in stopping_criteria:
+        if isinstance(criteria, LayoutStoppingCriteria):
+            for i, reason in enumerate(criteria.reasons):
+                if reason is not None:
+                    print(f"Stopped early: {reason} in sequence {i}")
+
+
+def generate_layout(
+    model,
+    point_cloud,
+    tokenizer,
+    code_template_file,
+    top_k=10,
+    top_p=0.95,
+    temperature=0.6,
+    num_beams=1,
+    max_new_tokens=4096,
+    feature_cache=None,
+    prompt_cache=None,
+    constraint=None,
+    num_draft_tokens=0,
+    stop_early=True,
+    on_entity=None,
+    prefill_chunk_size=None,
+    kv_cache_dtype=None,
+):
+    if num_beams > 1 and (constraint is not None or num_draft_tokens > 0):
+        print(
+            "Warning: beam search is not supported with --constrained or --speculative"
+        )
+        num_beams = 1
+    # beams are reordered between steps while the criteria track rows by index
+    stop_early = stop_early and num_beams == 1
+    point_features = None
+    if prompt_cache is None and feature_cache is not None:
+        point_features = feature_cache.encode(model, point_cloud)
+    if prompt_cache is None and (
+        constraint is not None
+        or num_draft_tokens > 0
+        or prefill_chunk_size
+        or kv_cache_dtype is not None
+    ):
+        # constrained and speculative decoding run their own loop from the
+        # prefilled prompt, chunked prefill and compact caches are set up ahead
+        # of generate()
+        input_ids = prepare_input_ids(model, tokenizer, code_template_file)
+        prompt_cache = PromptCache.prefill(
+            model,
+            input_ids,
+            point_cloud,
+            point_features=point_features,
+            chunk_size=prefill_chunk_size,
+        )
+    if prompt_cache is not None:
+        # fork from the prefilled prompt of the scene
+        inputs = prompt_cache.generate_kwargs(num_beams, cache_dtype=kv_cache_dtype)
+    else:
+        input_ids = prepare_input_ids(model, tokenizer, code_template_file)
+        inputs = {"input_ids": input_ids, "point_clouds": point_cloud}
+        if point_features is not None:
+            inputs = {"input_ids": input_ids, "point_features": point_features}
 
     streamer = TextIteratorStreamer(
         tokenizer, timeout=20.0, skip_prompt=True, skip_special_tokens=True
     )
+    stopping_criteria = None
+    if stop_early:
+        stopping_criteria = LayoutStoppingCriteria(
+            tokenizer, inputs["input_ids"].shape[1]
+        )
 
-    generate_kwargs = dict(
-        {"input_ids": input_ids, "point_clouds": point_cloud},
-        streamer=streamer,
+    if constraint is not None:
+        target = generate_constrained
+        generate_kwargs = dict(
+            model=model,
+            prompt_cache=prompt_cache,
+            constraint=constraint,
+            max_new_tokens=max_new_tokens,
+            temperature=temperature,
+            top_p=top_p,
+            top_k=top_k,
+            streamer=streamer,
+            stopping_criteria=stopping_criteria,
+            past_key_values=inputs["past_key_values"],
+        )
+    elif num_draft_tokens > 0:
+        target = generate_speculative
+        generate_kwargs = dict(
+            model=model,
+            prompt_cache=prompt_cache,
+            eos_token_id=model.generation_config.eos_token_id
+            or tokenizer.eos_token_id,
+            max_new_tokens=max_new_tokens,
+            temperature=temperature,
+            top_p=top_p,
+            top_k=top_k,
+            num_draft_tokens=num_draft_tokens,
+            streamer=streamer,
+            stopping_criteria=stopping_criteria,
+            past_key_values=inputs["past_key_values"],
+        )
+    else:
+        target = model.generate
+        generate_kwargs = dict(
+            inputs,
+            streamer=streamer,
+            stopping_criteria=StoppingCriteriaList(
+                [stopping_criteria] if stop_early else []
+            ),
+            max_new_tokens=max_new_tokens,
+            do_sample=True,
+            use_cache=True,
+            temperature=temperature,
+            top_p=top_p,
+            top_k=top_k,
+            num_beams=num_beams,
+        )
+    # the custom decoders return their output ids along with decoding stats
+    outputs = []
+    t = Thread(target=lambda: outputs.append(target(**generate_kwargs)))
+    start_time = time.perf_counter()
+    t.start()
+
+    print("Generating layout...\n")
+    # entities are parsed and unnormalized as their lines complete
+    parser = StreamingLayoutParser(on_entity=on_entity)
+    for text in streamer:
+        parser.feed(text)
+        print(text, end="", flush=True)
+    parser.close()
+    t.join()
+    print("\nDone!")
+    if parser.num_dropped:
+        print(f"Dropped {parser.num_dropped} doors and windows without a wall")
+    if stopping_criteria is not None:
+        report_early_stops([stopping_criteria])
+    if constraint is not None:
+        stats = outputs[0][1]
+        print(f"{stats['num_tokens']} tokens in {stats['num_steps']} decode steps")
+    elif num_draft_tokens > 0:
+        stats = outputs[0][1]
+        print(
+            f"{stats['num_tokens']} tokens in {stats['num_forward']} forward passes, "
+            f"{stats['num_accepted']}/{stats['num_drafted']} draft tokens accepted, "
+            f"{stats['num_tokens'] / stats['seconds']:.1f} tokens/s"
+        )
+    if prompt_cache is not None:
+        past_key_values = inputs["past_key_values"]
+        num_cached = past_key_values.get_seq_length()
+        # the last prompt token is cached along with the new ones
+        num_new_tokens = num_cached - len(prompt_cache) + 1
+        seconds = time.perf_counter() - start_time
+        print(
+            f"KV cache: {num_cached} tokens in "
+            f"{cache_nbytes(past_key_values) / 1024**2:.1f} MB, "
+            f"{num_new_tokens / seconds:.1f} tokens/s"
+        )
+    return parser.layout
+
+
+def generate_layouts(
+    model,
+    point_clouds,
+    tokenizer,
+    code_template_file,
+    top_k=10,
+    top_p=0.95,
+    temperature=0.6,
+    num_beams=1,
+    max_new_tokens=4096,
+    feature_cache=None,
+    constraint=None,
+    stop_early=True,
+):
+    """Generate the layouts of a batch of point clouds with one generate() call.
+
+    The point clouds are encoded together, and the prompts, which get as long as
+    their number of point tokens, are left padded to the longest one.
+
+    Args:
+        point_clouds: List[torch.Tensor], [1, N, 9] tensors of every scene.
+
+    Returns:
+        List[Layout], the layout of every point cloud.
+    """
+    # unpadded, so the point encoder has no nan padding to filter out
+    point_clouds = [point_cloud[0] for point_cloud in point_clouds]
+    input_ids = prepare_input_ids(model, tokenizer, code_template_file)
+    input_ids = input_ids.expand(len(point_clouds), -1)
+    point_features = None
+    if feature_cache is not None:
+        point_features = feature_cache.encode(model, point_clouds)
+    with torch.no_grad():
+        inputs_embeds, attention_mask = model.prepare_point_inputs_for_generation(
+            input_ids, point_clouds, point_features=point_features
+        )
+
+    print(f"Generating {len(point_clouds)} layouts...")
+    logits_processor = LogitsProcessorList()
+    if constraint is not None:
+        # the processor only sees the new tokens when generating from embeddings
+        logits_processor.append(LayoutLogitsProcessor(constraint, 0))
+    stopping_criteria = StoppingCriteriaList()
+    # beams are reordered between steps while the criteria track rows by index
+    if stop_early and num_beams == 1:
+        stopping_criteria.append(LayoutStoppingCriteria(tokenizer, 0))
+    # with inputs_embeds only, generate returns the new tokens only
+    output_ids = model.generate(
+        inputs_embeds=inputs_embeds,
+        attention_mask=attention_mask,
+        logits_processor=logits_processor,
+        stopping_criteria=stopping_criteria,
         max_new_tokens=max_new_tokens,
         do_sample=True,
         use_cache=True,
@@ -91,21 +433,87 @@ def generate_layout(
         top_p=top_p,
         top_k=top_k,
         num_beams=num_beams,
+        pad_token_id=tokenizer.pad_token_id or tokenizer.eos_token_id,
     )
-    t = Thread(target=model.generate, kwargs=generate_kwargs)
-    t.start()
+    print("Done!")
+    report_early_stops(stopping_criteria)
 
-    print("Generating layout...\n")
-    generate_texts = []
-    for text in streamer:
-        generate_texts.append(text)
-        print(text, end="", flush=True)
-    print("\nDone!")
+    layouts = []
+    for layout_str in tokenizer.batch_decode(output_ids, skip_special_tokens=True):
+        layout = Layout(layout_str)
+        layout.undiscretize_and_unnormalize()
+        layouts.append(layout)
+    return layouts
 
-    layout_str = "".join(generate_texts)
-    layout = Layout(layout_str)
-    layout.undiscretize_and_unnormalize()
-    return layout
+
+def sample_layouts(
+    model,
+    point_cloud,
+    tokenizer,
+    code_template_file,
+    num_samples,
+    top_k=10,
+    top_p=0.95,
+    temperature=0.6,
+    max_new_tokens=4096,
+    feature_cache=None,
+    constraint=None,
+    stop_early=True,
+    prefill_chunk_size=None,
+    kv_cache_dtype=None,
+):
+    """Sample several layouts of one point cloud with one generate() call.
+
+    The point cloud is encoded and its prompt prefilled once, every sample forks
+    from the prefilled prompt.
+
+    Returns:
+        List[Layout], num_samples layouts of the point cloud.
+    """
+    input_ids = prepare_input_ids(model, tokenizer, code_template_file)
+    point_features = None
+    if feature_cache is not None:
+        point_features = feature_cache.encode(model, point_cloud)
+    prompt_cache = PromptCache.prefill(
+        model,
+        input_ids,
+        point_cloud,
+        point_features=point_features,
+        chunk_size=prefill_chunk_size,
+    )
+
+    print(f"Sampling {num_samples} layouts...")
+    logits_processor = LogitsProcessorList()
+    if constraint is not None:
+        logits_processor.append(LayoutLogitsProcessor(constraint, len(prompt_cache)))
+    stopping_criteria = StoppingCriteriaList()
+    if stop_early:
+        stopping_criteria.append(LayoutStoppingCriteria(tokenizer, len(prompt_cache)))
+    output_ids = model.generate(
+        **prompt_cache.generate_kwargs(
+            num_return_sequences=num_samples, cache_dtype=kv_cache_dtype
+        ),
+        logits_processor=logits_processor,
+        stopping_criteria=stopping_criteria,
+        max_new_tokens=max_new_tokens,
+        do_sample=True,
+        use_cache=True,
+        temperature=temperature,
+        top_p=top_p,
+        top_k=top_k,
+        num_return_sequences=num_samples,
+        pad_token_id=tokenizer.pad_token_id or tokenizer.eos_token_id,
+    )
+    print("Done!")
+    report_early_stops(stopping_criteria)
+
+    layouts = []
+    output_ids = output_ids[:, len(prompt_cache) :]
+    for layout_str in tokenizer.batch_decode(output_ids, skip_special_tokens=True):
+        layout = Layout(layout_str)
+        layout.undiscretize_and_unnormalize()
+        layouts.append(layout)
+    return layouts
 
 
 if __name__ == "__main__":
@@ -162,7 +570,169 @@ if __name__ == "__main__":
         default=1,
         help="The number of beams for beam search",
     )
+    parser.add_argument(
+        "--constrained",
+        action="store_true",
+        help="Constrain decoding to the layout language and skip over the text it forces",
+    )
+    parser.add_argument(
+        "--speculative",
+        action="store_true",
+        help="Verify draft tokens looked up from the prompt and the generated text in one forward pass",
+    )
+    parser.add_argument(
+        "--num_draft_tokens",
+        type=int,
+        default=10,
+        help="Maximum number of draft tokens verified per forward pass with --speculative",
+    )
+    parser.add_argument(
+        "--quantize",
+        type=str,
+        choices=["int8", "int4"],
+        default=None,
+        help="Quantize the weights of the language model for CPU inference, ignored on GPU",
+    )
+    parser.add_argument(
+        "--sparse_backend",
+        type=str,
+        choices=["torchsparse", "torch"],
+        default=None,
+        help="Sparse convolutions of the point encoder, torch needs no torchsparse build; defaults to torchsparse when installed",
+    )
+    parser.add_argument(
+        "--encoder_autocast",
+        action="store_true",
+        help="Autocast the sparse convolutions of the point encoder to bfloat16 on CPU, ignored on GPU",
+    )
+    parser.add_argument(
+        "--kv_cache_dtype",
+        type=str,
+        choices=list(CACHE_DTYPES),
+        default=None,
+        help="Store the KV cache in reduced precision, int8 with a scale per head and token",
+    )
+    parser.add_argument(
+        "--prefill_chunk_size",
+        type=int,
+        default=None,
+        help="Prefill the prompt in chunks of this many tokens to bound the memory of large scenes, e.g. 512 on CPU-only hosts",
+    )
+    parser.add_argument(
+        "--max_new_tokens",
+        type=int,
+        default=4096,
+        help="The maximum number of tokens generated per scene or tile",
+    )
+    parser.add_argument(
+        "--adaptive_max_new_tokens",
+        action="store_true",
+        help="Size the token budget of every scene or tile from its footprint and voxel count, up to --max_new_tokens",
+    )
+    parser.add_argument(
+        "--no_early_stopping",
+        action="store_true",
+        help="Do not stop generation on repeated entities or lines outside the layout language, early stopping is always off with --num_beams > 1",
+    )
+    parser.add_argument(
+        "--num_samples",
+        type=int,
+        default=1,
+        help="The number of layouts sampled per scene or tile and fused into a consensus layout",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=1,
+        help="The number of scenes or tiles whose layouts are generated in one batch",
+    )
+    parser.add_argument(
+        "--tile_overlap",
+        type=float,
+        default=4.0,
+        help="Overlap in meters of the tiles scenes larger than the normalization world are split into",
+    )
+    parser.add_argument(
+        "--no_tiling",
+        action="store_true",
+        help="Do not split large scenes into tiles, coordinates beyond the normalization world are clipped",
+    )
+    parser.add_argument(
+        "--max_point_tokens",
+        type=int,
+        default=None,
+        help="Maximum number of point tokens per scene or tile, denser scenes are voxelized on a coarser grid",
+    )
+    parser.add_argument(
+        "--crop_box",
+        type=float,
+        nargs=6,
+        default=None,
+        metavar=("X_MIN", "Y_MIN", "Z_MIN", "X_MAX", "Y_MAX", "Z_MAX"),
+        help="Only keep the points inside an axis-aligned box",
+    )
+    parser.add_argument(
+        "--crop_oriented_box",
+        type=float,
+        nargs=7,
+        default=None,
+        metavar=("CX", "CY", "CZ", "SX", "SY", "SZ", "ANGLE"),
+        help="Only keep the points inside a box rotated by ANGLE radians around the z axis",
+    )
+    parser.add_argument(
+        "--crop_polygon",
+        type=float,
+        nargs="+",
+        default=None,
+        metavar="X Y",
+        help="Only keep the points above the floor polygon with these vertices, given as x y pairs, e.g. -1 2 3 4 5 -6",
+    )
+    parser.add_argument(
+        "--crop_height",
+        type=float,
+        nargs=2,
+        default=None,
+        metavar=("Z_MIN", "Z_MAX"),
+        help="Only keep the points between two heights",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default=None,
+        help="Directory to cache preprocessed point clouds in, disabled if not set",
+    )
+    parser.add_argument(
+        "--cache_size",
+        type=float,
+        default=8.0,
+        help="Maximum size of the preprocessed point cloud cache in GB",
+    )
+    parser.add_argument(
+        "--feature_cache_size",
+        type=int,
+        default=0,
+        help="Number of scenes whose encoded point features are kept in memory, disabled if 0",
+    )
+    parser.add_argument(
+        "--feature_cache_dir",
+        type=str,
+        default=None,
+        help="Directory to persist encoded point features in, disabled if not set",
+    )
     args = parser.parse_args()
+    if args.constrained and args.speculative:
+        parser.error("--constrained and --speculative cannot be combined")
+    if args.prefill_chunk_size is not None and args.batch_size > 1:
+        parser.error("--prefill_chunk_size requires --batch_size 1")
+    if args.kv_cache_dtype is not None and args.batch_size > 1:
+        parser.error("--kv_cache_dtype requires --batch_size 1")
+    if args.crop_polygon is not None and (
+        len(args.crop_polygon) % 2 != 0 or len(args.crop_polygon) < 6
+    ):
+        parser.error("--crop_polygon takes x y pairs of at least 3 vertices")
+    kv_cache_dtype = None
+    if args.kv_cache_dtype is not None:
+        kv_cache_dtype = CACHE_DTYPES[args.kv_cache_dtype]
 
     # 메모리 설정 최적화
     torch.cuda.empty_cache()
@@ -172,6 +742,10 @@ if __name__ == "__main__":
         # 메모리 할당자 설정 최적화
         os.environ['PYTORCH_CUDA_ALLOC_CONF'] = 'expandable_segments:True'
 
+    # the point encoder reads the backend when it is built
+    if args.sparse_backend is not None:
+        os.environ["SPATIALLM_SPARSE_BACKEND"] = args.sparse_backend
+
     # load the model
     print(f"Loading model from {args.model_path}...")
     tokenizer = AutoTokenizer.from_pretrained(args.model_path)
@@ -191,51 +765,183 @@ if __name__ == "__main__":
         print(f"Model loaded with device map: {model.hf_device_map if hasattr(model, 'hf_device_map') else 'cuda'}")
     else:
         print("No GPU available, using CPU...")
-        model = AutoModelForCausalLM.from_pretrained(args.model_path)
+        if args.quantize is not None:
+            bits = 8 if args.quantize == "int8" else 4
+            model = load_quantized_model(args.model_path, bits)
+        else:
+            model = AutoModelForCausalLM.from_pretrained(args.model_path)
         model.to("cpu")
     
     # 모델 설정
-    model.set_point_backbone_dtype(torch.float32)
+    autocast_dtype = None
+    if args.encoder_autocast and not torch.cuda.is_available():
+        autocast_dtype = torch.bfloat16
+    model.set_point_backbone_dtype(torch.float32, autocast_dtype=autocast_dtype)
     model.eval()
 
+    crops = []
+    if args.crop_box is not None:
+        crops.append(
+            dict(
+                type="BoxCrop",
+                min_bound=args.crop_box[:3],
+                max_bound=args.crop_box[3:],
+            )
+        )
+    if args.crop_oriented_box is not None:
+        crops.append(
+            dict(
+                type="OrientedBoxCrop",
+                center=args.crop_oriented_box[:3],
+                size=args.crop_oriented_box[3:6],
+                angle=args.crop_oriented_box[6],
+            )
+        )
+    if args.crop_polygon is not None:
+        polygon = [
+            args.crop_polygon[i : i + 2] for i in range(0, len(args.crop_polygon), 2)
+        ]
+        crops.append(dict(type="PolygonCrop", polygon=polygon))
+    if args.crop_height is not None:
+        crops.append(
+            dict(type="HeightCrop", z_min=args.crop_height[0], z_max=args.crop_height[1])
+        )
+
+    cache = None
+    if args.cache_dir is not None:
+        cache = PointCloudCache(args.cache_dir, int(args.cache_size * 1024**3))
+    constraint = None
+    if args.constrained:
+        eos_token_id = model.generation_config.eos_token_id
+        constraint = LayoutConstraint(tokenizer, eos_token_id or tokenizer.eos_token_id)
+
+    feature_cache = None
+    if args.feature_cache_size > 0 or args.feature_cache_dir is not None:
+        feature_cache = PointFeatureCache(
+            args.feature_cache_size, args.feature_cache_dir
+        )
+
     # check if the input is a single point cloud file or a folder containing multiple point cloud files
     if os.path.isfile(args.point_cloud):
         point_cloud_files = [args.point_cloud]
     else:
         point_cloud_files = glob.glob(os.path.join(args.point_cloud, "*.ply"))
 
-    for point_cloud_file in tqdm(point_cloud_files):
-        # load the point cloud
-        point_cloud = load_o3d_pcd(point_cloud_file)
-        point_cloud = cleanup_pcd(point_cloud)
-        points, colors = get_points_and_colors(point_cloud)
-        min_extent = np.min(points, axis=0)
-
-        # preprocess the point cloud to tensor features
-        grid_size = Layout.get_grid_size()
-        num_bins = Layout.get_num_bins()
-        input_pcd = preprocess_point_cloud(points, colors, grid_size, num_bins)
+    grid_size = Layout.get_grid_size()
+    num_bins = Layout.get_num_bins()
+    for batch_start in tqdm(range(0, len(point_cloud_files), args.batch_size)):
+        batch_files = point_cloud_files[batch_start : batch_start + args.batch_size]
+        # load and preprocess the point clouds to tensor features
+        scene_tiles = [
+            load_and_preprocess_point_cloud(
+                point_cloud_file,
+                grid_size,
+                num_bins,
+                cache=cache,
+                tile_overlap=None if args.no_tiling else args.tile_overlap,
+                max_point_tokens=args.max_point_tokens,
+                token_stride=num_bins // model.point_backbone.reduced_grid_size,
+                crops=crops,
+            )
+            for point_cloud_file in batch_files
+        ]
 
-        # generate the layout
-        layout = generate_layout(
-            model,
-            input_pcd,
-            tokenizer,
-            args.code_template_file,
-            args.top_k,
-            args.top_p,
-            args.temperature,
-            args.num_beams,
-        )
-        layout.translate(min_extent)
-        pred_language_string = layout.to_language_string()
-
-        # check if the output path is a file or directory
-        if os.path.splitext(args.output)[-1]:
-            with open(args.output, "w") as f:
-                f.write(pred_language_string)
+        # generate the layout of every tile, batching tiles across scenes
+        input_pcds = [tile[0] for tiles in scene_tiles for tile in tiles]
+        budgets = [args.max_new_tokens] * len(input_pcds)
+        if args.adaptive_max_new_tokens:
+            # budget in meters of the scene, not of the shrunk coordinates
+            budgets = [
+                estimate_max_new_tokens(
+                    tile[0][0, :, 3:6].numpy() * tile[3],
+                    max_tokens=args.max_new_tokens,
+                )
+                for tiles in scene_tiles
+                for tile in tiles
+            ]
+            print(f"Token budgets: {budgets}")
+        if args.num_samples > 1:
+            # the samples of a tile make up the batch
+            layouts = [
+                consensus_layout(
+                    sample_layouts(
+                        model,
+                        input_pcd,
+                        tokenizer,
+                        args.code_template_file,
+                        args.num_samples,
+                        args.top_k,
+                        args.top_p,
+                        args.temperature,
+                        max_new_tokens=budget,
+                        feature_cache=feature_cache,
+                        constraint=constraint,
+                        stop_early=not args.no_early_stopping,
+                        prefill_chunk_size=args.prefill_chunk_size,
+                        kv_cache_dtype=kv_cache_dtype,
+                    )
+                )
+                for input_pcd, budget in zip(input_pcds, budgets)
+            ]
+        elif args.batch_size == 1:
+            layouts = [
+                generate_layout(
+                    model,
+                    input_pcd,
+                    tokenizer,
+                    args.code_template_file,
+                    args.top_k,
+                    args.top_p,
+                    args.temperature,
+                    args.num_beams,
+                    max_new_tokens=budget,
+                    feature_cache=feature_cache,
+                    constraint=constraint,
+                    num_draft_tokens=args.num_draft_tokens if args.speculative else 0,
+                    stop_early=not args.no_early_stopping,
+                    prefill_chunk_size=args.prefill_chunk_size,
+                    kv_cache_dtype=kv_cache_dtype,
+                )
+                for input_pcd, budget in zip(input_pcds, budgets)
+            ]
         else:
-            output_filename = os.path.basename(point_cloud_file).replace(".ply", ".txt")
-            os.makedirs(args.output, exist_ok=True)
-            with open(os.path.join(args.output, output_filename), "w") as f:
-                f.write(pred_language_string)
+            layouts = []
+            for i in range(0, len(input_pcds), args.batch_size):
+                layouts += generate_layouts(
+                    model,
+                    input_pcds[i : i + args.batch_size],
+                    tokenizer,
+                    args.code_template_file,
+                    args.top_k,
+                    args.top_p,
+                    args.temperature,
+                    args.num_beams,
+                    max_new_tokens=max(budgets[i : i + args.batch_size]),
+                    feature_cache=feature_cache,
+                    constraint=constraint,
+                    stop_early=not args.no_early_stopping,
+                )
+
+        for point_cloud_file, tiles in zip(batch_files, scene_tiles):
+            # move the layout of every tile back to the scene
+            tile_layouts = layouts[: len(tiles)]
+            layouts = layouts[len(tiles) :]
+            for layout, (_, min_extent, _, scale) in zip(tile_layouts, tiles):
+                layout.scale(scale)
+                layout.translate(min_extent)
+            layout = tile_layouts[0]
+            if len(tiles) > 1:
+                layout = merge_tile_layouts(tile_layouts, [tile[2] for tile in tiles])
+            pred_language_string = layout.to_language_string()
+
+            # check if the output path is a file or directory
+            if os.path.splitext(args.output)[-1]:
+                with open(args.output, "w") as f:
+                    f.write(pred_language_string)
+            else:
+                output_filename = os.path.basename(point_cloud_file).replace(
+                    ".ply", ".txt"
+                )
+                os.makedirs(args.output, exist_ok=True)
+                with open(os.path.join(args.output, output_filename), "w") as f:
+                    f.write(pred_language_string)
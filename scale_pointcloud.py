@@ -10,7 +10,7 @@ def load_point_cloud(file_path):
     return point_cloud
 
 def get_points_and_colors(point_cloud):
-    points = np.asarray(point_cloud.points)
+    points = np.asarray(point_cloud.points, dtype=np.float32)
     if point_cloud.has_colors():
         colors = np.asarray(point_cloud.colors) * 255.0
     else:
@@ -22,10 +22,8 @@ def scale_point_cloud(point_cloud, target_height=2.5):
     Scale the point cloud to have a specific height (in meters)
     For indoor scenes, walls typically have a height around 2.5 meters
     """
-    points = np.asarray(point_cloud.points)
+    points = np.asarray(point_cloud.points, dtype=np.float32)
     has_colors = point_cloud.has_colors()
-    if has_colors:
-        colors = np.asarray(point_cloud.colors).copy()
     
     # Find the current height (along z-axis)
     min_z = np.min(points[:, 2])
@@ -39,8 +37,8 @@ def scale_point_cloud(point_cloud, target_height=2.5):
     scale_factor = target_height / current_height
     print(f"Scaling factor: {scale_factor}")
     
-    # Scale the points
-    scaled_points = points * scale_factor
+    # Scale the points in float32
+    scaled_points = points * np.float32(scale_factor)
     
     # Create a new point cloud with the scaled points
     scaled_cloud = o3d.geometry.PointCloud()
@@ -48,7 +46,7 @@ def scale_point_cloud(point_cloud, target_height=2.5):
     
     # Copy the original colors
     if has_colors:
-        scaled_cloud.colors = o3d.utility.Vector3dVector(colors)
+        scaled_cloud.colors = point_cloud.colors
     
     return scaled_cloud, scale_factor, current_height
 
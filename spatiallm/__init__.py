@@ -1,6 +1,8 @@
 from .layout.layout import Layout
 from .layout.entity import Wall, Door, Window, Bbox
 from .model.pcd_encoder import PointCloudEncoder
+from .model.feature_cache import PointFeatureCache
+from .model.prompt_cache import PromptCache
 from .model.spatiallm_llama import SpatialLMLlamaForCausalLM, SpatialLMLlamaConfig
 from .model.spatiallm_qwen import SpatialLMQwenForCausalLM, SpatialLMQwenConfig
 
@@ -11,6 +13,8 @@ __all__ = [
     "Window",
     "Bbox",
     "PointCloudEncoder",
+    "PointFeatureCache",
+    "PromptCache",
     "SpatialLMLlamaForCausalLM",
     "SpatialLMLlamaConfig",
     "SpatialLMQwenForCausalLM",
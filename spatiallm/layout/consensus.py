@@ -0,0 +1,209 @@
+"""
+Fuse several layouts sampled for one scene into a consensus layout.
+
+Entities of the samples are clustered by geometric proximity, every cluster
+taking at most one entity of each sample. A cluster found in enough samples is
+kept and its entities are averaged, so an entity is neither lost because a
+single sample missed it nor invented because a single sample hallucinated it.
+"""
+
+import math
+
+import numpy as np
+
+from spatiallm.layout.entity import Wall, Door, Window, Bbox
+from spatiallm.layout.layout import Layout
+
+
+def _wall_ends(wall):
+    return np.array([[wall.ax, wall.ay, wall.az], [wall.bx, wall.by, wall.bz]])
+
+
+def _wall_distance(wall_a, wall_b):
+    """Largest endpoint distance of two walls, which are undirected."""
+    a = _wall_ends(wall_a)
+    b = _wall_ends(wall_b)
+    forward = np.linalg.norm(a - b, axis=1).max()
+    backward = np.linalg.norm(a - b[::-1], axis=1).max()
+    return min(forward, backward)
+
+
+def _fixture_distance(fixture_a, fixture_b):
+    return math.dist(
+        (fixture_a.position_x, fixture_a.position_y, fixture_a.position_z),
+        (fixture_b.position_x, fixture_b.position_y, fixture_b.position_z),
+    )
+
+
+def _bbox_distance(bbox_a, bbox_b):
+    if bbox_a.class_name != bbox_b.class_name:
+        return np.inf
+    return _fixture_distance(bbox_a, bbox_b)
+
+
+def _cluster(samples, distance, tol):
+    """Greedily cluster the entities of every sample.
+
+    Args:
+        samples: List[List[entity]], the entities of every sample.
+        distance: callable, distance between two entities.
+        tol: float, maximum distance of an entity to the first of its cluster.
+
+    Returns:
+        List[List[Tuple[int, entity]]], the sample index and entity of the
+            members of every cluster.
+    """
+    clusters = []
+    for sample_id, entities in enumerate(samples):
+        taken = set()
+        for entity in entities:
+            best, best_distance = None, tol
+            for cluster_id, cluster in enumerate(clusters):
+                if cluster_id in taken:
+                    continue
+                d = distance(cluster[0][1], entity)
+                if d <= best_distance:
+                    best, best_distance = cluster_id, d
+            if best is None:
+                clusters.append([(sample_id, entity)])
+                taken.add(len(clusters) - 1)
+            else:
+                clusters[best].append((sample_id, entity))
+                taken.add(best)
+    return clusters
+
+
+def _average_wall(walls):
+    reference = _wall_ends(walls[0])
+    ends = []
+    for wall in walls:
+        wall_ends = _wall_ends(wall)
+        # orient every wall like the first one before averaging
+        if np.linalg.norm(reference - wall_ends[::-1]) < np.linalg.norm(
+            reference - wall_ends
+        ):
+            wall_ends = wall_ends[::-1]
+        ends.append(wall_ends)
+    (ax, ay, az), (bx, by, bz) = np.mean(ends, axis=0)
+    return Wall(
+        id=0,
+        ax=ax,
+        ay=ay,
+        az=az,
+        bx=bx,
+        by=by,
+        bz=bz,
+        height=np.mean([wall.height for wall in walls]),
+        thickness=np.mean([wall.thickness for wall in walls]),
+    )
+
+
+def _average_bbox(bboxes):
+    reference = bboxes[0].angle_z
+    angles, scales = [], []
+    for bbox in bboxes:
+        # a box is unchanged by a half turn, and by a quarter turn that swaps its
+        # x and y extents, so line every box up with the first one modulo pi / 2
+        quarter_turns = round((bbox.angle_z - reference) / (np.pi / 2))
+        angles.append(bbox.angle_z - quarter_turns * np.pi / 2)
+        if quarter_turns % 2:
+            scales.append((bbox.scale_y, bbox.scale_x))
+        else:
+            scales.append((bbox.scale_x, bbox.scale_y))
+    # the aligned angles are within pi / 4 of the reference, wrap their mean
+    angle = np.mean(angles)
+    scale_x, scale_y = np.mean(scales, axis=0)
+    return Bbox(
+        id=0,
+        class_name=bboxes[0].class_name,
+        position_x=np.mean([bbox.position_x for bbox in bboxes]),
+        position_y=np.mean([bbox.position_y for bbox in bboxes]),
+        position_z=np.mean([bbox.position_z for bbox in bboxes]),
+        angle_z=np.arctan2(np.sin(angle), np.cos(angle)),
+        scale_x=scale_x,
+        scale_y=scale_y,
+        scale_z=np.mean([bbox.scale_z for bbox in bboxes]),
+    )
+
+
+def consensus_layout(
+    layouts,
+    min_votes: int = None,
+    wall_tol: float = 0.3,
+    fixture_tol: float = 0.3,
+    bbox_tol: float = 0.5,
+):
+    """Fuse the layouts sampled for one scene.
+
+    Args:
+        layouts: List[Layout], the sampled layouts in metric coordinates.
+        min_votes: int, number of samples an entity must be found in to be
+            kept, a majority of the samples if None.
+        wall_tol: float, maximum endpoint distance in meters of clustered walls.
+        fixture_tol: float, maximum center distance in meters of clustered doors
+            and windows.
+        bbox_tol: float, maximum center distance in meters of clustered boxes of
+            the same class.
+
+    Returns:
+        Layout with freshly numbered entities.
+    """
+    if min_votes is None:
+        min_votes = len(layouts) // 2 + 1
+
+    def votes(cluster):
+        return len(cluster) >= min_votes
+
+    merged = Layout()
+    wall_clusters = _cluster(
+        [layout.walls for layout in layouts], _wall_distance, wall_tol
+    )
+    # consensus wall of every (sample, wall id)
+    wall_id_map = {}
+    for cluster in filter(votes, wall_clusters):
+        wall = _average_wall([wall for _, wall in cluster])
+        wall.id = len(merged.walls)
+        merged.walls.append(wall)
+        for sample_id, member in cluster:
+            wall_id_map[(sample_id, member.id)] = wall.id
+
+    for fixture_cls, fixtures, sample_fixtures in (
+        (Door, merged.doors, [layout.doors for layout in layouts]),
+        (Window, merged.windows, [layout.windows for layout in layouts]),
+    ):
+        # fixtures on a wall without consensus are dropped
+        samples = [
+            [
+                fixture
+                for fixture in entities
+                if (sample_id, fixture.wall_id) in wall_id_map
+            ]
+            for sample_id, entities in enumerate(sample_fixtures)
+        ]
+        for cluster in filter(votes, _cluster(samples, _fixture_distance, fixture_tol)):
+            # the fixture is attached to the wall most of its members are on
+            wall_ids = [
+                wall_id_map[(sample_id, fixture.wall_id)]
+                for sample_id, fixture in cluster
+            ]
+            members = [fixture for _, fixture in cluster]
+            fixtures.append(
+                fixture_cls(
+                    id=len(fixtures),
+                    wall_id=max(set(wall_ids), key=wall_ids.count),
+                    position_x=np.mean([f.position_x for f in members]),
+                    position_y=np.mean([f.position_y for f in members]),
+                    position_z=np.mean([f.position_z for f in members]),
+                    width=np.mean([f.width for f in members]),
+                    height=np.mean([f.height for f in members]),
+                )
+            )
+
+    bbox_clusters = _cluster(
+        [layout.bboxes for layout in layouts], _bbox_distance, bbox_tol
+    )
+    for cluster in filter(votes, bbox_clusters):
+        bbox = _average_bbox([bbox for _, bbox in cluster])
+        bbox.id = len(merged.bboxes)
+        merged.bboxes.append(bbox)
+    return merged
@@ -0,0 +1,155 @@
+"""
+Character-level state machine of the layout language.
+
+Layouts are written one entity per line, with integer bins as parameters::
+
+    wall_0=Wall(ax,ay,az,bx,by,bz,height,thickness)
+    door_0=Door(wall_0,position_x,position_y,position_z,width,height)
+    window_0=Window(wall_0,position_x,position_y,position_z,width,height)
+    bbox_0=Bbox(class_name,position_x,position_y,position_z,angle_z,scale_x,scale_y,scale_z)
+
+``LayoutGrammar`` accepts exactly the prefixes of such texts, which is what a
+constrained decoder needs to mask the tokens that cannot continue a layout.
+States are hashable tuples, so the allowed tokens of a state can be memoized.
+"""
+
+from spatiallm.layout.entity import NORMALIZATION_PRESET
+
+# placeholders of the entity templates
+ID = "<id>"
+BIN = "<bin>"
+NAME = "<name>"
+PLACEHOLDERS = (ID, BIN, NAME)
+
+DIGITS = "0123456789"
+LOWERCASE = "abcdefghijklmnopqrstuvwxyz"
+# class names are lowercase words joined by underscores, some hyphenated, e.g.
+# floor-standing_lamp or micro-wave_oven
+NAME_CHARS = frozenset(LOWERCASE + DIGITS + "_-")
+
+
+def _fields(*fields):
+    """Fields separated by commas."""
+    items = []
+    for field in fields:
+        items += [field, ","]
+    return items[:-1]
+
+
+TEMPLATES = (
+    ("wall_", ID, "=Wall(", *_fields(*[BIN] * 8), ")"),
+    ("door_", ID, "=Door(wall_", ID, ",", *_fields(*[BIN] * 5), ")"),
+    ("window_", ID, "=Window(wall_", ID, ",", *_fields(*[BIN] * 5), ")"),
+    ("bbox_", ID, "=Bbox(", NAME, ",", *_fields(*[BIN] * 7), ")"),
+)
+
+# every character any layout can contain
+ALPHABET = (
+    frozenset(
+        c
+        for template in TEMPLATES
+        for part in template
+        if part not in PLACEHOLDERS
+        for c in part
+    )
+    | NAME_CHARS
+    | frozenset("\n")
+)
+
+
+class LayoutGrammar(object):
+    """Prefix acceptor of the layout language.
+
+    A state is a tuple of the indices of the templates the current line can
+    still follow, the index of the template part being read and the characters
+    read of that part.
+
+    Args:
+        num_bins: int, number of bins of the integer parameters.
+        max_id_digits: int, maximum number of digits of an entity id.
+        max_name_length: int, maximum length of a box class name, the longest
+            benchmark class, leisure_table_and_chair_combination, has 35.
+    """
+
+    def __init__(
+        self,
+        num_bins: int = NORMALIZATION_PRESET["num_bins"],
+        max_id_digits: int = 4,
+        max_name_length: int = 64,
+    ):
+        self.num_bins = num_bins
+        self.max_id_digits = max_id_digits
+        self.max_name_length = max_name_length
+        self.start = (tuple(range(len(TEMPLATES))), 0, "")
+
+    def _accepts(self, placeholder, value):
+        if placeholder == NAME:
+            return (
+                len(value) <= self.max_name_length
+                and value[0] in LOWERCASE
+                and all(c in NAME_CHARS for c in value)
+            )
+        # integers without leading zeros
+        if not all(c in DIGITS for c in value) or (len(value) > 1 and value[0] == "0"):
+            return False
+        if placeholder == ID:
+            return len(value) <= self.max_id_digits
+        return int(value) < self.num_bins
+
+    def advance(self, state, char: str):
+        """State after reading one character, or None if it is not allowed."""
+        templates, item, value = state
+        template = TEMPLATES[templates[0]]
+        if item == len(template):
+            # the line is complete
+            return self.start if char == "\n" else None
+
+        part = template[item]
+        if part in PLACEHOLDERS:
+            if self._accepts(part, value + char):
+                return (templates, item, value + char)
+            if value:
+                # the placeholder is complete, read the character as the next part
+                return self.advance((templates, item + 1, ""), char)
+            return None
+
+        # only the entity labels differ between templates, and none is a prefix
+        # of another
+        value += char
+        templates = tuple(t for t in templates if TEMPLATES[t][item].startswith(value))
+        if not templates:
+            return None
+        if value == TEMPLATES[templates[0]][item]:
+            return (templates[:1], item + 1, "")
+        return (templates, item, value)
+
+    def advance_text(self, state, text: str):
+        for char in text:
+            if state is None:
+                return None
+            state = self.advance(state, char)
+        return state
+
+    def can_end(self, state):
+        """Whether the layout may end in this state, after a line or before one."""
+        templates, item, value = state
+        return state == self.start or item == len(TEMPLATES[templates[0]])
+
+    def allowed_chars(self, state):
+        return [char for char in sorted(ALPHABET) if self.advance(state, char)]
+
+    def forced_text(self, state):
+        """The text every layout continues with from this state, e.g. "=Wall(".
+
+        Returns:
+            text: str, possibly empty.
+            state: the state after the text.
+        """
+        text = ""
+        while not self.can_end(state):
+            chars = self.allowed_chars(state)
+            if len(chars) != 1:
+                break
+            text += chars[0]
+            state = self.advance(state, chars[0])
+        return text, state
@@ -22,95 +22,92 @@ class Layout:
     def get_num_bins():
         return NORMALIZATION_PRESET["num_bins"]
 
+    @staticmethod
+    def parse_line(line: str):
+        """Entity of one line of a layout string, None if it cannot be parsed.
+
+        Doors and windows are returned whether or not their wall exists.
+        """
+        try:
+            label = line.split("=")[0]
+            entity_id = int(label.split("_")[1])
+            entity_label = label.split("_")[0]
+
+            # extract params
+            start_pos = line.find("(")
+            end_pos = line.find(")")
+            params = line[start_pos + 1 : end_pos].split(",")
+
+            if entity_label == Wall.entity_label:
+                wall_args = [
+                    "ax",
+                    "ay",
+                    "az",
+                    "bx",
+                    "by",
+                    "bz",
+                    "height",
+                    "thickness",
+                ]
+                wall_params = dict(zip(wall_args, params[0:8]))
+                return Wall(id=entity_id, **wall_params)
+            elif entity_label in (Door.entity_label, Window.entity_label):
+                wall_id = int(params[0].split("_")[1])
+                fixture_args = [
+                    "position_x",
+                    "position_y",
+                    "position_z",
+                    "width",
+                    "height",
+                ]
+                fixture_params = dict(zip(fixture_args, params[1:6]))
+                fixture_cls = Door if entity_label == Door.entity_label else Window
+                return fixture_cls(
+                    id=entity_id,
+                    wall_id=wall_id,
+                    **fixture_params,
+                )
+            elif entity_label == Bbox.entity_label:
+                class_name = params[0]
+                bbox_args = [
+                    "position_x",
+                    "position_y",
+                    "position_z",
+                    "angle_z",
+                    "scale_x",
+                    "scale_y",
+                    "scale_z",
+                ]
+                bbox_params = dict(zip(bbox_args, params[1:8]))
+                return Bbox(
+                    id=entity_id,
+                    class_name=class_name,
+                    **bbox_params,
+                )
+        except Exception as e:
+            return None
+        return None
+
     def from_str(self, s: str):
         s = s.lstrip("\n")
         lines = s.split("\n")
         # wall lookup table
         existing_walls = []
         for line in lines:
-            try:
-                label = line.split("=")[0]
-                entity_id = int(label.split("_")[1])
-                entity_label = label.split("_")[0]
-
-                # extract params
-                start_pos = line.find("(")
-                end_pos = line.find(")")
-                params = line[start_pos + 1 : end_pos].split(",")
-
-                if entity_label == Wall.entity_label:
-                    wall_args = [
-                        "ax",
-                        "ay",
-                        "az",
-                        "bx",
-                        "by",
-                        "bz",
-                        "height",
-                        "thickness",
-                    ]
-                    wall_params = dict(zip(wall_args, params[0:8]))
-                    entity = Wall(id=entity_id, **wall_params)
-                    existing_walls.append(entity_id)
-                    self.walls.append(entity)
-                elif entity_label == Door.entity_label:
-                    wall_id = int(params[0].split("_")[1])
-                    if wall_id not in existing_walls:
-                        continue
-
-                    door_args = [
-                        "position_x",
-                        "position_y",
-                        "position_z",
-                        "width",
-                        "height",
-                    ]
-                    door_params = dict(zip(door_args, params[1:6]))
-                    entity = Door(
-                        id=entity_id,
-                        wall_id=wall_id,
-                        **door_params,
-                    )
-                    self.doors.append(entity)
-                elif entity_label == Window.entity_label:
-                    wall_id = int(params[0].split("_")[1])
-                    if wall_id not in existing_walls:
-                        continue
-
-                    window_args = [
-                        "position_x",
-                        "position_y",
-                        "position_z",
-                        "width",
-                        "height",
-                    ]
-                    window_params = dict(zip(window_args, params[1:6]))
-                    entity = Window(
-                        id=entity_id,
-                        wall_id=wall_id,
-                        **window_params,
-                    )
+            entity = self.parse_line(line)
+            if isinstance(entity, Wall):
+                existing_walls.append(entity.id)
+                self.walls.append(entity)
+            elif isinstance(entity, Door):
+                # windows are doors too, doors and windows must follow their wall
+                if entity.wall_id not in existing_walls:
+                    continue
+                if isinstance(entity, Window):
                     self.windows.append(entity)
-                elif entity_label == Bbox.entity_label:
-                    class_name = params[0]
-                    bbox_args = [
-                        "position_x",
-                        "position_y",
-                        "position_z",
-                        "angle_z",
-                        "scale_x",
-                        "scale_y",
-                        "scale_z",
-                    ]
-                    bbox_params = dict(zip(bbox_args, params[1:8]))
-                    entity = Bbox(
-                        id=entity_id,
-                        class_name=class_name,
-                        **bbox_params,
-                    )
-                    self.bboxes.append(entity)
-            except Exception as e:
-                continue
+                else:
+                    self.doors.append(entity)
+            elif isinstance(entity, Bbox):
+                self.bboxes.append(entity)
 
     def to_boxes(self):
         boxes = []
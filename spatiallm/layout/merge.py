@@ -0,0 +1,185 @@
+"""
+Merge the layouts predicted for overlapping tiles of a scene.
+
+Doors, windows and boxes are kept by the tile owning their center. Walls are
+kept by every tile whose owned region they cross, and collinear, overlapping
+walls coming from different tiles are fused into one, so a wall cut by a tile
+border comes out whole.
+"""
+
+import numpy as np
+
+from spatiallm.layout.entity import Wall, Door, Window, Bbox
+from spatiallm.layout.layout import Layout
+
+
+def _point_in_region(x, y, owned_min, owned_max):
+    return owned_min[0] <= x < owned_max[0] and owned_min[1] <= y < owned_max[1]
+
+
+def _segment_crosses_region(a, b, owned_min, owned_max):
+    """Whether the 2D segment ab intersects the region, by Liang-Barsky clipping."""
+    t0, t1 = 0.0, 1.0
+    d = b - a
+    for i in range(2):
+        for p, q in ((-d[i], a[i] - owned_min[i]), (d[i], owned_max[i] - a[i])):
+            if p == 0:
+                if q < 0:
+                    return False
+                continue
+            t = q / p
+            if p < 0:
+                t0 = max(t0, t)
+            else:
+                t1 = min(t1, t)
+            if t0 > t1:
+                return False
+    return True
+
+
+def _walls_collinear(wall_a, wall_b, angle_tol, distance_tol):
+    a0 = np.array([wall_a.ax, wall_a.ay])
+    a1 = np.array([wall_a.bx, wall_a.by])
+    b0 = np.array([wall_b.ax, wall_b.ay])
+    b1 = np.array([wall_b.bx, wall_b.by])
+    length = np.linalg.norm(a1 - a0)
+    if length == 0 or np.linalg.norm(b1 - b0) == 0:
+        return False
+    direction = (a1 - a0) / length
+    other = (b1 - b0) / np.linalg.norm(b1 - b0)
+    # walls are undirected
+    if abs(direction @ other) < np.cos(angle_tol):
+        return False
+    normal = np.array([-direction[1], direction[0]])
+    if max(abs((b0 - a0) @ normal), abs((b1 - a0) @ normal)) > distance_tol:
+        return False
+    # the extents along the wall must overlap or touch
+    lo, hi = sorted(((b0 - a0) @ direction, (b1 - a0) @ direction))
+    return lo <= length + distance_tol and hi >= -distance_tol
+
+
+def _fuse_walls(walls):
+    """Fuse collinear walls into the one spanning all of them."""
+    base = max(walls, key=lambda w: np.hypot(w.bx - w.ax, w.by - w.ay))
+    origin = np.array([base.ax, base.ay])
+    direction = np.array([base.bx - base.ax, base.by - base.ay])
+    direction /= np.linalg.norm(direction)
+    ends = []
+    for wall in walls:
+        for x, y in ((wall.ax, wall.ay), (wall.bx, wall.by)):
+            ends.append((np.array([x, y]) - origin) @ direction)
+    start = origin + min(ends) * direction
+    end = origin + max(ends) * direction
+    return Wall(
+        id=base.id,
+        ax=start[0],
+        ay=start[1],
+        az=min(w.az for w in walls),
+        bx=end[0],
+        by=end[1],
+        bz=min(w.bz for w in walls),
+        height=max(w.height for w in walls),
+        thickness=max(w.thickness for w in walls),
+    )
+
+
+def merge_tile_layouts(
+    layouts,
+    owned_regions,
+    angle_tol: float = np.deg2rad(5.0),
+    distance_tol: float = 0.2,
+):
+    """Merge per-tile layouts, already translated to scene coordinates.
+
+    Args:
+        layouts: List[Layout], the layout of every tile.
+        owned_regions: List[Tuple[np.ndarray, np.ndarray]], the min and max xy
+            corner of the floor region owned by every tile.
+        angle_tol: float, maximum angle in radians between fused walls.
+        distance_tol: float, maximum distance in meters between fused walls.
+
+    Returns:
+        Layout with freshly numbered entities.
+    """
+    walls, wall_tiles, wall_keys = [], [], []
+    for tile_id, (layout, (owned_min, owned_max)) in enumerate(
+        zip(layouts, owned_regions)
+    ):
+        for wall in layout.walls:
+            a = np.array([wall.ax, wall.ay])
+            b = np.array([wall.bx, wall.by])
+            if _segment_crosses_region(a, b, owned_min, owned_max):
+                walls.append(wall)
+                wall_tiles.append(tile_id)
+                wall_keys.append((tile_id, wall.id))
+
+    # union-find over collinear walls of different tiles
+    parent = list(range(len(walls)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i in range(len(walls)):
+        for j in range(i + 1, len(walls)):
+            if wall_tiles[i] != wall_tiles[j] and _walls_collinear(
+                walls[i], walls[j], angle_tol, distance_tol
+            ):
+                parent[find(i)] = find(j)
+
+    groups = {}
+    for i in range(len(walls)):
+        groups.setdefault(find(i), []).append(i)
+
+    merged = Layout()
+    wall_id_map = {}
+    for new_id, members in enumerate(groups.values()):
+        wall = _fuse_walls([walls[i] for i in members])
+        wall.id = new_id
+        merged.walls.append(wall)
+        for i in members:
+            wall_id_map[wall_keys[i]] = new_id
+
+    for tile_id, (layout, (owned_min, owned_max)) in enumerate(
+        zip(layouts, owned_regions)
+    ):
+        for fixture in layout.doors + layout.windows:
+            wall_id = wall_id_map.get((tile_id, fixture.wall_id))
+            if wall_id is None or not _point_in_region(
+                fixture.position_x, fixture.position_y, owned_min, owned_max
+            ):
+                continue
+            fixture_cls = Door if fixture.entity_label == Door.entity_label else Window
+            fixtures = merged.doors if fixture_cls is Door else merged.windows
+            fixtures.append(
+                fixture_cls(
+                    id=len(fixtures),
+                    wall_id=wall_id,
+                    position_x=fixture.position_x,
+                    position_y=fixture.position_y,
+                    position_z=fixture.position_z,
+                    width=fixture.width,
+                    height=fixture.height,
+                )
+            )
+        for bbox in layout.bboxes:
+            if not _point_in_region(
+                bbox.position_x, bbox.position_y, owned_min, owned_max
+            ):
+                continue
+            merged.bboxes.append(
+                Bbox(
+                    id=len(merged.bboxes),
+                    class_name=bbox.class_name,
+                    position_x=bbox.position_x,
+                    position_y=bbox.position_y,
+                    position_z=bbox.position_z,
+                    angle_z=bbox.angle_z,
+                    scale_x=bbox.scale_x,
+                    scale_y=bbox.scale_y,
+                    scale_z=bbox.scale_z,
+                )
+            )
+    return merged
@@ -0,0 +1,98 @@
+"""
+Incremental parsing of a layout while it is being generated.
+
+``StreamingLayoutParser`` is fed the text chunks of a streamer and emits every
+entity, undiscretized and unnormalized, as soon as its line is complete, so
+visualization or storage can run while the model is still decoding. A door or
+window whose wall has not been written yet is held back and emitted right
+after that wall.
+"""
+
+from spatiallm.layout.entity import Wall, Door, Window
+from spatiallm.layout.layout import Layout
+
+
+class StreamingLayoutParser(object):
+    """Parse a layout string chunk by chunk.
+
+    Unlike ``Layout.from_str``, doors and windows written before their wall are
+    kept once the wall appears. Those whose wall never appears are dropped on
+    close and counted in num_dropped.
+
+    Args:
+        on_entity: optional callable, called with every emitted entity.
+        unnormalize: bool, whether to undiscretize and unnormalize the entities
+            before emitting them.
+    """
+
+    def __init__(self, on_entity=None, unnormalize: bool = True):
+        self.on_entity = on_entity
+        self.unnormalize = unnormalize
+        # the emitted entities
+        self.layout = Layout()
+        self.wall_ids = set()
+        # wall id -> doors and windows waiting for that wall
+        self.pending = {}
+        self.num_dropped = 0
+        self.buffer = ""
+
+    def _add(self, entity):
+        if self.unnormalize:
+            entity.undiscretize_and_unnormalize()
+        if isinstance(entity, Wall):
+            self.layout.walls.append(entity)
+        elif isinstance(entity, Window):
+            self.layout.windows.append(entity)
+        elif isinstance(entity, Door):
+            self.layout.doors.append(entity)
+        else:
+            self.layout.bboxes.append(entity)
+        if self.on_entity is not None:
+            self.on_entity(entity)
+        return entity
+
+    def _parse_line(self, line: str):
+        entity = Layout.parse_line(line)
+        if entity is None:
+            return []
+        # windows are doors too
+        if isinstance(entity, Door) and entity.wall_id not in self.wall_ids:
+            self.pending.setdefault(entity.wall_id, []).append(entity)
+            return []
+        entities = [self._add(entity)]
+        if isinstance(entity, Wall):
+            self.wall_ids.add(entity.id)
+            entities += [self._add(e) for e in self.pending.pop(entity.id, [])]
+        return entities
+
+    def feed(self, text: str):
+        """Parse a chunk of text.
+
+        Returns:
+            List of the entities completed by this chunk.
+        """
+        self.buffer += text
+        *lines, self.buffer = self.buffer.split("\n")
+        entities = []
+        for line in lines:
+            entities += self._parse_line(line)
+        return entities
+
+    def close(self):
+        """Parse the last line, which may lack a trailing newline.
+
+        Returns:
+            List of the entities completed by the last line.
+        """
+        entities = self._parse_line(self.buffer)
+        self.buffer = ""
+        self.num_dropped += sum(len(fixtures) for fixtures in self.pending.values())
+        self.pending = {}
+        return entities
+
+    def parse(self, chunks):
+        """Generator of the entities of an iterable of text chunks, e.g. a
+        TextIteratorStreamer, yielded as their lines complete."""
+        for text in chunks:
+            yield from self.feed(text)
+        yield from self.close()
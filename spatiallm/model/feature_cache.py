@@ -0,0 +1,137 @@
+"""
+Cache of the projected point features of scenes.
+
+Sampling several layouts for one scene runs the same sparse convolutions and
+point projection every time. Entries are keyed by the SHA-256 of the point cloud
+tensor together with a hash of the point encoder weights and the settings that
+change its output, so features are never reused across checkpoints, sparse
+backends or autocast dtypes. They are held in memory with LRU eviction and can
+also be persisted to disk as ``.pt`` files.
+"""
+
+import hashlib
+import os
+import tempfile
+from collections import OrderedDict
+
+import torch
+
+from spatiallm.model.pcd_encoder import unpad_point_clouds
+
+
+def hash_tensor(tensor: torch.Tensor):
+    """SHA-256 hex digest of the shape, dtype and contents of a tensor."""
+    tensor = tensor.detach().cpu().contiguous()
+    digest = hashlib.sha256(f"{tuple(tensor.shape)}{tensor.dtype}".encode())
+    # bfloat16 has no numpy counterpart, hash the raw bytes instead
+    digest.update(tensor.view(torch.uint8).numpy().tobytes())
+    return digest.hexdigest()
+
+
+class PointFeatureCache(object):
+    """LRU cache of the output of forward_point_clouds for every point cloud.
+
+    The encoder weights are hashed once per model, they are assumed not to
+    change while the cache is in use.
+
+    Args:
+        max_entries: int, maximum number of scenes held in memory.
+        cache_dir: str, directory to persist the features in, disabled if None.
+    """
+
+    def __init__(self, max_entries: int = 32, cache_dir: str = None):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.entries = OrderedDict()
+        self.encoder_hashes = {}
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def encoder_hash(self, model):
+        """Hash of the point backbone and point projection weights of a model."""
+        if id(model) not in self.encoder_hashes:
+            digest = hashlib.sha256()
+            for module in (model.point_backbone, model.point_proj):
+                for name, tensor in module.state_dict().items():
+                    digest.update(name.encode())
+                    digest.update(hash_tensor(tensor).encode())
+            self.encoder_hashes[id(model)] = digest.hexdigest()
+        return self.encoder_hashes[id(model)]
+
+    def key(self, model, point_cloud: torch.Tensor):
+        digest = hashlib.sha256(hash_tensor(point_cloud).encode())
+        digest.update(self.encoder_hash(model).encode())
+        # not part of the weights, and the autocast dtype can change at any time
+        backbone = model.point_backbone
+        digest.update(
+            f"{backbone.sparse_backend.name}{backbone.autocast_dtype}".encode()
+        )
+        return digest.hexdigest()
+
+    def _path(self, key: str):
+        return os.path.join(self.cache_dir, key + ".pt")
+
+    def get(self, key: str, device=None):
+        """Point features of a cache entry, or None on a miss."""
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        if self.cache_dir is None:
+            return None
+        try:
+            features = torch.load(self._path(key), map_location=device)
+        except FileNotFoundError:
+            return None
+        self._insert(key, features)
+        return features
+
+    def put(self, key: str, features: torch.Tensor):
+        """Store the [n_tokens, hidden_size] point features of a point cloud."""
+        features = features.detach()
+        self._insert(key, features)
+        if self.cache_dir is not None:
+            # write to a temporary file first so readers never see a partial entry
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    torch.save(features.cpu(), f)
+                os.replace(tmp_path, self._path(key))
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+
+    def _insert(self, key: str, features: torch.Tensor):
+        self.entries[key] = features
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    @torch.no_grad()
+    def encode(self, model, point_clouds):
+        """Point features of a batch of point clouds, encoding only the misses.
+
+        Args:
+            model: a SpatialLM model.
+            point_clouds: [B, n_points, n_features] tensor, where rows with nan
+                values are padding, or a list of unpadded [n_points, n_features]
+                tensors.
+
+        Returns:
+            List[torch.Tensor], the [n_tokens, hidden_size] point features of
+                every point cloud, to be passed to generate() as point_features.
+        """
+        device = model.device
+        dtype = model.get_input_embeddings().weight.dtype
+        # padding is dropped so that a scene hashes the same in every batch
+        point_clouds = unpad_point_clouds(point_clouds)
+        keys = [self.key(model, point_cloud) for point_cloud in point_clouds]
+        features = [self.get(key, device) for key in keys]
+        misses = [i for i, feature in enumerate(features) if feature is None]
+        if misses:
+            encoded = model.forward_point_clouds(
+                [point_clouds[i] for i in misses], device, dtype
+            )
+            for i, feature in zip(misses, encoded):
+                self.put(keys[i], feature)
+                features[i] = feature
+        return [feature.to(device=device, dtype=dtype) for feature in features]
@@ -0,0 +1,233 @@
+"""
+Grammar-constrained decoding of layouts.
+
+``LayoutLogitsProcessor`` masks every token that cannot continue a layout, so
+generate() never wastes tokens on lines that ``Layout.from_str`` would drop.
+The allowed tokens of a grammar state are found by walking a trie of the
+vocabulary alongside the grammar, and memoized per state.
+
+``generate_constrained`` additionally jumps forward: the text the grammar
+forces after a sampled token, such as "=Wall(" or a comma after a three-digit
+bin, is appended without sampling and fed to the model in the same forward
+pass as the sampled token.
+"""
+
+import torch
+from transformers import (
+    LogitsProcessor,
+    LogitsProcessorList,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
+
+from spatiallm.layout.grammar import ALPHABET, LayoutGrammar
+
+
+class TokenTrie(object):
+    """Trie of the tokens whose text only uses characters of the alphabet."""
+
+    def __init__(self, tokenizer, alphabet=ALPHABET):
+        self.root = {}
+        self.token_texts = {}
+        texts = tokenizer.batch_decode(
+            [[token_id] for token_id in range(len(tokenizer))]
+        )
+        for token_id, text in enumerate(texts):
+            if not text or any(c not in alphabet for c in text):
+                continue
+            self.token_texts[token_id] = text
+            node = self.root
+            for c in text:
+                node = node.setdefault(c, {})
+            # token ids ending at a node are stored under the None key
+            node.setdefault(None, []).append(token_id)
+
+
+class LayoutConstraint(object):
+    """Token-level view of the layout grammar.
+
+    Args:
+        tokenizer: the tokenizer of the model.
+        eos_token_id: int or List[int], tokens ending a layout.
+        grammar: LayoutGrammar, a default one if None.
+    """
+
+    def __init__(self, tokenizer, eos_token_id, grammar: LayoutGrammar = None):
+        self.tokenizer = tokenizer
+        if isinstance(eos_token_id, int):
+            eos_token_id = [eos_token_id]
+        self.eos_token_id = list(eos_token_id)
+        self.grammar = grammar or LayoutGrammar()
+        self.trie = TokenTrie(tokenizer)
+        self.allowed_cache = {}
+
+    def advance(self, state, token_id: int):
+        """Grammar state after a token, None if it breaks the grammar."""
+        text = self.trie.token_texts.get(token_id)
+        if state is None or text is None:
+            return None
+        return self.grammar.advance_text(state, text)
+
+    def allowed_token_ids(self, state):
+        """LongTensor of the tokens that can follow a grammar state."""
+        if state not in self.allowed_cache:
+            token_ids = []
+            stack = [(self.trie.root, state)]
+            while stack:
+                node, node_state = stack.pop()
+                for char, child in node.items():
+                    if char is None:
+                        continue
+                    child_state = self.grammar.advance(node_state, char)
+                    if child_state is None:
+                        continue
+                    token_ids += child.get(None, [])
+                    stack.append((child, child_state))
+            if self.grammar.can_end(state):
+                token_ids += self.eos_token_id
+            self.allowed_cache[state] = torch.tensor(sorted(token_ids))
+        return self.allowed_cache[state]
+
+    def mask(self, state, scores: torch.FloatTensor):
+        """Scores of a single sequence with the disallowed tokens at -inf."""
+        allowed = self.allowed_token_ids(state).to(scores.device)
+        masked = torch.full_like(scores, -float("inf"))
+        masked[..., allowed] = scores[..., allowed]
+        return masked
+
+
+class LayoutLogitsProcessor(LogitsProcessor):
+    """Logits processor constraining generate() to the layout language.
+
+    Grammar states are kept per generated prefix rather than per row, which
+    stays correct when beam search reorders the rows between steps.
+
+    Args:
+        constraint: LayoutConstraint.
+        prompt_length: int, number of prompt tokens in the input_ids passed to
+            the processor, 0 when generating from inputs_embeds.
+    """
+
+    def __init__(self, constraint: LayoutConstraint, prompt_length: int):
+        self.constraint = constraint
+        self.prompt_length = prompt_length
+        self.states = {}
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor):
+        states = {}
+        for row, token_ids in enumerate(input_ids[:, self.prompt_length :].tolist()):
+            prefix = tuple(token_ids)
+            if not prefix:
+                state = self.constraint.grammar.start
+            elif prefix in states:
+                state = states[prefix]
+            else:
+                state = self.constraint.advance(
+                    self.states.get(prefix[:-1]), prefix[-1]
+                )
+            states[prefix] = state
+            # finished rows are padded with tokens outside the grammar, leave them
+            if state is not None:
+                scores[row] = self.constraint.mask(state, scores[row])
+        self.states = states
+        return scores
+
+
+@torch.no_grad()
+def generate_constrained(
+    model,
+    prompt_cache,
+    constraint: LayoutConstraint,
+    max_new_tokens=4096,
+    do_sample=True,
+    temperature=0.6,
+    top_p=0.95,
+    top_k=10,
+    streamer=None,
+    stopping_criteria=None,
+    past_key_values=None,
+):
+    """Decode one layout from a prefilled prompt with jump-forward.
+
+    Args:
+        model: a SpatialLM model.
+        prompt_cache: PromptCache of the scene prompt.
+        constraint: LayoutConstraint built for the tokenizer of the model.
+        streamer: optional streamer, receiving the prompt and then new tokens.
+        stopping_criteria: optional criteria called with the prompt and the
+            generated ids, see LayoutStoppingCriteria.
+        past_key_values: optional fork of prompt_cache to decode into, e.g. a
+            CompactCache, a new fork if None.
+
+    Returns:
+        output_ids: torch.LongTensor of the generated token ids, forced ones
+            included.
+        stats: Dict[str, int] of the number of tokens and decode steps.
+    """
+    warpers = LogitsProcessorList()
+    if do_sample:
+        warpers += [
+            TemperatureLogitsWarper(temperature),
+            TopKLogitsWarper(top_k),
+            TopPLogitsWarper(top_p),
+        ]
+    grammar = constraint.grammar
+    if past_key_values is None:
+        past_key_values = prompt_cache.fork()
+    input_ids = prompt_cache.input_ids
+    if streamer is not None:
+        streamer.put(input_ids.cpu())
+
+    generated = []
+    state = grammar.start
+    pending = input_ids[:, -1:]
+    num_steps = 0
+    while len(generated) < max_new_tokens:
+        num_cached = past_key_values.get_seq_length()
+        outputs = model(
+            input_ids=pending,
+            attention_mask=torch.ones(
+                (1, num_cached + pending.shape[1]),
+                dtype=input_ids.dtype,
+                device=input_ids.device,
+            ),
+            past_key_values=past_key_values,
+            use_cache=True,
+            num_logits_to_keep=1,
+        )
+        past_key_values = outputs.past_key_values
+        num_steps += 1
+
+        scores = constraint.mask(state, outputs.logits[:, -1, :].float())
+        scores = warpers(input_ids, scores)
+        if do_sample:
+            token_id = torch.multinomial(scores.softmax(dim=-1), 1).item()
+        else:
+            token_id = scores.argmax(dim=-1).item()
+        if token_id in constraint.eos_token_id:
+            break
+        state = constraint.advance(state, token_id)
+
+        # jump forward over the text the grammar forces next
+        forced_text, state = grammar.forced_text(state)
+        forced_ids = []
+        if forced_text:
+            forced_ids = constraint.tokenizer.encode(
+                forced_text, add_special_tokens=False
+            )
+        new_ids = [token_id] + forced_ids
+        generated += new_ids
+        pending = torch.tensor([new_ids], device=input_ids.device)
+        if streamer is not None:
+            streamer.put(pending.cpu())
+        if stopping_criteria is not None:
+            output_ids = torch.tensor([input_ids[0].tolist() + generated])
+            if stopping_criteria(output_ids).all():
+                break
+
+    if streamer is not None:
+        streamer.end()
+    generated = generated[:max_new_tokens]
+    stats = dict(num_tokens=len(generated), num_steps=num_steps)
+    return torch.tensor(generated, dtype=torch.long), stats
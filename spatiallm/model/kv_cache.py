@@ -0,0 +1,139 @@
+"""
+Compact key-value cache for long layout generations.
+
+The cache of a scene grows with its thousands of point tokens and with the
+thousands of layout tokens generated after them. ``CompactCache`` stores the
+keys and values in float16, or in int8 with a scale per head and token, and
+restores the precision of the model one layer at a time as attention reads
+them, so only the compact copy stays resident between decoding steps.
+"""
+
+import torch
+from transformers import DynamicCache
+
+CACHE_DTYPES = {
+    "int8": torch.int8,
+    "float16": torch.float16,
+    "bfloat16": torch.bfloat16,
+}
+
+
+class CompactCache(DynamicCache):
+    """DynamicCache storing its keys and values in reduced precision.
+
+    Args:
+        dtype: torch.dtype of the stored keys and values, torch.int8,
+            torch.float16 or torch.bfloat16.
+    """
+
+    def __init__(self, dtype: torch.dtype = torch.int8):
+        super().__init__()
+        if dtype not in CACHE_DTYPES.values():
+            raise ValueError(f"Unsupported cache dtype: {dtype}")
+        self.dtype = dtype
+        # [B, H, T, 1] scales of the int8 keys and values, None otherwise
+        self.key_scales = []
+        self.value_scales = []
+        self.compute_dtype = None
+
+    def _compress(self, states: torch.Tensor):
+        if self.dtype != torch.int8:
+            return states.to(self.dtype), None
+        # symmetric, one scale per head and token
+        scales = states.abs().amax(dim=-1, keepdim=True).clamp(min=1e-6) / 127
+        return torch.round(states / scales).to(torch.int8), scales.to(torch.float16)
+
+    def _decompress(self, states: torch.Tensor, scales: torch.Tensor):
+        states = states.to(self.compute_dtype)
+        if scales is not None:
+            states = states * scales.to(self.compute_dtype)
+        return states
+
+    def _apply(self, fn):
+        """Apply fn to every stored tensor, e.g. to select or repeat rows."""
+        for caches in (self.key_cache, self.value_cache):
+            caches[:] = [fn(tensor) for tensor in caches]
+        if self.dtype == torch.int8:
+            for scales in (self.key_scales, self.value_scales):
+                scales[:] = [fn(tensor) for tensor in scales]
+
+    def update(self, key_states, value_states, layer_idx, cache_kwargs=None):
+        if layer_idx == 0:
+            self._seen_tokens += key_states.shape[-2]
+        self.compute_dtype = key_states.dtype
+        keys, key_scales = self._compress(key_states)
+        values, value_scales = self._compress(value_states)
+        if len(self.key_cache) <= layer_idx:
+            self.key_cache.append(keys)
+            self.value_cache.append(values)
+            self.key_scales.append(key_scales)
+            self.value_scales.append(value_scales)
+        else:
+            self.key_cache[layer_idx] = torch.cat(
+                (self.key_cache[layer_idx], keys), dim=-2
+            )
+            self.value_cache[layer_idx] = torch.cat(
+                (self.value_cache[layer_idx], values), dim=-2
+            )
+            if self.dtype == torch.int8:
+                self.key_scales[layer_idx] = torch.cat(
+                    (self.key_scales[layer_idx], key_scales), dim=-2
+                )
+                self.value_scales[layer_idx] = torch.cat(
+                    (self.value_scales[layer_idx], value_scales), dim=-2
+                )
+        return self[layer_idx]
+
+    def __getitem__(self, layer_idx: int):
+        if layer_idx >= len(self):
+            raise KeyError(
+                f"Cache only has {len(self)} layers, attempted to access layer with index {layer_idx}"
+            )
+        return (
+            self._decompress(self.key_cache[layer_idx], self.key_scales[layer_idx]),
+            self._decompress(self.value_cache[layer_idx], self.value_scales[layer_idx]),
+        )
+
+    def __iter__(self):
+        for layer_idx in range(len(self)):
+            yield self[layer_idx]
+
+    def to_legacy_cache(self):
+        return tuple(self)
+
+    @classmethod
+    def from_legacy_cache(cls, past_key_values=None, dtype: torch.dtype = torch.int8):
+        cache = cls(dtype)
+        if past_key_values is not None:
+            for layer_idx, (key_states, value_states) in enumerate(past_key_values):
+                cache.update(key_states, value_states, layer_idx)
+        return cache
+
+    def crop(self, max_length: int):
+        if max_length < 0:
+            max_length = self.get_seq_length() - abs(max_length)
+        if self.get_seq_length() <= max_length:
+            return
+        self._seen_tokens = max_length
+        self._apply(lambda tensor: tensor[..., :max_length, :])
+
+    def batch_repeat_interleave(self, repeats: int):
+        self._apply(lambda tensor: tensor.repeat_interleave(repeats, dim=0))
+
+    def batch_select_indices(self, indices: torch.Tensor):
+        self._apply(lambda tensor: tensor[indices, ...])
+
+    def reorder_cache(self, beam_idx: torch.LongTensor):
+        self._apply(lambda tensor: tensor.index_select(0, beam_idx.to(tensor.device)))
+
+
+def cache_nbytes(past_key_values):
+    """Bytes held by a DynamicCache or CompactCache, scales included."""
+    tensors = past_key_values.key_cache + past_key_values.value_cache
+    if isinstance(past_key_values, CompactCache):
+        tensors += past_key_values.key_scales + past_key_values.value_scales
+    return sum(
+        tensor.numel() * tensor.element_size()
+        for tensor in tensors
+        if isinstance(tensor, torch.Tensor)
+    )
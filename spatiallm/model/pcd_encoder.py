@@ -17,13 +17,65 @@ Reference: https://github.com/facebookresearch/scenescript/blob/main/src/network
 }
 """
 
+import os
+from types import SimpleNamespace
+
 import torch
-import torchsparse
-import torchsparse.nn as spnn
 from einops import repeat
 
 from torch import nn
-from torch.nn import functional as F
+
+from spatiallm.model import sparse_conv
+
+try:
+    import torchsparse
+    import torchsparse.nn as spnn
+    from torchsparse.utils.collate import sparse_collate
+except ImportError:
+    torchsparse = None
+
+SPARSE_BACKENDS = ("torchsparse", "torch")
+
+
+def get_sparse_backend(name=None):
+    """The sparse tensor, collate function and layers of a sparse backend.
+
+    Args:
+        name: str, "torchsparse" or "torch" for the pure-PyTorch fallback. If
+            None, the SPATIALLM_SPARSE_BACKEND environment variable, or else
+            torchsparse if it is installed.
+
+    Returns:
+        A namespace with SparseTensor, sparse_collate, Conv3d, GroupNorm and
+            ReLU.
+    """
+    if name is None:
+        name = os.environ.get("SPATIALLM_SPARSE_BACKEND")
+    if name is None:
+        name = "torchsparse" if torchsparse is not None else "torch"
+    if name == "torch":
+        return SimpleNamespace(
+            name=name,
+            SparseTensor=sparse_conv.SparseTensor,
+            sparse_collate=sparse_conv.sparse_collate,
+            Conv3d=sparse_conv.Conv3d,
+            GroupNorm=sparse_conv.GroupNorm,
+            ReLU=sparse_conv.ReLU,
+        )
+    if name == "torchsparse":
+        if torchsparse is None:
+            raise ImportError(
+                "torchsparse is not installed, use the torch sparse backend instead"
+            )
+        return SimpleNamespace(
+            name=name,
+            SparseTensor=torchsparse.SparseTensor,
+            sparse_collate=sparse_collate,
+            Conv3d=spnn.Conv3d,
+            GroupNorm=spnn.GroupNorm,
+            ReLU=spnn.ReLU,
+        )
+    raise ValueError(f"Unknown sparse backend: {name}")
 
 
 def make_conv3d_sparse(
@@ -31,13 +83,14 @@ def make_conv3d_sparse(
     channels_out,
     kernel_size=3,
     num_groups=8,
-    activation=spnn.ReLU,
+    backend=None,
 ):
+    backend = backend or get_sparse_backend()
     num_groups = min(num_groups, channels_out)
     block = nn.Sequential(
-        spnn.Conv3d(channels_in, channels_out, kernel_size=kernel_size, stride=1),
-        spnn.GroupNorm(num_groups, channels_out),
-        activation(inplace=True),
+        backend.Conv3d(channels_in, channels_out, kernel_size=kernel_size, stride=1),
+        backend.GroupNorm(num_groups, channels_out),
+        backend.ReLU(inplace=True),
     )
     return block
 
@@ -46,13 +99,14 @@ def make_conv3d_downscale_sparse(
     channels_in,
     channels_out,
     num_groups=8,
-    activation=spnn.ReLU,
+    backend=None,
 ):
+    backend = backend or get_sparse_backend()
     num_groups = min(num_groups, channels_out)
     block = nn.Sequential(
-        spnn.Conv3d(channels_in, channels_out, kernel_size=2, stride=2),
-        spnn.GroupNorm(num_groups, channels_out),
-        activation(inplace=True),
+        backend.Conv3d(channels_in, channels_out, kernel_size=2, stride=2),
+        backend.GroupNorm(num_groups, channels_out),
+        backend.ReLU(inplace=True),
     )
     return block
 
@@ -62,15 +116,15 @@ class ResBlockSparse(nn.Module):
         self,
         channels,
         num_groups=8,
-        activation=spnn.ReLU,
+        backend=None,
     ):
         super().__init__()
 
         self.block0 = make_conv3d_sparse(
-            channels, channels, num_groups=num_groups, activation=activation
+            channels, channels, num_groups=num_groups, backend=backend
         )
         self.block1 = make_conv3d_sparse(
-            channels, channels, num_groups=num_groups, activation=activation
+            channels, channels, num_groups=num_groups, backend=backend
         )
 
     def forward(self, x):
@@ -84,38 +138,67 @@ def index_batched_sparse_tensor(sparse_tensor, index):
 
     Args:
         sparse_tensor: a torchsparse.SparseTensor that is the output of
-            torchsparse.utils.collate.sparse_collate().
+            torchsparse.utils.collate.sparse_collate(), or its sparse_conv
+            counterpart.
         index: int.
 
     Returns:
-        torchsparse.SparseTensor with no batch dimension.
+        SparseTensor of the same backend with no batch dimension.
     """
     batch_mask = sparse_tensor.C[:, 0] == index
     coords = sparse_tensor.C[batch_mask, 1:]  # Get rid of batch dim
     feats = sparse_tensor.F[batch_mask]
-    return torchsparse.SparseTensor(
+    return type(sparse_tensor)(
         coords=coords,
         feats=feats,
         stride=sparse_tensor.s,
     )
 
 
-def sparse_uncollate(sparse_tensor):
-    """Un-Collate a batched torchsparse.SparseTensor.
+def sort_by_batch(sparse_tensor):
+    """Order the voxels of a batched torchsparse.SparseTensor by batch index.
+
+    The sort is stable, so the voxels of every batch element keep their order, and
+    it is skipped if the voxels are already ordered, e.g. right after collation.
 
     Args:
         sparse_tensor: a torchsparse.SparseTensor that is the output of
             torchsparse.utils.collate.sparse_collate().
 
     Returns:
-        List[torchsparse.SparseTensor].
+        batch_index: [N] torch.LongTensor, sorted batch index of every voxel.
+        order: [N] torch.LongTensor permutation sorting the voxels, or a full
+            slice if they are already sorted.
+        counts: [B] torch.LongTensor, number of voxels of every batch element.
     """
-    batch_size = sparse_tensor.C[:, 0].max() + 1
+    batch_index = sparse_tensor.C[:, 0].long()
+    if torch.all(batch_index[1:] >= batch_index[:-1]):
+        order = slice(None)
+    else:
+        batch_index, order = torch.sort(batch_index, stable=True)
+    counts = torch.bincount(batch_index)
+    return batch_index, order, counts
+
+
+def sparse_uncollate(sparse_tensor):
+    """Un-Collate a batched torchsparse.SparseTensor.
+
+    Args:
+        sparse_tensor: a torchsparse.SparseTensor that is the output of
+            torchsparse.utils.collate.sparse_collate(), or its sparse_conv
+            counterpart.
 
-    sparse_tensor_list = []
-    for b in range(batch_size):
-        sparse_tensor_list.append(index_batched_sparse_tensor(sparse_tensor, b))
-    return sparse_tensor_list
+    Returns:
+        List of SparseTensors of the same backend.
+    """
+    _, order, counts = sort_by_batch(sparse_tensor)
+    counts = counts.tolist()
+    coords = sparse_tensor.C[order, 1:].split(counts)  # Get rid of batch dim
+    feats = sparse_tensor.F[order].split(counts)
+    return [
+        type(sparse_tensor)(coords=coords_i, feats=feats_i, stride=sparse_tensor.s)
+        for coords_i, feats_i in zip(coords, feats)
+    ]
 
 
 def vox_to_sequence(sparse_tensor):
@@ -130,47 +213,35 @@ def vox_to_sequence(sparse_tensor):
             coords: [B, maxlen, 3] torch.IntTensor. To be used with embeddings for Transformers.
             mask: [B, maxlen] torch.BoolTensor. To be used with Transformers.
     """
-    sparse_tensor_list = sparse_uncollate(sparse_tensor)
-    batch_size = len(sparse_tensor_list)
-    channels = sparse_tensor_list[0].F.shape[-1]
-    maxlen = max([x.C.shape[0] for x in sparse_tensor_list])
+    batch_index, order, counts = sort_by_batch(sparse_tensor)
+    batch_size = counts.shape[0]
+    channels = sparse_tensor.F.shape[-1]
+    maxlen = counts.max().item()
+
+    # position of every sorted voxel within its batch element
+    starts = torch.cumsum(counts, dim=0) - counts
+    position = (
+        torch.arange(batch_index.shape[0], device=batch_index.device)
+        - starts[batch_index]
+    )
 
     seq = torch.zeros(
         (batch_size, maxlen, channels),
         dtype=sparse_tensor.F.dtype,
         device=sparse_tensor.F.device,
     )
+    seq[batch_index, position] = sparse_tensor.F[order]
+
+    # Get coords (divided by stride, so its in {0, 1, ...})
     coords = torch.zeros(
         (batch_size, maxlen, 3),
         dtype=sparse_tensor.C.dtype,
         device=sparse_tensor.C.device,
     )
-    mask = torch.ones(
-        (batch_size, maxlen),
-        dtype=torch.bool,
-        device=sparse_tensor.F.device,
-    )
-    for i in range(batch_size):
-        sparse_tensor = sparse_tensor_list[i]
-
-        # Get coords (divided by stride, so its in {0, 1, ...})
-        coords_i = sparse_tensor.C  # [N_points_i, 3]
-        coords_num = coords_i.shape[0]
-        assert coords_num <= maxlen, f"coords_num: {coords_num} is too high..."
-
-        # Get features
-        feats = sparse_tensor.F  # [N_points_i, C]
-
-        # Pad and save
-        pad = maxlen - coords_num
-
-        feats = F.pad(feats.T, (0, pad), value=0).T  # [maxlen, C]
-        seq[i] = feats
+    coords[batch_index, position] = sparse_tensor.C[order, 1:]
 
-        coords_i = F.pad(coords_i.T, (0, pad), value=0).T  # [maxlen, 3]
-        coords[i] = coords_i
-
-        mask[i, :coords_num] = False
+    mask = torch.arange(maxlen, device=counts.device)[None] >= counts[:, None]
+    mask = mask.to(sparse_tensor.F.device)
 
     return {
         "seq": seq,
@@ -200,13 +271,36 @@ def fourier_encode_vector(vec, num_bands=10, sample_rate=60):
     return encoding.flatten(2)
 
 
+def unpad_point_clouds(point_clouds):
+    """Drop the nan rows a batch of point clouds is padded with.
+
+    Args:
+        point_clouds: [B, n_points, n_features] tensor, where rows with nan
+            values are padding, or a list of unpadded [n_points, n_features]
+            tensors, which is returned as is.
+
+    Returns:
+        List of [n_points, n_features] tensors.
+    """
+    if not isinstance(point_clouds, torch.Tensor):
+        return list(point_clouds)
+    if point_clouds.shape[0] == 1:
+        # a single point cloud is never padded
+        return [point_clouds[0]]
+    return [
+        point_cloud[~torch.isnan(point_cloud).any(dim=1)]
+        for point_cloud in point_clouds
+    ]
+
+
 class ResNet3DSparse(nn.Module):
-    def __init__(self, dim_in, dim_out, layers):
+    def __init__(self, dim_in, dim_out, layers, backend=None):
         super().__init__()
+        backend = backend or get_sparse_backend()
 
         self.stem = nn.Sequential(
-            make_conv3d_sparse(dim_in, layers[0], kernel_size=7),
-            ResBlockSparse(layers[0]),
+            make_conv3d_sparse(dim_in, layers[0], kernel_size=7, backend=backend),
+            ResBlockSparse(layers[0], backend=backend),
         )
 
         # Number of down-convs is len(layers) - 1
@@ -214,9 +308,11 @@ class ResNet3DSparse(nn.Module):
         for i in range(len(layers) - 1):
             blocks.append(
                 nn.Sequential(
-                    make_conv3d_downscale_sparse(layers[i], layers[i + 1]),
-                    ResBlockSparse(layers[i + 1]),
-                    ResBlockSparse(layers[i + 1]),
+                    make_conv3d_downscale_sparse(
+                        layers[i], layers[i + 1], backend=backend
+                    ),
+                    ResBlockSparse(layers[i + 1], backend=backend),
+                    ResBlockSparse(layers[i + 1], backend=backend),
                 )
             )
         self.blocks = nn.Sequential(*blocks)
@@ -242,6 +338,7 @@ class PointCloudEncoder(nn.Module):
         d_model,
         conv_layers,
         num_bins,
+        sparse_backend=None,
     ):
         """Point Cloud Encoder.
 
@@ -250,14 +347,18 @@ class PointCloudEncoder(nn.Module):
             d_model: int.
             conv_layers: List[int].
             num_bins: int.
+            sparse_backend: str, see get_sparse_backend. Both backends load the
+                same weights.
         """
 
         super().__init__()
 
+        self.sparse_backend = get_sparse_backend(sparse_backend)
         self.sparse_resnet = ResNet3DSparse(
             dim_in=input_channels,
             dim_out=d_model,
             layers=conv_layers,
+            backend=self.sparse_backend,
         )
         downconvs = len(conv_layers) - 1
         res_reduction = 2**downconvs  # voxel resolution reduction
@@ -267,25 +368,55 @@ class PointCloudEncoder(nn.Module):
         # the following is a legacy parameter
         self.extra_embedding = nn.Parameter(torch.empty(d_model).normal_(std=0.02))
 
-    def forward(self, point_cloud: torchsparse.SparseTensor):
+        # dtype the sparse ResNet autocasts to, e.g. torch.bfloat16 on CPU
+        self.autocast_dtype = None
+        # [reduced_grid_size, 21] Fourier encoding of every coordinate of an axis
+        self.fourier_table = None
+
+    def encode_coords(self, coords):
+        """Fourier encode the [B, N, 3] coordinates of the reduced grid.
+
+        Coordinates are integers of a small grid, so the encoding of every axis
+        is looked up in a table computed once instead of recomputing sin and cos
+        for every voxel. Coordinates outside the grid fall back to
+        fourier_encode_vector.
+        """
+        size = self.reduced_grid_size
+        if coords.numel() > 0 and ((coords < 0) | (coords >= size)).any():
+            return fourier_encode_vector(coords / (size - 1))
+        if self.fourier_table is None or self.fourier_table.device != coords.device:
+            positions = torch.arange(size, device=coords.device)
+            self.fourier_table = fourier_encode_vector(
+                positions[None, :, None] / (size - 1)
+            )[0]
+        # [B, N, 3, 21] -> [B, N, 21 * 3], the layout of fourier_encode_vector
+        encoding = self.fourier_table[coords.long()]
+        return encoding.transpose(2, 3).flatten(2)
+
+    def forward(self, point_cloud):
         """Forward function.
 
         Args:
-            point_cloud: torchsparse.SparseTensor.
+            point_cloud: SparseTensor of the sparse backend of the encoder.
 
         Returns: a Dict with the following keys:
             context: [B, maxlen, d_model] torch.FloatTensor.
             context_mask: [B, maxlen] torch.BoolTensor. True means ignore.
         """
-        outputs = self.sparse_resnet(point_cloud)
+        dtype = point_cloud.F.dtype
+        with torch.autocast(
+            point_cloud.F.device.type,
+            dtype=self.autocast_dtype or torch.bfloat16,
+            enabled=self.autocast_dtype is not None,
+        ):
+            outputs = self.sparse_resnet(point_cloud)
+        outputs.F = outputs.F.to(dtype)
         outputs = vox_to_sequence(outputs)
 
         context = outputs["seq"]
         context_mask = outputs["mask"]
 
-        coords = outputs["coords"]
-        coords_normalised = coords / (self.reduced_grid_size - 1)
-        encoded_coords = fourier_encode_vector(coords_normalised)
+        encoded_coords = self.encode_coords(outputs["coords"])
 
         context = torch.cat([context, encoded_coords], dim=-1)
         context = self.input_proj(context)
@@ -0,0 +1,146 @@
+"""
+Reusable prefill of the scene prompt.
+
+The prompt of a scene, chat template, point tokens and code template included,
+is the same for every layout sampled from it, and prefilling its thousands of
+point tokens dominates the latency on CPU. ``PromptCache`` prefills the prompt
+once and snapshots the keys and values, which later generate() calls fork from
+with any sampling settings. Snapshots can be saved to disk and loaded back.
+
+The prompt can also be prefilled in chunks of a fixed number of tokens, which
+bounds the activation and attention memory of large scenes by the chunk size
+instead of the prompt length, at the cost of some speed.
+"""
+
+import torch
+from transformers import DynamicCache
+
+from spatiallm.model.kv_cache import CompactCache
+
+
+class PromptCache(object):
+    """Keys and values of a prefilled scene prompt.
+
+    The snapshot covers every prompt token but the last one, which generate()
+    feeds to produce the first new token. Forking only copies the per-layer
+    lists, the cached tensors are shared since generate() concatenates new keys
+    and values instead of writing into them.
+
+    Args:
+        input_ids: [1, L] prompt ids with one point token per point feature.
+        past_key_values: Tuple[Tuple[torch.Tensor, torch.Tensor]], the legacy
+            format keys and values of input_ids[:, :-1] for every layer.
+    """
+
+    def __init__(self, input_ids: torch.LongTensor, past_key_values):
+        self.input_ids = input_ids
+        self.past_key_values = past_key_values
+
+    def __len__(self):
+        return self.input_ids.shape[1]
+
+    @classmethod
+    @torch.no_grad()
+    def prefill(
+        cls,
+        model,
+        input_ids,
+        point_clouds=None,
+        point_features=None,
+        chunk_size: int = None,
+    ):
+        """Prefill the prompt of a single scene.
+
+        Args:
+            model: a SpatialLM model.
+            input_ids: [1, L] prompt ids with one point pad token.
+            point_clouds: [1, n_points, n_features] tensor of the scene.
+            point_features: List[torch.Tensor], precomputed point features used
+                in place of point_clouds, see PointFeatureCache.
+            chunk_size: int, number of prompt tokens fed to the decoder per
+                forward pass, the whole prompt at once if None.
+
+        Returns:
+            PromptCache.
+        """
+        assert input_ids.shape[0] == 1, "Only a single prompt can be prefilled"
+        inputs_embeds, _ = model.prepare_point_inputs_for_generation(
+            input_ids, point_clouds, point_features=point_features
+        )
+        # expand the point pad token to one placeholder per point token, their
+        # ids are never embedded since generate() only feeds the last prompt token
+        num_point_tokens = inputs_embeds.shape[1] - input_ids.shape[1] + 1
+        point_pos = torch.where(input_ids[0] == model.config.point_start_token_id)[0]
+        point_pos = point_pos[0].item() + 1
+        input_ids = torch.cat(
+            (
+                input_ids[:, :point_pos],
+                input_ids.new_full((1, num_point_tokens), model.config.point_token_id),
+                input_ids[:, point_pos + 1 :],
+            ),
+            dim=1,
+        )
+
+        # the decoder only returns hidden states, the logits of the prompt are
+        # never computed
+        inputs_embeds = inputs_embeds[:, :-1]
+        chunk_size = chunk_size or inputs_embeds.shape[1]
+        past_key_values = DynamicCache()
+        for start in range(0, inputs_embeds.shape[1], chunk_size):
+            # positions continue from the cached length
+            model.model(
+                inputs_embeds=inputs_embeds[:, start : start + chunk_size],
+                past_key_values=past_key_values,
+                use_cache=True,
+            )
+        return cls(input_ids, past_key_values.to_legacy_cache())
+
+    def fork(self, batch_size: int = 1, cache_dtype: torch.dtype = None):
+        """A cache to generate from, repeated batch_size times.
+
+        With a cache_dtype, the fork is a CompactCache holding its own reduced
+        precision copy of the prompt.
+        """
+        if cache_dtype is not None:
+            past_key_values = CompactCache.from_legacy_cache(
+                self.past_key_values, cache_dtype
+            )
+        else:
+            past_key_values = DynamicCache.from_legacy_cache(self.past_key_values)
+        if batch_size > 1:
+            past_key_values.batch_repeat_interleave(batch_size)
+        return past_key_values
+
+    def generate_kwargs(
+        self,
+        num_beams: int = 1,
+        num_return_sequences: int = 1,
+        cache_dtype: torch.dtype = None,
+    ):
+        """Inputs of generate() continuing from the prompt.
+
+        The cache is repeated the way generate() expands input_ids for the same
+        num_beams and num_return_sequences, which must be passed along.
+        """
+        expand_size = num_beams if num_beams > 1 else num_return_sequences
+        return {
+            "input_ids": self.input_ids,
+            "attention_mask": torch.ones_like(self.input_ids),
+            "past_key_values": self.fork(expand_size, cache_dtype),
+        }
+
+    def save(self, file_path: str):
+        torch.save(
+            {
+                "input_ids": self.input_ids.cpu(),
+                "past_key_values": [
+                    (key.cpu(), value.cpu()) for key, value in self.past_key_values
+                ],
+            },
+            file_path,
+        )
+
+    @classmethod
+    def load(cls, file_path: str, device=None):
+        state = torch.load(file_path, map_location=device)
+        return cls(state["input_ids"], tuple(map(tuple, state["past_key_values"])))
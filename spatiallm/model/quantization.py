@@ -0,0 +1,195 @@
+"""
+Weight-only quantization of the language model for CPU inference.
+
+Decoding a layout is bound by reading the weights of the decoder and of the
+lm_head at every step. ``quantize_model`` replaces those linear layers with
+``QuantizedLinear`` layers holding int8 weights with one scale per output
+channel, or int4 weights with a scale and zero point per group of input
+channels, which are multiplied with the activations by the fused CPU kernels
+of PyTorch when available. Those kernels run in bfloat16, a few times faster
+than a float32 matmul when decoding one token at a time. The checkpoint is
+loaded in float32 and the point backbone, projector, embeddings and norms are
+left untouched, so the point cloud is still encoded in float32.
+"""
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from transformers import AutoModelForCausalLM
+from transformers.utils import logging
+
+HAS_INT8_KERNEL = hasattr(torch, "_weight_int8pack_mm")
+logger = logging.get_logger(__name__)
+
+
+class QuantizedLinear(nn.Module):
+    """Linear layer with weight-only int8 or int4 quantized weights.
+
+    Args:
+        in_features: int, size of the input features.
+        out_features: int, size of the output features.
+        bits: int, 8 or 4.
+        group_size: int, number of input channels sharing a scale with int4.
+        bias: bool, whether the layer has a bias.
+    """
+
+    def __init__(
+        self,
+        in_features: int,
+        out_features: int,
+        bits: int = 8,
+        group_size: int = 128,
+        bias: bool = False,
+    ):
+        super().__init__()
+        if bits not in (8, 4):
+            raise ValueError(f"Unsupported number of bits: {bits}")
+        self.in_features = in_features
+        self.out_features = out_features
+        self.bits = bits
+        self.group_size = group_size
+        # whether the int4 weight is packed for torch._weight_int4pack_mm_for_cpu
+        self.cpu_packed = False
+        self.register_buffer("weight", None)
+        self.register_buffer("scales", None)
+        self.register_buffer("bias", None)
+
+    @classmethod
+    @torch.no_grad()
+    def from_linear(cls, linear: nn.Linear, bits: int = 8, group_size: int = 128):
+        layer = cls(
+            linear.in_features,
+            linear.out_features,
+            bits=bits,
+            group_size=group_size,
+            bias=linear.bias is not None,
+        )
+        weight = linear.weight.float()
+        if bits == 8:
+            # symmetric, one scale per output channel
+            scales = weight.abs().amax(dim=1).clamp(min=1e-8) / 127
+            layer.weight = torch.round(weight / scales[:, None]).to(torch.int8)
+            layer.scales = scales.to(linear.weight.dtype)
+        else:
+            # asymmetric, one scale and minimum per group of input channels
+            n, k = weight.shape
+            groups = weight.reshape(n, k // group_size, group_size)
+            minimum = groups.amin(dim=-1, keepdim=True)
+            scales = (groups.amax(dim=-1, keepdim=True) - minimum).clamp(min=1e-8) / 15
+            q = torch.clamp(torch.round((groups - minimum) / scales), 0, 15)
+            q = q.reshape(n, k).to(torch.int32)
+            # [k // group_size, n, 2] scales and zero points, with w = (q - 8) * s + z
+            layer.scales = (
+                torch.stack((scales, minimum + 8 * scales), dim=-1)
+                .reshape(n, k // group_size, 2)
+                .transpose(0, 1)
+                .contiguous()
+                .to(linear.weight.dtype)
+            )
+            layer.cpu_packed = (
+                hasattr(torch, "_convert_weight_to_int4pack_for_cpu")
+                and weight.device.type == "cpu"
+                and n % 16 == 0
+            )
+            if layer.cpu_packed:
+                layer.weight = torch._convert_weight_to_int4pack_for_cpu(q, 1)
+            else:
+                # two weights per byte, the even input channel in the low nibble
+                layer.weight = (q[:, ::2] | (q[:, 1::2] << 4)).to(torch.uint8)
+        if linear.bias is not None:
+            layer.bias = linear.bias.detach().clone()
+        return layer
+
+    def dequantize(self, dtype: torch.dtype = torch.float32):
+        """The float weight, for devices without a fused kernel."""
+        if self.bits == 8:
+            return self.weight.to(dtype) * self.scales.to(dtype)[:, None]
+        if self.cpu_packed:
+            # the packed layout is private to the kernel, multiply the identity
+            eye = torch.eye(self.in_features, dtype=dtype, device=self.weight.device)
+            return torch._weight_int4pack_mm_for_cpu(
+                eye, self.weight, self.group_size, self.scales.to(dtype)
+            ).t()
+        q = torch.stack((self.weight & 15, self.weight >> 4), dim=-1)
+        q = q.reshape(self.out_features, -1, self.group_size).to(dtype)
+        scales, zeros = self.scales.to(dtype).transpose(0, 1).unbind(dim=-1)
+        weight = (q - 8) * scales[..., None] + zeros[..., None]
+        return weight.reshape(self.out_features, self.in_features)
+
+    def forward(self, x: torch.Tensor):
+        shape = x.shape
+        x = x.reshape(-1, self.in_features).contiguous()
+        if x.device.type == "cpu" and self.bits == 8 and HAS_INT8_KERNEL:
+            # the fused kernels are only vectorized for bfloat16 activations
+            out = torch._weight_int8pack_mm(
+                x.to(torch.bfloat16), self.weight, self.scales.to(torch.bfloat16)
+            ).to(x.dtype)
+        elif x.device.type == "cpu" and self.cpu_packed:
+            out = torch._weight_int4pack_mm_for_cpu(
+                x.to(torch.bfloat16),
+                self.weight,
+                self.group_size,
+                self.scales.to(torch.bfloat16),
+            ).to(x.dtype)
+        else:
+            out = F.linear(x, self.dequantize(x.dtype))
+        if self.bias is not None:
+            out = out + self.bias.to(out.dtype)
+        return out.reshape(*shape[:-1], self.out_features)
+
+    def extra_repr(self):
+        return (
+            f"in_features={self.in_features}, out_features={self.out_features}, "
+            f"bits={self.bits}, group_size={self.group_size}"
+        )
+
+
+def quantize_model(model, bits: int = 8, group_size: int = 128):
+    """Quantize the linear layers of the decoder and the lm_head in place.
+
+    Layers whose input size is not a multiple of group_size stay in float with
+    int4. The point backbone and projector are never quantized.
+
+    Args:
+        model: a SpatialLM model.
+        bits: int, 8 or 4.
+        group_size: int, number of input channels sharing a scale with int4.
+
+    Returns:
+        int, the number of quantized layers.
+    """
+    targets = [(model, "lm_head")]
+    for name, module in model.model.named_modules():
+        for child_name, child in module.named_children():
+            if isinstance(child, nn.Linear):
+                targets.append((module, child_name))
+
+    num_quantized = 0
+    # look every layer up when it is replaced, so that no reference keeps the
+    # float weights of the layers already quantized alive
+    for parent, name in targets:
+        linear = getattr(parent, name)
+        if bits == 4 and linear.in_features % group_size != 0:
+            continue
+        setattr(parent, name, QuantizedLinear.from_linear(linear, bits, group_size))
+        del linear
+        num_quantized += 1
+    # the lm_head is no longer the transposed input embeddings
+    model.config.tie_word_embeddings = False
+    return num_quantized
+
+
+def load_quantized_model(model_path: str, bits: int = 8, group_size: int = 128):
+    """Load a SpatialLM checkpoint on CPU with its language model quantized.
+
+    The checkpoint is loaded in float32, so the layers that are not quantized
+    keep their full precision. quantize_model replaces the linear layers one at
+    a time, so every float32 weight is freed as soon as it is quantized.
+
+    Returns:
+        The quantized model.
+    """
+    model = AutoModelForCausalLM.from_pretrained(model_path, torch_dtype=torch.float32)
+    num_quantized = quantize_model(model, bits, group_size)
+    logger.info(f"Quantized {num_quantized} linear layers to int{bits}")
+    return model
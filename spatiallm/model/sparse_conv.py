@@ -0,0 +1,263 @@
+"""
+Pure-PyTorch sparse 3D convolutions, a fallback for torchsparse.
+
+torchsparse needs a long source build, which gets in the way of lightweight
+CPU deployments. This module mirrors the subset of its API the point cloud
+encoder uses, ``SparseTensor``, ``sparse_collate``, ``Conv3d``, ``GroupNorm``
+and ``ReLU``, with the same parameter names and shapes, so the same
+checkpoints load in either backend.
+
+Voxels are looked up by integer keys packing the batch index and coordinates,
+searched in a sorted copy of the keys. The semantics follow torchsparse 2.1:
+coordinates are divided by the tensor stride, stride 1 convolutions are
+submanifold, a convolution with kernel size and stride 2 maps every voxel to
+the floor of half its coordinates, in sorted order, and output voxel q gathers
+input voxel q + offset with the kernel weights of that offset.
+"""
+
+import math
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+
+class SparseTensor(object):
+    """Features of the occupied voxels of a batch of grids.
+
+    Args:
+        feats: [N, C] torch.FloatTensor.
+        coords: [N, 3] torch.IntTensor, or [N, 4] with the batch index first.
+        stride: int, tensor stride of the coordinates.
+    """
+
+    def __init__(self, feats, coords, stride=1):
+        self.feats = feats
+        self.coords = coords
+        self.stride = stride
+        # kernel maps shared by every tensor with the same coordinates
+        self.caches = {}
+
+    @property
+    def F(self):
+        return self.feats
+
+    @F.setter
+    def F(self, feats):
+        self.feats = feats
+
+    @property
+    def C(self):
+        return self.coords
+
+    @C.setter
+    def C(self, coords):
+        self.coords = coords
+
+    @property
+    def s(self):
+        return self.stride
+
+    def to(self, device, non_blocking=False):
+        self.feats = self.feats.to(device, non_blocking=non_blocking)
+        self.coords = self.coords.to(device, non_blocking=non_blocking)
+        return self
+
+    def replace(self, feats):
+        """A tensor with the same voxels and new features."""
+        output = SparseTensor(feats=feats, coords=self.coords, stride=self.stride)
+        output.caches = self.caches
+        return output
+
+    def __add__(self, other):
+        return self.replace(self.feats + other.feats)
+
+
+def sparse_collate(inputs):
+    """Batch SparseTensors, prepending the batch index to the coordinates."""
+    coords = [
+        torch.cat(
+            (
+                torch.full(
+                    (x.coords.shape[0], 1), k, dtype=torch.int, device=x.coords.device
+                ),
+                x.coords.int(),
+            ),
+            dim=1,
+        )
+        for k, x in enumerate(inputs)
+    ]
+    return SparseTensor(
+        feats=torch.cat([x.feats for x in inputs], dim=0),
+        coords=torch.cat(coords, dim=0),
+        stride=inputs[0].stride,
+    )
+
+
+def get_kernel_offsets(kernel_size):
+    """[K, 3] offsets of a cubic kernel, in the weight order of torchsparse."""
+    r = range(-kernel_size // 2 + 1, kernel_size // 2 + 1)
+    if kernel_size % 2 == 1:
+        offsets = [[x, y, z] for z in r for y in r for x in r]
+    else:
+        offsets = [[x, y, z] for x in r for y in r for z in r]
+    return torch.tensor(offsets, dtype=torch.long)
+
+
+def _voxel_keys(coords, pad, size):
+    """Integer keys of [N, 4] coordinates shifted by pad into [0, size)."""
+    coords = coords.long()
+    keys = coords[:, 0]
+    for k in range(1, 4):
+        keys = keys * size + coords[:, k] + pad
+    return keys
+
+
+def submanifold_kernel_map(coords, kernel_size):
+    """Input and output voxel indices of every kernel offset.
+
+    Returns:
+        List[Tuple[torch.LongTensor, torch.LongTensor]], for every offset the
+            input indices and the output indices they contribute to.
+    """
+    offsets = get_kernel_offsets(kernel_size).to(coords.device)
+    pad = kernel_size // 2
+    size = coords[:, 1:].max().item() + 2 * pad + 1
+    keys = _voxel_keys(coords, pad, size)
+    sorted_keys, order = torch.sort(keys)
+    arange = torch.arange(coords.shape[0], device=coords.device)
+
+    kernel_map = []
+    for offset in offsets:
+        queries = coords.long().clone()
+        queries[:, 1:] += offset
+        query_keys = _voxel_keys(queries, pad, size)
+        position = torch.searchsorted(sorted_keys, query_keys)
+        position = position.clamp(max=sorted_keys.shape[0] - 1)
+        found = sorted_keys[position] == query_keys
+        kernel_map.append((order[position[found]], arange[found]))
+    return kernel_map
+
+
+def downsample_kernel_map(coords):
+    """Output coordinates and kernel map of a kernel 2, stride 2 convolution.
+
+    Returns:
+        coords: [M, 4] torch.IntTensor, sorted output coordinates.
+        kernel_map: see submanifold_kernel_map.
+    """
+    parents = coords.clone()
+    parents[:, 1:] = torch.div(coords[:, 1:], 2, rounding_mode="floor")
+    out_coords, inverse = torch.unique(parents, dim=0, return_inverse=True)
+    # index of the offset of every voxel within its parent, z varying fastest
+    delta = (coords[:, 1:] - 2 * parents[:, 1:]).long()
+    offset_index = delta[:, 0] * 4 + delta[:, 1] * 2 + delta[:, 2]
+    arange = torch.arange(coords.shape[0], device=coords.device)
+    kernel_map = []
+    for k in range(8):
+        mask = offset_index == k
+        kernel_map.append((arange[mask], inverse[mask]))
+    return out_coords, kernel_map
+
+
+class Conv3d(nn.Module):
+    """Sparse 3D convolution with cubic kernels, submanifold with stride 1."""
+
+    def __init__(
+        self,
+        in_channels,
+        out_channels,
+        kernel_size=3,
+        stride=1,
+        dilation=1,
+        bias=False,
+    ):
+        super().__init__()
+        if dilation != 1:
+            raise NotImplementedError("Dilated sparse convolutions are not supported")
+        if stride != 1 and (stride, kernel_size) != (2, 2):
+            raise NotImplementedError(
+                "Only stride 1 and kernel size 2 stride 2 convolutions are supported"
+            )
+        self.in_channels = in_channels
+        self.out_channels = out_channels
+        self.kernel_size = kernel_size
+        self.stride = stride
+        self.kernel_volume = kernel_size**3
+        if self.kernel_volume > 1:
+            self.kernel = nn.Parameter(
+                torch.zeros(self.kernel_volume, in_channels, out_channels)
+            )
+        else:
+            self.kernel = nn.Parameter(torch.zeros(in_channels, out_channels))
+        if bias:
+            self.bias = nn.Parameter(torch.zeros(out_channels))
+        else:
+            self.register_parameter("bias", None)
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        std = 1 / math.sqrt(self.in_channels * self.kernel_volume)
+        self.kernel.data.uniform_(-std, std)
+        if self.bias is not None:
+            self.bias.data.uniform_(-std, std)
+
+    def extra_repr(self):
+        return (
+            f"{self.in_channels}, {self.out_channels}, "
+            f"kernel_size={self.kernel_size}, stride={self.stride}"
+        )
+
+    def forward(self, input: SparseTensor):
+        if self.kernel_volume == 1:
+            return input.replace(input.feats @ self.kernel)
+
+        key = (input.stride, self.kernel_size, self.stride)
+        if key not in input.caches:
+            if self.stride == 1:
+                input.caches[key] = (
+                    input.coords,
+                    submanifold_kernel_map(input.coords, self.kernel_size),
+                )
+            else:
+                input.caches[key] = downsample_kernel_map(input.coords)
+        coords, kernel_map = input.caches[key]
+
+        feats = input.feats.new_zeros((coords.shape[0], self.out_channels))
+        for weight, (in_index, out_index) in zip(self.kernel, kernel_map):
+            if in_index.numel() > 0:
+                # accumulate in the input dtype when the matmuls are autocast
+                products = input.feats[in_index] @ weight
+                feats.index_add_(0, out_index, products.to(feats.dtype))
+        if self.bias is not None:
+            feats = feats + self.bias
+
+        if self.stride == 1:
+            return input.replace(feats)
+        output = SparseTensor(
+            feats=feats, coords=coords, stride=input.stride * self.stride
+        )
+        output.caches = input.caches
+        return output
+
+
+class GroupNorm(nn.GroupNorm):
+    """GroupNorm over the voxels of every batch element separately."""
+
+    def forward(self, input: SparseTensor):
+        coords, feats = input.coords, input.feats
+        num_channels = feats.shape[1]
+        output = torch.zeros_like(feats)
+        for k in range(int(coords[:, 0].max().item()) + 1):
+            indices = coords[:, 0] == k
+            batch_feats = feats[indices].transpose(0, 1).reshape(1, num_channels, -1)
+            batch_feats = F.group_norm(
+                batch_feats, self.num_groups, self.weight, self.bias, self.eps
+            )
+            output[indices] = batch_feats.reshape(num_channels, -1).transpose(0, 1)
+        return input.replace(output)
+
+
+class ReLU(nn.ReLU):
+    def forward(self, input: SparseTensor):
+        return input.replace(F.relu(input.feats, inplace=self.inplace))
@@ -5,7 +5,6 @@ from enum import Enum
 from typing import List, Optional, Tuple, Union
 
 import torch
-import torchsparse
 import torch.utils.checkpoint
 import torch.nn.functional as F
 from torch import nn
@@ -15,12 +14,13 @@ from transformers import (
     AutoConfig,
     AutoModelForCausalLM,
 )
-from torchsparse.utils.collate import sparse_collate
 from transformers.utils import logging
 from transformers.cache_utils import Cache
 from transformers.modeling_outputs import CausalLMOutputWithPast
 from transformers.models.llama.configuration_llama import LlamaConfig
 
+from spatiallm.model.pcd_encoder import PointCloudEncoder, unpad_point_clouds
+
 IGNORE_INDEX = -100
 logger = logging.get_logger(__name__)
 
@@ -46,8 +46,6 @@ class SpatialLMLlamaForCausalLM(LlamaForCausalLM):
         self.point_backbone = None
         point_config = config.point_config
         if self.point_backbone_type == PointBackboneType.SCENESCRIPT:
-            from spatiallm.model.pcd_encoder import PointCloudEncoder
-
             self.point_backbone = PointCloudEncoder(
                 input_channels=point_config["input_channels"],
                 d_model=point_config["embed_channels"],
@@ -69,24 +67,234 @@ class SpatialLMLlamaForCausalLM(LlamaForCausalLM):
 
     def forward_point_cloud(self, point_cloud, device, dtype):
         # point cloud has shape (n_points, n_features)
-        # find the points that have nan values
-        self.point_backbone.to(torch.float32)
-        nan_mask = torch.isnan(point_cloud).any(dim=1)
-        point_cloud = point_cloud[~nan_mask]
-        coords = point_cloud[:, :3].int()
-        feats = point_cloud[:, 3:].float()
+        return self.forward_point_clouds(point_cloud[None], device, dtype)[0][None]
+
+    def forward_point_clouds(self, point_clouds, device, dtype):
+        """Encode a batch of point clouds in a single pass of the point backbone.
+
+        Args:
+            point_clouds: [B, n_points, n_features] tensor, where rows with nan
+                values are padding, or a list of unpadded [n_points, n_features]
+                tensors, which spares the nan scan.
+
+        Returns:
+            List[torch.Tensor], the [n_tokens, hidden_size] point features of
+                every point cloud.
+        """
         if self.point_backbone_type == PointBackboneType.SCENESCRIPT:
-            pc_sparse_tensor = torchsparse.SparseTensor(coords=coords, feats=feats)
-            pc_sparse_tensor = sparse_collate([pc_sparse_tensor])  # batch_size = 1
-            pc_sparse_tensor = pc_sparse_tensor.to(device)
+            backbone_dtype = self.point_backbone.input_proj.weight.dtype
+            if backbone_dtype != torch.float32:
+                # loaded in half precision without set_point_backbone_dtype
+                self.set_point_backbone_dtype(torch.float32)
+            backend = self.point_backbone.sparse_backend
+            pc_sparse_tensors = []
+            for point_cloud in unpad_point_clouds(point_clouds):
+                point_cloud = point_cloud.to(device=device, dtype=torch.float32)
+                coords = point_cloud[:, :3].int()
+                feats = point_cloud[:, 3:]
+                pc_sparse_tensors.append(
+                    backend.SparseTensor(coords=coords, feats=feats)
+                )
+            pc_sparse_tensor = backend.sparse_collate(pc_sparse_tensors)
             encoded_features = self.point_backbone(pc_sparse_tensor)
-            return self.point_proj(encoded_features["context"].to(dtype))
+            point_features = self.point_proj(encoded_features["context"].to(dtype))
+            # drop the padding of the shorter sequences
+            context_mask = encoded_features["context_mask"]
+            return [
+                point_feature[~mask]
+                for point_feature, mask in zip(point_features, context_mask)
+            ]
         else:
             raise ValueError(f"Unknown point backbone type: {self.point_backbone_type}")
 
-    def set_point_backbone_dtype(self, dtype: torch.dtype):
+    def splice_point_features(
+        self,
+        input_ids,
+        inputs_embeds,
+        attention_mask,
+        point_features,
+        padding_side="right",
+    ):
+        """Replace the point pad token of every sequence by its point features.
+
+        Sequences get as long as their number of point tokens, so they are padded
+        to the longest one on padding_side, "left" for generation.
+
+        Returns:
+            inputs_embeds: [B, L, C] torch.FloatTensor.
+            attention_mask: [B, L] torch.Tensor.
+            splice_index: see point_splice_index, to splice the labels alike.
+        """
+        if attention_mask is None:
+            attention_mask = torch.ones(input_ids.shape, device=inputs_embeds.device)
+        if len(point_features) < len(input_ids):
+            # generate() repeats every sequence for beams and return sequences
+            expand_size = len(input_ids) // len(point_features)
+            point_features = [
+                point_feature
+                for point_feature in point_features
+                for _ in range(expand_size)
+            ]
+        device = inputs_embeds.device
+        num_patches = torch.tensor(
+            [len(point_feature) for point_feature in point_features], device=device
+        )
+        splice_index = self.point_splice_index(input_ids, num_patches, padding_side)
+        index, valid = splice_index
+
+        # gather every position from the token embeddings followed by the point
+        # features, so the output is allocated once at its padded size
+        source = torch.cat(
+            [inputs_embeds.flatten(0, 1)]
+            + [
+                point_feature.to(device=device, dtype=inputs_embeds.dtype)
+                for point_feature in point_features
+            ]
+        )
+        inputs_embeds = torch.index_select(source, 0, index.flatten()).view(
+            *index.shape, -1
+        )
+        # point tokens are attended to, padding is not
+        mask_dtype = torch.promote_types(
+            attention_mask.dtype, torch.get_default_dtype()
+        )
+        mask_source = torch.cat(
+            (
+                attention_mask.flatten().to(mask_dtype),
+                torch.ones(
+                    source.shape[0] - attention_mask.numel(),
+                    dtype=mask_dtype,
+                    device=attention_mask.device,
+                ),
+            )
+        )
+        attention_mask = mask_source[index.to(mask_source.device)]
+        attention_mask.masked_fill_(~valid.to(attention_mask.device), 0)
+
+        assert (
+            attention_mask.shape[1] == inputs_embeds.shape[1]
+        ), "The length of attention mask and inputs embeds should be the same"
+        return inputs_embeds, attention_mask, splice_index
+
+    def point_splice_index(self, input_ids, num_patches, padding_side="right"):
+        """Gather index splicing point tokens into a batch of sequences.
+
+        The point start and end tokens of the whole batch are located with a
+        single nonzero call, and the sequences are checked and measured with one
+        more host sync, whatever the batch size.
+
+        Args:
+            input_ids: [B, L] torch.LongTensor, with one point start and one point
+                end token per sequence.
+            num_patches: [B] torch.LongTensor, the number of point tokens of
+                every sequence.
+            padding_side: str, "left" or "right".
+
+        Returns:
+            index: [B, L'] torch.LongTensor, for every spliced position the row of
+                the [B * L + sum(num_patches), C] concatenation of the flattened
+                token embeddings and the point features it takes. Padding repeats
+                the first or the last position of its sequence.
+            valid: [B, L'] torch.BoolTensor, False on padding.
+        """
+        batch_size, seq_len = input_ids.shape
+        device = input_ids.device
+        num_patches = num_patches.to(device)
+        rows, cols = torch.nonzero(
+            (input_ids == self.config.point_start_token_id)
+            | (input_ids == self.config.point_end_token_id),
+            as_tuple=True,
+        )
+        # currently, we only support one point start and one point end token
+        is_valid = rows.shape[0] == 2 * batch_size
+        if is_valid:
+            start_pos, end_pos = cols[0::2], cols[1::2]
+            batch_index = torch.arange(batch_size, device=device)
+            checks = (
+                (rows.view(batch_size, 2) == batch_index[:, None]).all()
+                & (
+                    input_ids[batch_index, start_pos]
+                    == self.config.point_start_token_id
+                ).all()
+                & (
+                    input_ids[batch_index, end_pos] == self.config.point_end_token_id
+                ).all()
+            )
+            # length of every sequence once its point pad tokens are replaced
+            lengths = start_pos + 1 + num_patches + seq_len - end_pos
+            is_valid, max_length = torch.stack((checks.long(), lengths.max())).tolist()
+        if not is_valid:
+            num_point_start_tokens = (
+                (input_ids == self.config.point_start_token_id).sum(dim=1).tolist()
+            )
+            num_point_end_tokens = (
+                (input_ids == self.config.point_end_token_id).sum(dim=1).tolist()
+            )
+            raise AssertionError(
+                "The number of point start tokens and point end tokens should be 1, "
+                f"but got {num_point_start_tokens} and {num_point_end_tokens}."
+            )
+
+        # position of every output token within its unpadded sequence
+        positions = torch.arange(max_length, device=device)[None]
+        if padding_side == "left":
+            positions = positions - (max_length - lengths)[:, None]
+        valid = (positions >= 0) & (positions < lengths[:, None])
+        positions = torch.minimum(positions.clamp(min=0), lengths[:, None] - 1)
+
+        start_pos, end_pos = start_pos[:, None], end_pos[:, None]
+        num_patches = num_patches[:, None]
+        is_point = (positions > start_pos) & (positions <= start_pos + num_patches)
+        token_index = torch.where(
+            positions <= start_pos,
+            positions,
+            positions - start_pos - 1 - num_patches + end_pos,
+        )
+        point_offsets = torch.cumsum(num_patches, dim=0) - num_patches
+        index = torch.where(
+            is_point,
+            batch_size * seq_len + point_offsets + positions - start_pos - 1,
+            batch_index[:, None] * seq_len + token_index,
+        )
+        return index, valid
+
+    def prepare_point_inputs_for_generation(
+        self, input_ids, point_clouds=None, attention_mask=None, point_features=None
+    ):
+        """Encode a batch of point clouds and splice them into the prompts.
+
+        The left padded inputs_embeds and attention_mask returned can be passed
+        to generate() in place of input_ids and point_clouds, which lets scenes
+        with different numbers of point tokens be generated in one batch. The
+        encoder is skipped if precomputed point_features are given.
+        """
+        inputs_embeds = self.model.embed_tokens(input_ids)
+        if point_features is None:
+            point_features = self.forward_point_clouds(
+                point_clouds, inputs_embeds.device, inputs_embeds.dtype
+            )
+        inputs_embeds, attention_mask, _ = self.splice_point_features(
+            input_ids,
+            inputs_embeds,
+            attention_mask,
+            point_features,
+            padding_side="left",
+        )
+        return inputs_embeds, attention_mask.to(input_ids.dtype)
+
+    def set_point_backbone_dtype(
+        self, dtype: torch.dtype, autocast_dtype: Optional[torch.dtype] = None
+    ):
+        """Cast the point backbone once after loading, it is not cast per call.
+
+        Args:
+            dtype: torch.dtype of the point backbone weights.
+            autocast_dtype: optional torch.dtype the sparse convolutions are
+                autocast to, e.g. torch.bfloat16 on CPU.
+        """
         for param in self.point_backbone.parameters():
             param.data = param.data.to(dtype)
+        self.point_backbone.autocast_dtype = autocast_dtype
 
     def get_model(self):
         return self.model
@@ -106,6 +314,7 @@ class SpatialLMLlamaForCausalLM(LlamaForCausalLM):
         cache_position: Optional[torch.LongTensor] = None,
         num_logits_to_keep: int = 0,
         point_clouds: Optional[torch.Tensor] = None,
+        point_features: Optional[List[torch.FloatTensor]] = None,
         **loss_kwargs,
     ) -> Union[Tuple, CausalLMOutputWithPast]:
         r"""
@@ -118,6 +327,10 @@ class SpatialLMLlamaForCausalLM(LlamaForCausalLM):
             point_clouds (`torch.Tensor` of shape `(batch_size, n_points, n_features)`, *optional*):
                 Point clouds to be used for the point cloud encoder.
 
+            point_features (`List[torch.FloatTensor]` of shape `(n_tokens, hidden_size)`, *optional*):
+                Precomputed output of `forward_point_clouds` for every point cloud, used in place of
+                `point_clouds` so that the point cloud encoder is skipped.
+
             num_logits_to_keep (`int`, *optional*):
                 Calculate logits for the last `num_logits_to_keep` tokens. If `0`, calculate logits for all
                 `input_ids` (special case). Only last token logits are needed for generation, and calculating them only for that
@@ -160,95 +373,22 @@ class SpatialLMLlamaForCausalLM(LlamaForCausalLM):
             inputs_embeds = self.model.embed_tokens(input_ids)
 
         if (
-            self.point_backbone is not None
+            (point_clouds is not None or point_features is not None)
+            and self.point_backbone is not None
             and (input_ids.shape[1] != 1 or self.training)
-            and point_clouds is not None
         ):
-            n_point_clouds = point_clouds.shape[0]
-            point_features = []
-            for i in range(n_point_clouds):  # * iterate over batch
-                point_cloud = point_clouds[i]
-                point_feature = self.forward_point_cloud(
-                    point_cloud, inputs_embeds.device, inputs_embeds.dtype
+            if point_features is None:
+                point_features = self.forward_point_clouds(
+                    point_clouds, inputs_embeds.device, inputs_embeds.dtype
                 )
-                point_features.append(point_feature)
-
             # Insert point cloud features into the input ids
-            point_start_end_token_pos = []
-            new_input_embeds = []
-            new_attention_mask = []
-            cur_point_idx = 0
-            max_num_tokens = 0
-            for cur_input_ids, cur_input_embeds, cur_attention_mask in zip(
-                input_ids, inputs_embeds, attention_mask
-            ):  # * input_ids: B, L; input_embeds: B, L, C
-                cur_point_features = (
-                    point_features[cur_point_idx]
-                    .to(device=cur_input_embeds.device)
-                    .squeeze(0)
-                )
-                num_patches = cur_point_features.shape[0]  # * number of point tokens
-                num_point_start_tokens = (
-                    (cur_input_ids == self.config.point_start_token_id).sum().item()
-                )
-                num_point_end_tokens = (
-                    (cur_input_ids == self.config.point_end_token_id).sum().item()
-                )
-                # currently, we only support one point start and one point end token
-                assert num_point_start_tokens == num_point_end_tokens == 1, (
-                    "The number of point start tokens and point end tokens should be 1, "
-                    f"but got {num_point_start_tokens} and {num_point_end_tokens}."
-                )
-                point_start_token_pos = torch.where(
-                    cur_input_ids == self.config.point_start_token_id
-                )[0][0]
-                point_end_token_pos = torch.where(
-                    cur_input_ids == self.config.point_end_token_id
-                )[0][0]
-                cur_new_input_embeds = torch.cat(
-                    (
-                        cur_input_embeds[: point_start_token_pos + 1],
-                        cur_point_features,
-                        cur_input_embeds[point_end_token_pos:],
-                    ),
-                    dim=0,
-                )
-                cur_new_attention_mask = torch.cat(
-                    (
-                        cur_attention_mask[: point_start_token_pos + 1],
-                        torch.ones(num_patches, device=cur_attention_mask.device),
-                        cur_attention_mask[point_end_token_pos:],
-                    ),
-                    dim=0,
-                )
-
-                cur_point_idx += 1
-                new_input_embeds.append(cur_new_input_embeds)
-                new_attention_mask.append(cur_new_attention_mask)
-                point_start_end_token_pos.append(
-                    (point_start_token_pos, num_patches, point_end_token_pos)
-                )
-                if cur_new_input_embeds.shape[0] > max_num_tokens:
-                    max_num_tokens = cur_new_input_embeds.shape[0]
-            # pad the new input embeds and attention mask to the max dimension
-            for i in range(len(new_input_embeds)):
-                cur_input_embeds = new_input_embeds[i]
-                last_row = cur_input_embeds[-1]
-                padding = last_row.repeat(max_num_tokens - cur_input_embeds.shape[0], 1)
-                new_input_embeds[i] = torch.cat([cur_input_embeds, padding], dim=0)
-
-                cur_attention_mask = new_attention_mask[i]
-                new_attention_mask[i] = F.pad(
-                    cur_attention_mask,
-                    (0, max_num_tokens - cur_attention_mask.shape[0]),
-                    value=0,
-                )
-            inputs_embeds = torch.stack(new_input_embeds, dim=0)
-            attention_mask = torch.stack(new_attention_mask, dim=0)
-
-            assert (
-                attention_mask.shape[1] == inputs_embeds.shape[1]
-            ), "The length of attention mask and inputs embeds should be the same"
+            (
+                inputs_embeds,
+                attention_mask,
+                splice_index,
+            ) = self.splice_point_features(
+                input_ids, inputs_embeds, attention_mask, point_features
+            )
 
         # decoder outputs consists of (dec_features, layer_state, dec_hidden, dec_attn)
         outputs = self.model(
@@ -280,35 +420,12 @@ class SpatialLMLlamaForCausalLM(LlamaForCausalLM):
 
         loss = None
         if labels is not None:
-            # prepare new labels
-            new_labels = []
-            max_num_tokens = logits.shape[1]
-            for i in range(len(point_start_end_token_pos)):
-                cur_labels = labels[i]
-                (
-                    cur_point_start_token_pos,
-                    num_patches,
-                    cur_point_end_token_pos,
-                ) = point_start_end_token_pos[i]
-                cur_new_labels = torch.cat(
-                    (
-                        cur_labels[: cur_point_start_token_pos + 1],
-                        torch.full(
-                            (num_patches,),
-                            IGNORE_INDEX,
-                            device=cur_labels.device,
-                        ),
-                        cur_labels[cur_point_end_token_pos:],
-                    ),
-                    dim=0,
-                )
-                cur_new_labels = F.pad(
-                    cur_new_labels,
-                    (0, max_num_tokens - cur_new_labels.shape[0]),
-                    value=IGNORE_INDEX,
-                )
-                new_labels.append(cur_new_labels)
-            labels = torch.stack(new_labels, dim=0)
+            # prepare new labels, point tokens and padding are ignored
+            index, valid = splice_index
+            index = index.to(labels.device)
+            is_token = index < labels.numel()
+            labels = labels.flatten()[index.clamp(max=labels.numel() - 1)]
+            labels.masked_fill_(~(is_token & valid.to(labels.device)), IGNORE_INDEX)
 
             assert (
                 labels.shape[1] == logits.shape[1]
@@ -344,8 +461,9 @@ class SpatialLMLlamaForCausalLM(LlamaForCausalLM):
         if past_key_values:
             input_ids = input_ids[:, -1:]
 
-        # if `inputs_embeds` are passed, we only want to use them in the 1st generation step
-        if inputs_embeds is not None and past_key_values is None:
+        # if `inputs_embeds` are passed, we only want to use them in the 1st generation step,
+        # generate() may start from an empty cache instead of None
+        if inputs_embeds is not None and not past_key_values:
             model_inputs = {"inputs_embeds": inputs_embeds}
         else:
             model_inputs = {"input_ids": input_ids}
@@ -356,6 +474,7 @@ class SpatialLMLlamaForCausalLM(LlamaForCausalLM):
                 "use_cache": kwargs.get("use_cache"),
                 "attention_mask": attention_mask,
                 "point_clouds": kwargs.get("point_clouds", None),
+                "point_features": kwargs.get("point_features", None),
             }
         )
         return model_inputs
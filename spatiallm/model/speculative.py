@@ -0,0 +1,174 @@
+"""
+Prompt-lookup speculative decoding of layouts.
+
+Layouts repeat themselves: entity labels, ``wall_N`` references, commas and
+whole parameter runs recur from line to line. Draft tokens are proposed by
+looking up the last generated n-gram in a table built from the prompt and the
+text generated so far, and are verified together in one forward pass. A draft
+token is accepted only if it is the token the model itself picks at that
+position, so the output follows the same distribution as plain decoding, and
+is the same as greedy decoding when not sampling.
+"""
+
+import time
+
+import torch
+from transformers import (
+    LogitsProcessorList,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
+
+
+class NgramTable(object):
+    """Most recent continuation of every n-gram of a growing token sequence.
+
+    Args:
+        max_ngram_size: int, longest n-gram looked up.
+    """
+
+    def __init__(self, max_ngram_size: int = 3):
+        self.max_ngram_size = max_ngram_size
+        self.tokens = []
+        # n-gram -> position of the token following its latest occurrence
+        self.continuations = {}
+
+    def extend(self, token_ids):
+        for token_id in token_ids:
+            end = len(self.tokens)
+            for n in range(1, min(self.max_ngram_size, end) + 1):
+                self.continuations[tuple(self.tokens[end - n : end])] = end
+            self.tokens.append(token_id)
+
+    def propose(self, num_tokens: int):
+        """Tokens that followed the longest earlier occurrence of the suffix."""
+        if num_tokens <= 0:
+            return []
+        for n in range(min(self.max_ngram_size, len(self.tokens)), 0, -1):
+            start = self.continuations.get(tuple(self.tokens[-n:]))
+            if start is not None:
+                return self.tokens[start : start + num_tokens]
+        return []
+
+
+@torch.no_grad()
+def generate_speculative(
+    model,
+    prompt_cache,
+    eos_token_id,
+    max_new_tokens=4096,
+    do_sample=True,
+    temperature=0.6,
+    top_p=0.95,
+    top_k=10,
+    num_draft_tokens=10,
+    max_ngram_size=3,
+    streamer=None,
+    stopping_criteria=None,
+    past_key_values=None,
+):
+    """Decode one layout from a prefilled prompt with prompt-lookup drafts.
+
+    Args:
+        model: a SpatialLM model.
+        prompt_cache: PromptCache of the scene prompt.
+        eos_token_id: int or List[int], tokens ending a layout.
+        num_draft_tokens: int, maximum number of draft tokens per forward pass.
+        max_ngram_size: int, longest n-gram looked up to propose drafts.
+        streamer: optional streamer, receiving the prompt and then new tokens.
+        stopping_criteria: optional criteria called with the prompt and the
+            generated ids, see LayoutStoppingCriteria.
+        past_key_values: optional fork of prompt_cache to decode into, e.g. a
+            CompactCache, a new fork if None.
+
+    Returns:
+        output_ids: torch.LongTensor of the generated token ids.
+        stats: Dict[str, float] of the number of tokens, forward passes, drafted
+            and accepted tokens and the decoding time in seconds.
+    """
+    if isinstance(eos_token_id, int):
+        eos_token_id = [eos_token_id]
+    warpers = LogitsProcessorList()
+    if do_sample:
+        warpers += [
+            TemperatureLogitsWarper(temperature),
+            TopKLogitsWarper(top_k),
+            TopPLogitsWarper(top_p),
+        ]
+    if past_key_values is None:
+        past_key_values = prompt_cache.fork()
+    input_ids = prompt_cache.input_ids
+    if streamer is not None:
+        streamer.put(input_ids.cpu())
+
+    # the point placeholders never continue a layout, leave them out of the table
+    prompt_ids = input_ids[0].tolist()
+    point_token_id = model.config.point_token_id
+    table = NgramTable(max_ngram_size)
+    table.extend([token_id for token_id in prompt_ids if token_id != point_token_id])
+
+    start_time = time.perf_counter()
+    generated = []
+    pending = prompt_ids[-1:]
+    stats = dict(num_tokens=0, num_forward=0, num_drafted=0, num_accepted=0)
+    finished = False
+    while not finished and len(generated) < max_new_tokens:
+        draft = table.propose(
+            min(num_draft_tokens, max_new_tokens - len(generated) - 1)
+        )
+        chunk = pending + draft
+        num_cached = past_key_values.get_seq_length()
+        outputs = model(
+            input_ids=torch.tensor([chunk], device=input_ids.device),
+            attention_mask=torch.ones(
+                (1, num_cached + len(chunk)),
+                dtype=input_ids.dtype,
+                device=input_ids.device,
+            ),
+            past_key_values=past_key_values,
+            use_cache=True,
+            num_logits_to_keep=len(draft) + 1,
+        )
+        past_key_values = outputs.past_key_values
+        logits = outputs.logits[0, -(len(draft) + 1) :].float()
+        stats["num_forward"] += 1
+        stats["num_drafted"] += len(draft)
+
+        # pick a token at every position, the drafts are accepted while they
+        # agree with the picks
+        new_tokens = []
+        num_accepted = 0
+        for i in range(len(draft) + 1):
+            scores = warpers(None, logits[i : i + 1])
+            if do_sample:
+                token_id = torch.multinomial(scores.softmax(dim=-1), 1).item()
+            else:
+                token_id = scores.argmax(dim=-1).item()
+            if token_id in eos_token_id:
+                finished = True
+                break
+            new_tokens.append(token_id)
+            if i == len(draft) or token_id != draft[i]:
+                break
+            num_accepted += 1
+
+        # drop the keys and values of the rejected drafts, the last new token is
+        # fed in the next pass
+        past_key_values.crop(num_cached + len(pending) + num_accepted)
+        stats["num_accepted"] += num_accepted
+        generated += new_tokens
+        table.extend(new_tokens)
+        pending = new_tokens[-1:]
+        if streamer is not None and new_tokens:
+            streamer.put(torch.tensor(new_tokens))
+        if stopping_criteria is not None:
+            output_ids = torch.tensor([prompt_ids + generated])
+            if stopping_criteria(output_ids).all():
+                break
+
+    if streamer is not None:
+        streamer.end()
+    stats["seconds"] = time.perf_counter() - start_time
+    stats["num_tokens"] = len(generated)
+    return torch.tensor(generated, dtype=torch.long), stats
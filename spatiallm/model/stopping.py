@@ -0,0 +1,126 @@
+"""
+Token budgets and early stopping for layout generation.
+
+A scene can only hold so many entities, so the token budget is sized from its
+footprint and number of voxels instead of always allowing 4096 tokens. While
+decoding, ``LayoutStoppingCriteria`` checks every entity line as it completes
+and stops a sequence that repeats the same entity or keeps writing lines that
+cannot be parsed as entities, recording why it stopped.
+"""
+
+import numpy as np
+import torch
+from transformers import StoppingCriteria
+
+from spatiallm.layout.layout import Layout
+
+
+def estimate_max_new_tokens(
+    points: np.ndarray,
+    cell_size: float = 0.5,
+    tokens_per_cell: float = 10.0,
+    tokens_per_kvoxel: float = 2.0,
+    min_tokens: int = 512,
+    max_tokens: int = 4096,
+):
+    """Token budget of a scene from its footprint and number of voxels.
+
+    The footprint is the number of occupied cells of a coarse grid on the floor
+    plane, which follows the floor area actually scanned rather than its
+    bounding box. The defaults leave ample room over the layouts of typical
+    scenes, an entity line being about 25 tokens.
+
+    Args:
+        points: [N, 3] array of the voxelized coordinates in meters.
+        cell_size: float, side length in meters of a footprint cell.
+        tokens_per_cell: float, tokens allowed per footprint cell.
+        tokens_per_kvoxel: float, tokens allowed per thousand voxels.
+        min_tokens: int, lower bound of the budget.
+        max_tokens: int, upper bound of the budget.
+
+    Returns:
+        int, the number of new tokens to allow.
+    """
+    cells = np.unique(np.floor(points[:, :2] / cell_size).astype(np.int64), axis=0)
+    budget = (
+        min_tokens
+        + tokens_per_cell * len(cells)
+        + tokens_per_kvoxel * len(points) / 1000
+    )
+    return int(min(budget, max_tokens))
+
+
+class LayoutStoppingCriteria(StoppingCriteria):
+    """Stop sequences that loop over an entity or stop writing entities.
+
+    Every completed line is checked once. A sequence is stopped when the same
+    entity, ignoring its id, has been written max_repeats times, or when
+    max_invalid_lines consecutive lines could not be parsed by
+    Layout.parse_line. Lines are not checked against the stricter grammar of
+    constrained decoding, so unusual but parseable lines never stop a layout.
+    The reason of every stopped row is kept in reasons.
+
+    Rows are tracked by index, so this is meant for greedy decoding and
+    sampling rather than beam search.
+
+    Args:
+        tokenizer: the tokenizer of the model.
+        prompt_length: int, number of prompt tokens in the input_ids passed to
+            the criteria, 0 when generating from inputs_embeds.
+        max_repeats: int, occurrences of an entity that stop a sequence.
+        max_invalid_lines: int, consecutive unparseable lines that stop a
+            sequence.
+    """
+
+    def __init__(
+        self,
+        tokenizer,
+        prompt_length: int,
+        max_repeats: int = 3,
+        max_invalid_lines: int = 3,
+    ):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.max_repeats = max_repeats
+        self.max_invalid_lines = max_invalid_lines
+        self.rows = []
+        self.reasons = []
+
+    def _check_line(self, row, line):
+        line = line.strip()
+        if not line:
+            return None
+        if Layout.parse_line(line) is None:
+            row["num_invalid"] += 1
+            if row["num_invalid"] >= self.max_invalid_lines:
+                return "invalid"
+            return None
+        # isolated bad lines do not add up to a stop
+        row["num_invalid"] = 0
+        # the entity without its label and id
+        body = line.partition("=")[2]
+        row["counts"][body] = row["counts"].get(body, 0) + 1
+        if row["counts"][body] >= self.max_repeats:
+            return "repetition"
+        return None
+
+    def __call__(self, input_ids: torch.LongTensor, scores=None, **kwargs):
+        while len(self.rows) < input_ids.shape[0]:
+            self.rows.append(dict(num_seen=0, text="", counts={}, num_invalid=0))
+            self.reasons.append(None)
+        is_done = torch.zeros(input_ids.shape[0], dtype=torch.bool)
+        for i, row in enumerate(self.rows[: input_ids.shape[0]]):
+            if self.reasons[i] is not None:
+                is_done[i] = True
+                continue
+            new_ids = input_ids[i, self.prompt_length + row["num_seen"] :].tolist()
+            row["num_seen"] += len(new_ids)
+            row["text"] += self.tokenizer.decode(new_ids, skip_special_tokens=True)
+            *lines, row["text"] = row["text"].split("\n")
+            for line in lines:
+                reason = self._check_line(row, line)
+                if reason is not None:
+                    self.reasons[i] = reason
+                    is_done[i] = True
+                    break
+        return is_done.to(input_ids.device)
@@ -1,8 +1,36 @@
-from .pcd_loader import load_o3d_pcd, get_points_and_colors, cleanup_pcd, Compose
+from .pcd_loader import (
+    load_o3d_pcd,
+    get_points_and_colors,
+    to_uint8_colors,
+    cleanup_pcd,
+    Compose,
+)
+from .cache import PointCloudCache
+from .neighbors import (
+    NeighborFilter,
+    remove_radius_outlier,
+    remove_statistical_outlier,
+)
+from .ply import PlyPointCloud, load_ply_pcd
+from .tiling import Tile, split_into_tiles
+from .voxel_map import VoxelMap
+from .voxelize import voxelize_test, fit_cell_budget
 
 __all__ = [
     "load_o3d_pcd",
     "get_points_and_colors",
+    "to_uint8_colors",
     "cleanup_pcd",
     "Compose",
+    "PointCloudCache",
+    "NeighborFilter",
+    "remove_radius_outlier",
+    "remove_statistical_outlier",
+    "PlyPointCloud",
+    "load_ply_pcd",
+    "Tile",
+    "split_into_tiles",
+    "VoxelMap",
+    "voxelize_test",
+    "fit_cell_budget",
 ]
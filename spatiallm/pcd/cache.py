@@ -0,0 +1,124 @@
+"""
+On-disk cache of preprocessed point clouds.
+
+Entries are addressed by the SHA-256 of the input file plus the preprocessing
+parameters, so a scene is only cleaned up and voxelized once no matter how often
+the sampling parameters or the model checkpoint change. Every entry is a
+``.npy`` file of features that is memory-mapped on load plus a small ``.npz``
+file of metadata arrays, and the least recently used entries are evicted once
+the cache grows past its size limit.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+
+def hash_file(file_path: str, chunk_size: int = 1 << 24):
+    """SHA-256 hex digest of the contents of a file."""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class PointCloudCache(object):
+    """Size-bounded LRU cache of preprocessed point cloud arrays.
+
+    Args:
+        cache_dir: str, directory holding the cache entries.
+        max_size: int, maximum total size of the entries in bytes.
+    """
+
+    FEATURES_SUFFIX = ".npy"
+    META_SUFFIX = ".meta.npz"
+
+    def __init__(self, cache_dir: str, max_size: int = 8 << 30):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, file_path: str, **params):
+        """Cache key of a point cloud file preprocessed with the given parameters."""
+        digest = hashlib.sha256(hash_file(file_path).encode())
+        digest.update(json.dumps(params, sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def _paths(self, key: str):
+        base = os.path.join(self.cache_dir, key)
+        return base + self.FEATURES_SUFFIX, base + self.META_SUFFIX
+
+    def get(self, key: str):
+        """Load a cache entry.
+
+        Returns:
+            features: [N, 9] read-only memory-mapped array, or None on a miss.
+            meta: Dict[str, np.ndarray] of the metadata arrays, or None on a miss.
+        """
+        features_path, meta_path = self._paths(key)
+        try:
+            features = np.load(features_path, mmap_mode="r")
+            with np.load(meta_path) as meta:
+                meta = dict(meta)
+        except (FileNotFoundError, ValueError):
+            return None, None
+        # the modification time records the last use for eviction
+        os.utime(features_path)
+        return features, meta
+
+    def put(self, key: str, features: np.ndarray, **meta):
+        """Store a cache entry and evict old entries beyond the size limit.
+
+        Args:
+            key: str, the cache key.
+            features: [N, 9] array.
+            meta: metadata arrays stored alongside, e.g. min_extent.
+        """
+        features_path, meta_path = self._paths(key)
+        # write to temporary files first so concurrent readers never see a
+        # partial entry, the features file is published last
+        writes = (
+            (meta_path, lambda f: np.savez(f, **meta)),
+            (features_path, lambda f: np.save(f, np.ascontiguousarray(features))),
+        )
+        for path, write in writes:
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    write(f)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits in max_size."""
+        entries = []
+        total_size = 0
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(self.FEATURES_SUFFIX):
+                continue
+            key = name[: -len(self.FEATURES_SUFFIX)]
+            paths = self._paths(key)
+            try:
+                stats = [os.stat(path) for path in paths]
+            except FileNotFoundError:
+                continue
+            size = sum(stat.st_size for stat in stats)
+            entries.append((stats[0].st_mtime, size, paths))
+            total_size += size
+
+        for _, size, paths in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            for path in paths:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            total_size -= size
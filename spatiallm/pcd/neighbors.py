@@ -0,0 +1,105 @@
+"""
+Parallel neighbor-based outlier removal.
+
+Reimplements Open3D's ``remove_radius_outlier`` and
+``remove_statistical_outlier`` on top of a SciPy KD-tree queried with all cores.
+The tree of a cloud is built once by ``NeighborFilter`` and shared by both
+filters, so running them back to back on the same cloud costs one index build.
+"""
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+class NeighborFilter(object):
+    """KD-tree over a point cloud answering outlier queries in parallel.
+
+    Args:
+        points: [N, 3] array of coordinates.
+        workers: int, number of query threads, -1 to use all cores.
+        chunk_size: int, number of points queried at a time to bound memory.
+    """
+
+    def __init__(self, points: np.ndarray, workers: int = -1, chunk_size=1 << 20):
+        self.points = np.asarray(points)
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self._tree = None
+
+    @property
+    def tree(self):
+        if self._tree is None:
+            self._tree = cKDTree(self.points, balanced_tree=False)
+        return self._tree
+
+    def radius_mask(self, nb_points: int, radius: float):
+        """Mask of the points with more than nb_points points within radius.
+
+        The point itself is counted and the radius is exclusive, as in Open3D,
+        so a point needs nb_points other points within radius to be kept.
+        """
+        # Open3D keeps neighbors strictly inside the radius, cKDTree includes
+        # the boundary
+        radius = np.nextafter(radius, 0)
+        mask = np.empty(len(self.points), dtype=bool)
+        for start in range(0, len(self.points), self.chunk_size):
+            counts = self.tree.query_ball_point(
+                self.points[start : start + self.chunk_size],
+                radius,
+                workers=self.workers,
+                return_length=True,
+            )
+            mask[start : start + len(counts)] = counts > nb_points
+        return mask
+
+    def statistical_mask(self, nb_neighbors: int, std_ratio: float):
+        """Mask of the points whose mean neighbor distance is not an outlier.
+
+        The mean distance to the nb_neighbors nearest points, the point itself
+        included, must be positive and below the mean plus std_ratio standard
+        deviations over the cloud, as in Open3D.
+        """
+        num_points = len(self.points)
+        k = min(nb_neighbors, num_points)
+        if k == 0:
+            return np.zeros(num_points, dtype=bool)
+        avg_distances = np.empty(num_points, dtype=np.float64)
+        for start in range(0, num_points, self.chunk_size):
+            distances, _ = self.tree.query(
+                self.points[start : start + self.chunk_size],
+                k=k,
+                workers=self.workers,
+            )
+            distances = distances.reshape(len(distances), -1)
+            avg_distances[start : start + len(distances)] = distances.mean(1)
+        # like Open3D, points on top of all their neighbors are left out of the
+        # statistics but still counted, and always removed
+        positive = avg_distances > 0
+        if num_points < 2:
+            return positive
+        cloud_mean = avg_distances[positive].sum() / num_points
+        sq_sum = np.sum((avg_distances[positive] - cloud_mean) ** 2)
+        std_dev = np.sqrt(sq_sum / (num_points - 1))
+        distance_threshold = cloud_mean + std_ratio * std_dev
+        return positive & (avg_distances < distance_threshold)
+
+
+def _select(pcd, mask):
+    index = np.flatnonzero(mask)
+    return pcd.select_by_index(index), index
+
+
+# Drop-in of Open3D's PointCloud.remove_radius_outlier
+def remove_radius_outlier(pcd, nb_points: int, radius: float, neighbors=None):
+    if neighbors is None:
+        neighbors = NeighborFilter(np.asarray(pcd.points))
+    return _select(pcd, neighbors.radius_mask(nb_points, radius))
+
+
+# Drop-in of Open3D's PointCloud.remove_statistical_outlier
+def remove_statistical_outlier(
+    pcd, nb_neighbors: int, std_ratio: float, neighbors=None
+):
+    if neighbors is None:
+        neighbors = NeighborFilter(np.asarray(pcd.points))
+    return _select(pcd, neighbors.statistical_mask(nb_neighbors, std_ratio))
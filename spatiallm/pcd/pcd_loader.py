@@ -2,11 +2,18 @@ import logging
 import numpy as np
 import open3d as o3d
 
+from spatiallm.pcd.neighbors import remove_radius_outlier
+from spatiallm.pcd.ply import PlyPointCloud
 from spatiallm.pcd.registry import Registry
+from spatiallm.pcd.voxelize import voxelize_test
 
 TRANSFORMS = Registry("transforms")
 log = logging.getLogger(__name__)
 
+# points stay float32 and colors uint8 until the feature tensor is built
+COORD_DTYPE = np.float32
+COLOR_DTYPE = np.uint8
+
 """
 3D Point Cloud Preprocessing
 
@@ -21,13 +28,29 @@ Reference: PointCept
 
 
 class Compose(object):
-    def __init__(self, cfg=None):
+    def __init__(self, cfg=None, fuse=True):
         self.cfg = cfg if cfg is not None else []
         self.transforms = []
         for t_cfg in self.cfg:
             self.transforms.append(TRANSFORMS.build(t_cfg))
+        # run the standard inference chain, after any leading crops, as a single
+        # fused transform
+        self.num_crops = 0
+        while self.num_crops < len(self.transforms) and isinstance(
+            self.transforms[self.num_crops], Crop
+        ):
+            self.num_crops += 1
+        self.fused = (
+            FusedTestGridSample.from_transforms(self.transforms[self.num_crops :])
+            if fuse
+            else None
+        )
 
     def __call__(self, data_dict):
+        if self.fused is not None:
+            for t in self.transforms[: self.num_crops]:
+                data_dict = t(data_dict)
+            return self.fused(data_dict)
         for t in self.transforms:
             data_dict = t(data_dict)
         return data_dict
@@ -50,6 +73,100 @@ class NormalizeColor(object):
         return data_dict
 
 
+class Crop(object):
+    """Keep the points inside a region, the coordinates are left untouched.
+
+    Subclasses implement ``get_mask``. Crops only drop points, so the minimum
+    bound of what is left maps a layout predicted for it back to the scene.
+    """
+
+    def __init__(self, keys=("coord", "color", "normal", "segment")):
+        self.keys = keys
+
+    def get_mask(self, coord):
+        raise NotImplementedError
+
+    def __call__(self, data_dict):
+        assert "coord" in data_dict.keys()
+        mask = self.get_mask(data_dict["coord"])
+        for key in self.keys:
+            if key in data_dict:
+                data_dict[key] = data_dict[key][mask]
+        return data_dict
+
+
+@TRANSFORMS.register_module()
+class BoxCrop(Crop):
+    """Crop to an axis-aligned box given by its min and max corner."""
+
+    def __init__(self, min_bound, max_bound, **kwargs):
+        super().__init__(**kwargs)
+        self.min_bound = np.asarray(min_bound, dtype=np.float64)
+        self.max_bound = np.asarray(max_bound, dtype=np.float64)
+
+    def get_mask(self, coord):
+        return np.all((coord >= self.min_bound) & (coord <= self.max_bound), axis=1)
+
+
+@TRANSFORMS.register_module()
+class OrientedBoxCrop(Crop):
+    """Crop to a box rotated by angle radians around the z axis, as a layout Bbox."""
+
+    def __init__(self, center, size, angle=0.0, **kwargs):
+        super().__init__(**kwargs)
+        self.center = np.asarray(center, dtype=np.float64)
+        self.half_size = np.asarray(size, dtype=np.float64) * 0.5
+        cos, sin = np.cos(angle), np.sin(angle)
+        # columns are the box axes, so coordinates @ rotation are box-local
+        self.rotation = np.array([[cos, -sin, 0], [sin, cos, 0], [0, 0, 1]])
+
+    def get_mask(self, coord):
+        local = (coord - self.center) @ self.rotation.astype(coord.dtype)
+        return np.all(np.abs(local) <= self.half_size, axis=1)
+
+
+@TRANSFORMS.register_module()
+class PolygonCrop(Crop):
+    """Crop to the prism over a floor polygon, optionally bounded in height."""
+
+    def __init__(self, polygon, z_min=None, z_max=None, **kwargs):
+        super().__init__(**kwargs)
+        self.polygon = np.asarray(polygon, dtype=np.float64).reshape(-1, 2)
+        assert len(self.polygon) >= 3
+        self.height = HeightCrop(z_min, z_max)
+
+    def get_mask(self, coord):
+        x, y = coord[:, 0], coord[:, 1]
+        inside = self.height.get_mask(coord)
+        # even-odd rule, one vectorized pass over the points per edge
+        crossings = np.zeros(len(coord), dtype=bool)
+        for (x0, y0), (x1, y1) in zip(self.polygon, np.roll(self.polygon, -1, 0)):
+            if y0 == y1:
+                continue
+            straddle = (y0 > y) != (y1 > y)
+            x_cross = x0 + (y - y0) * (x1 - x0) / (y1 - y0)
+            crossings ^= straddle & (x < x_cross)
+        return inside & crossings
+
+
+@TRANSFORMS.register_module()
+class HeightCrop(Crop):
+    """Crop to a band of heights, either bound may be None."""
+
+    def __init__(self, z_min=None, z_max=None, **kwargs):
+        super().__init__(**kwargs)
+        self.z_min = z_min
+        self.z_max = z_max
+
+    def get_mask(self, coord):
+        mask = np.ones(len(coord), dtype=bool)
+        if self.z_min is not None:
+            mask &= coord[:, 2] >= self.z_min
+        if self.z_max is not None:
+            mask &= coord[:, 2] <= self.z_max
+        return mask
+
+
 @TRANSFORMS.register_module()
 class GridSample(object):
     def __init__(
@@ -64,6 +181,7 @@ class GridSample(object):
         return_displacement=False,
         project_displacement=False,
         max_grid_coord=None,
+        counting_sort=True,
     ):
         self.grid_size = grid_size
         self.hash = self.fnv_hash_vec if hash_type == "fnv" else self.ravel_hash_vec
@@ -76,17 +194,21 @@ class GridSample(object):
         self.return_displacement = return_displacement
         self.project_displacement = project_displacement
         self.max_grid_coord = max_grid_coord
+        # linear-time voxelization is only possible when the grid is bounded
+        self.counting_sort = counting_sort and max_grid_coord is not None
 
     def __call__(self, data_dict):
         assert "coord" in data_dict.keys()
-        scaled_coord = data_dict["coord"] / np.array(self.grid_size)
-        grid_coord = np.floor(scaled_coord).astype(int)
-        min_coord = grid_coord.min(0)
-        grid_coord -= min_coord
+        coord = data_dict["coord"]
+        scaled_coord = coord / np.array(self.grid_size, dtype=coord.dtype)
+        grid_coord, min_coord = self.get_grid_coord(scaled_coord)
         scaled_coord -= min_coord
         min_coord = min_coord * np.array(self.grid_size)
-        if self.max_grid_coord is not None:
-            grid_coord = np.clip(grid_coord, 0, self.max_grid_coord - 1)
+        if self.mode == "test":  # test mode
+            idx_part, inverse = self.select_test(grid_coord)
+            return self._test_output(
+                data_dict, grid_coord, min_coord, idx_part, inverse
+            )
         key = self.hash(grid_coord)
         idx_sort = np.argsort(key)
         key_sort = key[idx_sort]
@@ -124,29 +246,62 @@ class GridSample(object):
             for key in self.keys:
                 data_dict[key] = data_dict[key][idx_unique]
             return data_dict
-
-        elif self.mode == "test":  # test mode
-            idx_select = (
-                np.cumsum(np.insert(count, 0, 0)[0:-1]) + (count.max() // 2) % count
-            )
-            idx_part = idx_sort[idx_select]
-            data_part = dict(index=idx_part)
-            if self.return_inverse:
-                data_dict["inverse"] = np.zeros_like(inverse)
-                data_dict["inverse"][idx_sort] = inverse
-            if self.return_grid_coord:
-                data_part["grid_coord"] = grid_coord[idx_part]
-            if self.return_min_coord:
-                data_part["min_coord"] = min_coord.reshape([1, 3])
-            for key in data_dict.keys():
-                if key in self.keys:
-                    data_part[key] = data_dict[key][idx_part]
-                else:
-                    data_part[key] = data_dict[key]
-            return data_part
         else:
             raise NotImplementedError
 
+    def get_grid_coord(self, scaled_coord):
+        """Shift and clip floored grid coordinates, returns them with the shift."""
+        grid_coord = np.floor(scaled_coord).astype(int)
+        min_coord = grid_coord.min(0)
+        grid_coord -= min_coord
+        if self.max_grid_coord is not None:
+            grid_coord = np.clip(grid_coord, 0, self.max_grid_coord - 1)
+        return grid_coord, min_coord
+
+    def select_test(self, grid_coord):
+        """Select the representative point of every voxel in test mode.
+
+        Returns:
+            idx_part: [V] indices of the selected points.
+            inverse: [N] voxel index of every point, or None if not requested.
+        """
+        if self.counting_sort:
+            idx_part, inverse, _ = voxelize_test(
+                grid_coord,
+                num_bins=self.max_grid_coord,
+                hash_fn=self.hash,
+                return_inverse=self.return_inverse,
+            )
+            return idx_part, inverse
+        key = self.hash(grid_coord)
+        idx_sort = np.argsort(key)
+        key_sort = key[idx_sort]
+        _, inverse, count = np.unique(key_sort, return_inverse=True, return_counts=True)
+        idx_select = (
+            np.cumsum(np.insert(count, 0, 0)[0:-1]) + (count.max() // 2) % count
+        )
+        idx_part = idx_sort[idx_select]
+        if not self.return_inverse:
+            return idx_part, None
+        inverse_unsorted = np.zeros_like(inverse)
+        inverse_unsorted[idx_sort] = inverse
+        return idx_part, inverse_unsorted
+
+    def _test_output(self, data_dict, grid_coord, min_coord, idx_part, inverse):
+        data_part = dict(index=idx_part)
+        if self.return_inverse:
+            data_dict["inverse"] = inverse
+        if self.return_grid_coord:
+            data_part["grid_coord"] = grid_coord[idx_part]
+        if self.return_min_coord:
+            data_part["min_coord"] = min_coord.reshape([1, 3])
+        for key in data_dict.keys():
+            if key in self.keys:
+                data_part[key] = data_dict[key][idx_part]
+            else:
+                data_part[key] = data_dict[key]
+        return data_part
+
     @staticmethod
     def ravel_hash_vec(arr):
         """
@@ -184,33 +339,156 @@ class GridSample(object):
         return hashed_arr
 
 
+class FusedTestGridSample(object):
+    """PositiveShift, NormalizeColor and test mode GridSample fused in one pass.
+
+    The voxel selection only needs the grid coordinates, so the shifted
+    coordinates and normalized colors are computed for the selected points only
+    and written straight into one float32 feature buffer. The input arrays are
+    left untouched. The output holds the same keys as the unfused chain, with
+    ``coord`` and ``color`` as float32 views of the buffer, plus ``feat``, the
+    [V, 9] buffer of grid coordinates, coordinates and colors.
+    """
+
+    def __init__(self, grid_sample: GridSample):
+        self.grid_sample = grid_sample
+
+    @classmethod
+    def from_transforms(cls, transforms):
+        """Build the fused transform if transforms are the standard inference chain."""
+        if len(transforms) != 3:
+            return None
+        shift, normalize, grid_sample = transforms
+        if not (
+            type(shift) is PositiveShift
+            and type(normalize) is NormalizeColor
+            and type(grid_sample) is GridSample
+        ):
+            return None
+        if (
+            grid_sample.mode != "test"
+            or sorted(grid_sample.keys) != ["color", "coord"]
+            or not grid_sample.return_grid_coord
+            or grid_sample.return_inverse
+        ):
+            return None
+        return cls(grid_sample)
+
+    def __call__(self, data_dict):
+        grid_sample = self.grid_sample
+        coord = data_dict["coord"]
+        color = data_dict["color"]
+        coord_min = np.min(coord, 0)
+        scaled_coord = coord - coord_min
+        scaled_coord /= np.array(grid_sample.grid_size, dtype=coord.dtype)
+        grid_coord, min_coord = grid_sample.get_grid_coord(scaled_coord)
+        del scaled_coord
+        idx_part, _ = grid_sample.select_test(grid_coord)
+
+        feat = np.empty((len(idx_part), 9), dtype=np.float32)
+        grid_coord = grid_coord[idx_part]
+        feat[:, :3] = grid_coord
+        np.subtract(coord[idx_part], coord_min, out=feat[:, 3:6], casting="unsafe")
+        feat[:, 6:9] = color[idx_part] / 127.5 - 1
+
+        data_part = dict(index=idx_part, grid_coord=grid_coord)
+        if grid_sample.return_min_coord:
+            min_coord = min_coord * np.array(grid_sample.grid_size)
+            data_part["min_coord"] = min_coord.reshape([1, 3])
+        for key in data_dict.keys():
+            data_part[key] = data_dict[key]
+        data_part["coord"] = feat[:, 3:6]
+        data_part["color"] = feat[:, 6:9]
+        data_part["feat"] = feat
+        return data_part
+
+
 # Load a point cloud from a file
 def load_o3d_pcd(file_path: str):
     return o3d.io.read_point_cloud(file_path)
 
 
-# Get points and colors from a Open3D point cloud
+# Convert colors in [0, 1] or [0, 255] to uint8
+def to_uint8_colors(colors: np.ndarray):
+    if colors.dtype == COLOR_DTYPE:
+        return colors
+    if colors.shape[1] == 4:
+        colors = colors[:, :3]
+    if colors.max() < 1.1:
+        # round so that uint8 colors read as u / 255 map back to u
+        colors = np.round(colors * 255)
+    return np.clip(colors, 0, 255).astype(COLOR_DTYPE)
+
+
+# Get float32 points and uint8 colors from a Open3D point cloud
 def get_points_and_colors(pcd: o3d.geometry.PointCloud):
-    points = np.asarray(pcd.points)
-    colors = np.zeros_like(points, dtype=np.uint8)
+    if isinstance(pcd, PlyPointCloud):
+        return pcd.xyz, pcd.rgb
+    points = np.asarray(pcd.points, dtype=COORD_DTYPE)
+    colors = np.zeros_like(points, dtype=COLOR_DTYPE)
     if pcd.has_colors():
-        colors = np.asarray(pcd.colors)
-        if colors.shape[1] == 4:
-            colors = colors[:, :3]
-        if colors.max() < 1.1:
-            colors = (colors * 255).astype(np.uint8)
+        colors = to_uint8_colors(np.asarray(pcd.colors))
     return points, colors
 
 
+# Voxel down sample a memory-mapped PLY chunk by chunk, following Open3D's
+# voxel_down_sample: the grid starts half a voxel below the minimum bound and
+# every voxel is replaced by the average of its points and colors
+def voxel_down_sample_ply(
+    ply: PlyPointCloud, voxel_size: float, chunk_size: int = 1 << 22
+):
+    vertices = ply.vertices
+    min_bound = np.array([vertices[f].min() for f in ply.xyz_fields], np.float64)
+    max_bound = np.array([vertices[f].max() for f in ply.xyz_fields], np.float64)
+    origin = min_bound - voxel_size * 0.5
+    dims = np.floor((max_bound - origin) / voxel_size).astype(np.int64) + 1
+    strides = np.array([dims[1] * dims[2], dims[2], 1], dtype=np.int64)
+
+    # accumulated voxel keys and [x, y, z, r, g, b, count] sums
+    keys = np.empty(0, dtype=np.int64)
+    sums = np.empty((0, 7), dtype=np.float64)
+    for xyz, rgb in ply.iter_chunks(chunk_size):
+        voxel = np.floor((xyz - origin) / voxel_size).astype(np.int64)
+        chunk = np.empty((len(xyz), 7), dtype=np.float64)
+        chunk[:, :3] = xyz
+        chunk[:, 3:6] = rgb / 255.0
+        chunk[:, 6] = 1.0
+        keys = np.concatenate([keys, voxel @ strides])
+        sums = np.concatenate([sums, chunk])
+        keys, inverse = np.unique(keys, return_inverse=True)
+        sums = np.stack(
+            [
+                np.bincount(inverse, weights=sums[:, i], minlength=len(keys))
+                for i in range(sums.shape[1])
+            ],
+            axis=1,
+        )
+
+    pcd = o3d.geometry.PointCloud()
+    pcd.points = o3d.utility.Vector3dVector(sums[:, :3] / sums[:, 6:])
+    if ply.has_colors():
+        pcd.colors = o3d.utility.Vector3dVector(sums[:, 3:6] / sums[:, 6:])
+    return pcd
+
+
 # Preprocess a point cloud
 def cleanup_pcd(
     pcd: o3d.geometry.PointCloud,
     voxel_size: float = 0.02,
     num_nb: int = 3,
     radius: float = 0.05,
+    neighbor_backend: str = "kdtree",
 ):
     # voxelize the point cloud
-    pcd = pcd.voxel_down_sample(voxel_size)
+    if isinstance(pcd, PlyPointCloud):
+        pcd = voxel_down_sample_ply(pcd, voxel_size)
+    else:
+        pcd = pcd.voxel_down_sample(voxel_size)
     # remove outliers
-    pcd, _ = pcd.remove_radius_outlier(num_nb, radius)
+    if neighbor_backend == "kdtree":
+        pcd, _ = remove_radius_outlier(pcd, num_nb, radius)
+    elif neighbor_backend == "open3d":
+        pcd, _ = pcd.remove_radius_outlier(num_nb, radius)
+    else:
+        raise ValueError(f"Unsupported neighbor backend: {neighbor_backend}")
     return pcd
@@ -0,0 +1,212 @@
+"""
+Memory-mapped reader for binary PLY point clouds.
+
+The vertex block of a binary PLY file is a packed array of records, so it can be
+mapped with ``np.memmap`` and exposed as NumPy views without reading the whole
+scan into memory. Coordinates stay float32 and colors uint8 as stored on disk.
+"""
+
+import numpy as np
+
+PLY_DTYPES = {
+    "char": "i1",
+    "int8": "i1",
+    "uchar": "u1",
+    "uint8": "u1",
+    "short": "i2",
+    "int16": "i2",
+    "ushort": "u2",
+    "uint16": "u2",
+    "int": "i4",
+    "int32": "i4",
+    "uint": "u4",
+    "uint32": "u4",
+    "float": "f4",
+    "float32": "f4",
+    "double": "f8",
+    "float64": "f8",
+}
+
+PLY_FORMATS = {
+    "binary_little_endian": "<",
+    "binary_big_endian": ">",
+}
+
+COLOR_PROPERTIES = (
+    ("red", "green", "blue"),
+    ("r", "g", "b"),
+    ("diffuse_red", "diffuse_green", "diffuse_blue"),
+)
+
+
+def parse_ply_header(file_path: str):
+    """Parse the header of a binary PLY file.
+
+    Returns:
+        header_size: int, byte offset of the first element.
+        byte_order: str, "<" or ">".
+        elements: List[Tuple[str, int, List[Tuple[str, str]]]], the name, count
+            and (property name, NumPy type) pairs of each element.
+    """
+    elements = []
+    with open(file_path, "rb") as f:
+        if f.readline().strip() != b"ply":
+            raise ValueError(f"{file_path} is not a PLY file")
+        byte_order = None
+        while True:
+            line = f.readline()
+            if not line:
+                raise ValueError(f"{file_path} has no end_header line")
+            tokens = line.decode("ascii").split()
+            if not tokens or tokens[0] in ("comment", "obj_info"):
+                continue
+            if tokens[0] == "end_header":
+                break
+            if tokens[0] == "format":
+                if tokens[1] not in PLY_FORMATS:
+                    raise ValueError(
+                        f"Unsupported PLY format {tokens[1]}, only binary PLY files "
+                        "can be memory-mapped"
+                    )
+                byte_order = PLY_FORMATS[tokens[1]]
+            elif tokens[0] == "element":
+                elements.append((tokens[1], int(tokens[2]), []))
+            elif tokens[0] == "property":
+                if tokens[1] == "list":
+                    elements[-1][2].append((tokens[-1], None))
+                else:
+                    elements[-1][2].append((tokens[2], PLY_DTYPES[tokens[1]]))
+        header_size = f.tell()
+    if byte_order is None:
+        raise ValueError(f"{file_path} has no format line")
+    return header_size, byte_order, elements
+
+
+class PlyPointCloud(object):
+    """Binary PLY point cloud backed by a memory map of its vertex block.
+
+    Args:
+        file_path: str, path to a binary little or big endian PLY file.
+    """
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        header_size, byte_order, elements = parse_ply_header(file_path)
+
+        offset = header_size
+        for name, count, properties in elements:
+            if any(prop_type is None for _, prop_type in properties):
+                # variable sized records cannot be mapped or skipped
+                raise ValueError(
+                    f"Cannot map element {name} with list properties, the vertex "
+                    "element must come first"
+                )
+            dtype = np.dtype(
+                [(prop, byte_order + prop_type) for prop, prop_type in properties]
+            )
+            if name == "vertex":
+                break
+            offset += count * dtype.itemsize
+        else:
+            raise ValueError(f"{file_path} has no vertex element")
+
+        self.num_points = count
+        self.vertex_dtype = dtype
+        self.vertex_offset = offset
+        self._raw = np.memmap(file_path, dtype=np.uint8, mode="r")
+        self.vertices = np.ndarray(
+            shape=(count,), dtype=dtype, buffer=self._raw, offset=offset
+        )
+
+        self.xyz_fields = ("x", "y", "z")
+        for field in self.xyz_fields:
+            if field not in dtype.names:
+                raise ValueError(f"{file_path} has no vertex property {field}")
+        self.rgb_fields = None
+        for fields in COLOR_PROPERTIES:
+            if all(field in dtype.names for field in fields):
+                self.rgb_fields = fields
+                break
+
+    def __len__(self):
+        return self.num_points
+
+    def has_colors(self):
+        return self.rgb_fields is not None
+
+    def _packed_view(self, fields, type_str):
+        """Return a [N, 3] view of three adjacent fields of the same type, or None."""
+        base = self.vertex_dtype.fields[fields[0]]
+        field_dtype, field_offset = base[0], base[1]
+        if field_dtype.str[1:] != type_str:
+            return None
+        for i, field in enumerate(fields):
+            dtype, offset = self.vertex_dtype.fields[field][:2]
+            if dtype != field_dtype or offset != field_offset + i * dtype.itemsize:
+                return None
+        return np.ndarray(
+            shape=(self.num_points, 3),
+            dtype=field_dtype,
+            buffer=self._raw,
+            offset=self.vertex_offset + field_offset,
+            strides=(self.vertex_dtype.itemsize, field_dtype.itemsize),
+        )
+
+    def _convert_xyz(self, vertices):
+        xyz = np.empty((len(vertices), 3), dtype=np.float32)
+        for i, field in enumerate(self.xyz_fields):
+            xyz[:, i] = vertices[field]
+        return xyz
+
+    def _convert_rgb(self, vertices):
+        rgb = np.zeros((len(vertices), 3), dtype=np.uint8)
+        if self.rgb_fields is None:
+            return rgb
+        for i, field in enumerate(self.rgb_fields):
+            channel = vertices[field]
+            if channel.dtype.kind == "f":
+                # float colors are stored in [0, 1]
+                channel = np.clip(channel * 255.0, 0, 255)
+            rgb[:, i] = channel
+        return rgb
+
+    @property
+    def xyz(self):
+        """[N, 3] float32 coordinates.
+
+        A zero-copy view of the file when x, y, z are adjacent float32 properties,
+        otherwise a float32 copy.
+        """
+        view = self._packed_view(self.xyz_fields, "f4")
+        if view is not None:
+            return view
+        return self._convert_xyz(self.vertices)
+
+    @property
+    def rgb(self):
+        """[N, 3] uint8 colors, zeros if the file has no colors.
+
+        A zero-copy view of the file when the color properties are adjacent
+        uchar properties, otherwise a uint8 copy.
+        """
+        if self.rgb_fields is not None:
+            view = self._packed_view(self.rgb_fields, "u1")
+            if view is not None:
+                return view
+        return self._convert_rgb(self.vertices)
+
+    def iter_chunks(self, chunk_size: int = 1 << 22):
+        """Iterate over the points in chunks.
+
+        Yields:
+            xyz: [chunk_size, 3] float32 array.
+            rgb: [chunk_size, 3] uint8 array.
+        """
+        for start in range(0, self.num_points, chunk_size):
+            vertices = self.vertices[start : start + chunk_size]
+            yield self._convert_xyz(vertices), self._convert_rgb(vertices)
+
+
+# Load a binary PLY point cloud without reading it into memory
+def load_ply_pcd(file_path: str):
+    return PlyPointCloud(file_path)
@@ -0,0 +1,77 @@
+"""
+Split scenes larger than the normalization world into overlapping tiles.
+
+Every tile fits in the world box on the floor plane, so ``GridSample`` never has
+to clip its grid coordinates. Neighboring tiles overlap, and each tile owns the
+part of the floor up to the middle of its overlaps, which is used to decide
+which tile an entity predicted twice belongs to.
+"""
+
+import math
+from dataclasses import dataclass
+
+import numpy as np
+
+
+@dataclass
+class Tile:
+    index: np.ndarray
+    owned_min: np.ndarray
+    owned_max: np.ndarray
+
+
+def _tile_starts(lower: float, upper: float, tile_size: float, overlap: float):
+    """Start of every tile along one axis, the last tile ends at upper."""
+    extent = upper - lower
+    if extent <= tile_size:
+        return [lower]
+    stride = tile_size - overlap
+    num_tiles = math.ceil((extent - tile_size) / stride) + 1
+    starts = [lower + i * stride for i in range(num_tiles - 1)]
+    starts.append(upper - tile_size)
+    return starts
+
+
+def _owned_bounds(starts, tile_size: float):
+    """Owned interval of every tile, split in the middle of each overlap."""
+    bounds = [-np.inf]
+    for prev_start, start in zip(starts[:-1], starts[1:]):
+        bounds.append((start + prev_start + tile_size) * 0.5)
+    bounds.append(np.inf)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def split_into_tiles(points: np.ndarray, tile_size: float, overlap: float = 4.0):
+    """Partition points into overlapping tiles on the floor plane.
+
+    Args:
+        points: [N, 3] array of coordinates.
+        tile_size: float, side length of a tile, smaller than the world box.
+        overlap: float, width of the band shared by neighboring tiles.
+
+    Returns:
+        List[Tile], the point indices and the owned floor region of every
+        non-empty tile. A single tile owning everything if the scene fits.
+    """
+    assert 0 <= overlap < tile_size
+    lower = points[:, :2].min(0)
+    upper = points[:, :2].max(0)
+    starts = [_tile_starts(lower[i], upper[i], tile_size, overlap) for i in range(2)]
+    owned = [_owned_bounds(axis_starts, tile_size) for axis_starts in starts]
+
+    tiles = []
+    for x_start, (x_min, x_max) in zip(starts[0], owned[0]):
+        in_x = (points[:, 0] >= x_start) & (points[:, 0] <= x_start + tile_size)
+        for y_start, (y_min, y_max) in zip(starts[1], owned[1]):
+            in_y = (points[:, 1] >= y_start) & (points[:, 1] <= y_start + tile_size)
+            index = np.flatnonzero(in_x & in_y)
+            if len(index) == 0:
+                continue
+            tiles.append(
+                Tile(
+                    index=index,
+                    owned_min=np.array([x_min, y_min]),
+                    owned_max=np.array([x_max, y_max]),
+                )
+            )
+    return tiles
@@ -0,0 +1,141 @@
+"""
+Incremental voxel map for scans captured in several passes.
+
+Points are hashed into fixed-size voxels with the FNV hash of ``GridSample`` and
+every voxel keeps running sums of its coordinates and colors, so a new pass only
+costs time proportional to its own size plus the size of the map, and the
+averaged cloud can be emitted at any time without touching the raw points again.
+"""
+
+import numpy as np
+
+from spatiallm.pcd.pcd_loader import (
+    COLOR_DTYPE,
+    COORD_DTYPE,
+    Compose,
+    GridSample,
+    get_points_and_colors,
+)
+from spatiallm.pcd.ply import PlyPointCloud
+
+
+class VoxelMap(object):
+    """Voxel hash map averaging the points and colors that fall in each voxel.
+
+    Averaging mirrors Open3D's ``voxel_down_sample``, so the map can stand in for
+    the voxelization step of ``cleanup_pcd``. The grid is anchored at the origin
+    instead of the minimum bound so that it stays fixed as passes are added.
+
+    Args:
+        voxel_size: float, side length of a voxel in meters.
+    """
+
+    def __init__(self, voxel_size: float = 0.02):
+        self.voxel_size = voxel_size
+        # sorted voxel keys and the per-voxel sums and point counts
+        self.keys = np.empty(0, dtype=np.uint64)
+        self.xyz_sum = np.empty((0, 3), dtype=np.float64)
+        self.rgb_sum = np.empty((0, 3), dtype=np.float64)
+        self.count = np.empty(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def insert(self, points: np.ndarray, colors: np.ndarray = None):
+        """Add a chunk of points with optional [N, 3] uint8 colors."""
+        if len(points) == 0:
+            return
+        voxel = np.floor(points / self.voxel_size).astype(np.int64)
+        key, inverse = np.unique(GridSample.fnv_hash_vec(voxel), return_inverse=True)
+        num_keys = len(key)
+        xyz_sum = np.stack(
+            [
+                np.bincount(inverse, weights=points[:, i], minlength=num_keys)
+                for i in range(3)
+            ],
+            axis=1,
+        )
+        rgb_sum = np.zeros((num_keys, 3), dtype=np.float64)
+        if colors is not None:
+            for i in range(3):
+                rgb_sum[:, i] = np.bincount(
+                    inverse, weights=colors[:, i], minlength=num_keys
+                )
+        count = np.bincount(inverse, minlength=num_keys)
+
+        # accumulate into the voxels already in the map
+        pos = np.searchsorted(self.keys, key)
+        found = np.zeros(num_keys, dtype=bool)
+        if len(self.keys) > 0:
+            found = self.keys[np.minimum(pos, len(self.keys) - 1)] == key
+        self.xyz_sum[pos[found]] += xyz_sum[found]
+        self.rgb_sum[pos[found]] += rgb_sum[found]
+        self.count[pos[found]] += count[found]
+
+        # insert the new voxels, keys and positions are both sorted
+        new = ~found
+        self.keys = np.insert(self.keys, pos[new], key[new])
+        self.xyz_sum = np.insert(self.xyz_sum, pos[new], xyz_sum[new], axis=0)
+        self.rgb_sum = np.insert(self.rgb_sum, pos[new], rgb_sum[new], axis=0)
+        self.count = np.insert(self.count, pos[new], count[new])
+
+    def insert_pcd(self, pcd, chunk_size: int = 1 << 22):
+        """Add an Open3D point cloud or a memory-mapped PLY, chunk by chunk."""
+        if isinstance(pcd, PlyPointCloud):
+            for xyz, rgb in pcd.iter_chunks(chunk_size):
+                self.insert(xyz, rgb)
+        else:
+            self.insert(*get_points_and_colors(pcd))
+
+    def get_points_and_colors(self):
+        """Average point and color of every voxel, float32 and uint8."""
+        count = self.count[:, None]
+        points = (self.xyz_sum / count).astype(COORD_DTYPE)
+        colors = np.round(self.rgb_sum / count).astype(COLOR_DTYPE)
+        return points, colors
+
+    def get_features(self, grid_size: float, num_bins: int):
+        """Voxelize the map into the input features of the model.
+
+        Returns:
+            feat: [N, 9] float32 array of grid coordinates, coordinates and colors.
+            min_extent: [3] minimum bound that maps a predicted layout back.
+        """
+        points, colors = self.get_points_and_colors()
+        transform = Compose(
+            [
+                dict(type="PositiveShift"),
+                dict(type="NormalizeColor"),
+                dict(
+                    type="GridSample",
+                    grid_size=grid_size,
+                    hash_type="fnv",
+                    mode="test",
+                    keys=("coord", "color"),
+                    return_grid_coord=True,
+                    max_grid_coord=num_bins,
+                ),
+            ]
+        )
+        point_cloud = transform({"coord": points, "color": colors})
+        return point_cloud["feat"], points.min(0)
+
+    def save(self, file_path: str):
+        np.savez(
+            file_path,
+            voxel_size=self.voxel_size,
+            keys=self.keys,
+            xyz_sum=self.xyz_sum,
+            rgb_sum=self.rgb_sum,
+            count=self.count,
+        )
+
+    @classmethod
+    def load(cls, file_path: str):
+        with np.load(file_path) as data:
+            voxel_map = cls(float(data["voxel_size"]))
+            voxel_map.keys = data["keys"]
+            voxel_map.xyz_sum = data["xyz_sum"]
+            voxel_map.rgb_sum = data["rgb_sum"]
+            voxel_map.count = data["count"]
+        return voxel_map
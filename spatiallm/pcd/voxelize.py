@@ -0,0 +1,160 @@
+"""
+Linear-time voxelization for bounded grid coordinates.
+
+When grid coordinates are clipped to a known number of bins (e.g. the 640 bins
+of the normalization world), the voxel key fits in a dense ravel index and the
+points can be grouped with a counting sort instead of hashing and comparison
+sorting the whole scan twice.
+"""
+
+import numpy as np
+
+
+def ravel_grid_coord(grid_coord: np.ndarray, num_bins=None):
+    """Ravel non-negative integer grid coordinates into a dense C-order index.
+
+    Args:
+        grid_coord: [N, 3] non-negative integer array.
+        num_bins: int, optional upper bound of every coordinate. The bound of
+            each axis is computed from the data if not given.
+
+    Returns:
+        key: [N] int32 (int64 if the volume does not fit) dense voxel index.
+        num_keys: int, the size of the dense index space.
+    """
+    assert grid_coord.ndim == 2 and grid_coord.shape[1] == 3
+    if num_bins is None:
+        dims = grid_coord.max(0).astype(np.int64) + 1
+    else:
+        dims = np.full(3, num_bins, dtype=np.int64)
+    num_keys = int(np.prod(dims))
+    key_dtype = np.int32 if num_keys <= np.iinfo(np.int32).max else np.int64
+    strides = np.array([dims[1] * dims[2], dims[2], 1], dtype=key_dtype)
+    key = grid_coord.astype(key_dtype, copy=False) @ strides
+    return key, num_keys
+
+
+def counting_argsort(key: np.ndarray, num_keys: int):
+    """Stable argsort of integer keys in [0, num_keys) by LSD counting sort.
+
+    Each pass sorts one 16-bit digit, which NumPy handles with a linear-time
+    radix sort, so a 640^3 ravel index takes two passes over the data.
+    """
+    num_bits = max(int(num_keys - 1).bit_length(), 1)
+    order = None
+    for shift in range(0, num_bits, 16):
+        digit = ((key >> shift) & 0xFFFF).astype(np.uint16)
+        if order is None:
+            order = np.argsort(digit, kind="stable")
+        else:
+            order = order[np.argsort(digit[order], kind="stable")]
+    return order
+
+
+def voxelize_test(
+    grid_coord: np.ndarray, num_bins=None, hash_fn=None, return_inverse=False
+):
+    """Select one representative point per voxel in linear time.
+
+    Reproduces the test mode of ``GridSample``: voxels are ordered by
+    ``hash_fn`` of their grid coordinate and the representative of each voxel is
+    the ``(count.max() // 2) % count``-th point of the voxel. Ties inside a voxel
+    are broken by the original point order, i.e. the result equals the sort
+    based path run with a stable argsort.
+
+    Args:
+        grid_coord: [N, 3] non-negative integer array, bounded by the grid.
+        num_bins: int, optional upper bound of every coordinate.
+        hash_fn: callable mapping [V, 3] grid coordinates to [V] keys that
+            define the voxel order. Defaults to the ravel order.
+        return_inverse: bool, whether to compute the point-to-voxel mapping.
+
+    Returns:
+        index: [V] indices of the selected points.
+        inverse: [N] voxel index of every point, or None.
+        count: [V] number of points per voxel.
+    """
+    num_points = grid_coord.shape[0]
+    key, num_keys = ravel_grid_coord(grid_coord, num_bins)
+    order = counting_argsort(key, num_keys)
+    key_sort = key[order]
+
+    is_first = np.empty(num_points, dtype=bool)
+    is_first[0] = True
+    np.not_equal(key_sort[1:], key_sort[:-1], out=is_first[1:])
+    start = np.flatnonzero(is_first)
+    count = np.diff(np.append(start, num_points))
+    index = order[start + (count.max() // 2) % count]
+
+    # reorder voxels the same way the hashed path does
+    if hash_fn is not None:
+        perm = np.argsort(hash_fn(grid_coord[index]))
+        index = index[perm]
+        count = count[perm]
+    else:
+        perm = None
+
+    inverse = None
+    if return_inverse:
+        voxel_id = np.cumsum(is_first) - 1
+        if perm is not None:
+            rank = np.empty_like(perm)
+            rank[perm] = np.arange(perm.size)
+            voxel_id = rank[voxel_id]
+        inverse = np.empty(num_points, dtype=np.intp)
+        inverse[order] = voxel_id
+    return index, inverse, count
+
+
+def count_occupied_cells(coord: np.ndarray, cell_size: float):
+    """Number of cells of a grid anchored at the minimum bound holding points."""
+    cell = np.floor((coord - coord.min(0)) / cell_size).astype(np.int64)
+    key, _ = ravel_grid_coord(cell)
+    return len(np.unique(key))
+
+
+def fit_cell_budget(
+    coord: np.ndarray, cell_size: float, max_cells: int, tolerance: float = 0.02
+):
+    """Smallest factor to scale cell_size by so that at most max_cells are occupied.
+
+    The factor is found by a bisection in log space on the centers of the
+    occupied cells of size ``cell_size / 8``, which is much cheaper than counting
+    on every point, and then checked against the points themselves.
+
+    Args:
+        coord: [N, 3] array of coordinates.
+        cell_size: float, size of the cells at scale 1.
+        max_cells: int, budget of occupied cells.
+        tolerance: float, relative precision of the factor.
+
+    Returns:
+        scale: float, 1.0 if the budget is already met.
+        num_cells: int, number of occupied cells at that scale.
+    """
+    num_cells = count_occupied_cells(coord, cell_size)
+    if num_cells <= max_cells:
+        return 1.0, num_cells
+
+    fine_size = cell_size / 8
+    fine = np.floor((coord - coord.min(0)) / fine_size).astype(np.int64)
+    key, _ = ravel_grid_coord(fine)
+    _, first = np.unique(key, return_index=True)
+    centers = (fine[first] + 0.5) * fine_size
+
+    lower, upper = 1.0, 2.0
+    while count_occupied_cells(centers, cell_size * upper) > max_cells:
+        lower, upper = upper, upper * 2
+    while upper / lower > 1 + tolerance:
+        middle = np.sqrt(lower * upper)
+        if count_occupied_cells(centers, cell_size * middle) > max_cells:
+            lower = middle
+        else:
+            upper = middle
+
+    # the estimate can be off by a few cells, grow until the points fit
+    num_cells = count_occupied_cells(coord, cell_size * upper)
+    while num_cells > max_cells:
+        upper *= 1 + tolerance
+        num_cells = count_occupied_cells(coord, cell_size * upper)
+    return float(upper), num_cells